@@ -20,7 +20,9 @@ import procedural_compute.cfd.solvers
 
 from procedural_compute.core.utils import subprocesses, fileUtils
 from procedural_compute.core.utils import threads
-from procedural_compute.core.utils.subprocesses import waitSTDOUT
+from procedural_compute.core.utils.subprocesses import waitSTDOUT, streamSTDOUT
+from procedural_compute.cfd.utils.foamLog import FoamLog, runSolver
+from procedural_compute.cfd.utils.pipeline import Pipeline, Step
 
 
 class SCENE_OT_cfdOperators(bpy.types.Operator):
@@ -205,77 +207,88 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
     def caseDir(self):
         return bpy.path.abspath(bpy.context.scene.Compute.CFD.system.caseDir)
 
+    def nCores(self):
+        """ Cores used by the parallel steps
+        """
+        system = bpy.context.scene.Compute.CFD.system
+        if not system.runMPI:
+            return 1
+        bpy.ops.scene.getnumsubdomains()
+        return system.numSubdomains
+
     def basicMesh(self):
-        mpi = bpy.context.scene.Compute.CFD.system.runMPI
-        self.runFoamBlockMesh()
-        if bpy.context.scene.Compute.CFD.mesh.nFeatureSnapIter > 0:
-            self.runFoamSurfaceFeatureExtract()
-        if mpi:
-            self.decomposePar()
-        self.runFoamSnapMesh()
-        if mpi:
-            self.reconstructParMesh()
-            threads.queue_fun("cfdRun", self.delProcessDirs, (self.caseDir(),))
+        CFD = bpy.context.scene.Compute.CFD
+        commands = ["blockMesh"]
+        if CFD.mesh.nFeatureSnapIter > 0:
+            commands.append("surfaceFeatureExtract")
+        commands += ["snappyHexMesh -overwrite", "reconstructParMesh -constant -mergeTol 1e-6"]
+        pipeline = Pipeline.fromCommands("mesh", commands, cores=self.nCores(), mpiCall=self.getMpiCall())
+        if "reconstructParMesh" in pipeline.steps:
+            pipeline.add(Step("delProcessDirs", self.delProcessDirs, after=("reconstructParMesh",)))
+        # The pipeline runs its own steps (on the cfdSteps pool) so takes no cores itself
+        threads.queue_fun("cfdRun", pipeline.run, (self.caseDir(),), cores=0)
         return None
 
     def basicRun(self):
-        mpi = bpy.context.scene.Compute.CFD.system.runMPI
-        if mpi:
-            self.decomposePar()
-        self.runFoamCase()
-        if mpi:
-            self.reconstructPar()
+        CFD = bpy.context.scene.Compute.CFD
+        commands = [CFD.solver.name, "reconstructPar -latestTime"]
+        pipeline = Pipeline.fromCommands("run", commands, cores=self.nCores(), mpiCall=self.getMpiCall(),
+                                         convergence=CFD.control.convergence())
+        threads.queue_fun("cfdRun", pipeline.run, (self.caseDir(),), cores=0)
         return None
 
+    def queueCommand(self, cmd, logfile, mode='w', cores=1, queue="cfdRun"):
+        """ Queue the command, streaming its output to the logfile in the case directory
+        """
+        kwargs = {'name': queue, 'logfile': logfile, 'mode': mode}
+        return threads.queue_fun(queue, streamSTDOUT, (cmd, self.caseDir()), kwargs, cores=cores)
+
     def runFoamBlockMesh(self):
-        cmd = "blockMesh | tee logBM.txt"
-        threads.queue_fun("cfdRun", waitSTDOUT, (cmd, self.caseDir()))
+        self.queueCommand("blockMesh", "logBM.txt")
         return None
 
     def runFoamSurfaceFeatureExtract(self):
-        cmd = "surfaceFeatureExtract | tee logSFE.txt"
-        threads.queue_fun("cfdRun", waitSTDOUT, (cmd, self.caseDir()))
+        self.queueCommand("surfaceFeatureExtract", "logSFE.txt")
         return None
 
     def runFoamSnapMesh(self):
-        cmd = "%s snappyHexMesh -overwrite %s | tee logSHM.txt"%(self.getMpiCall(), self.parStr())
-        threads.queue_fun("cfdRun", waitSTDOUT, (cmd, self.caseDir()))
+        cmd = "%s snappyHexMesh -overwrite %s"%(self.getMpiCall(), self.parStr())
+        self.queueCommand(cmd, "logSHM.txt", cores=self.nCores())
         return None
 
     def runPostMeshUtils(self):
         def run(cmd):
             setSets = fileUtils.getFilesByExtension('.setSet', '%s/'%self.caseDir())
             for s in setSets:
-                waitSTDOUT("%s setSet %s -batch %s | tee logPMesh.txt"%(self.getMpiCall(), self.parStr(), s), cwd=self.caseDir())
-            waitSTDOUT("%s setsToZones %s %s | tee logPMesh.txt"%(self.getMpiCall(), self.parStr(), s), cwd=self.caseDir())
-            waitSTDOUT("%s changeDictionary %s %s | tee logPMesh.txt"%(self.getMpiCall(), self.parStr(), s), cwd=self.caseDir())
-        threads.queue_fun("cfdRun", run, ())
+                streamSTDOUT("%s setSet %s -batch %s"%(self.getMpiCall(), self.parStr(), s), cwd=self.caseDir(), name="cfdRun", logfile="logPMesh.txt")
+            streamSTDOUT("%s setsToZones %s %s"%(self.getMpiCall(), self.parStr(), s), cwd=self.caseDir(), name="cfdRun", logfile="logPMesh.txt")
+            streamSTDOUT("%s changeDictionary %s %s"%(self.getMpiCall(), self.parStr(), s), cwd=self.caseDir(), name="cfdRun", logfile="logPMesh.txt")
+        threads.queue_fun("cfdRun", run, (), cores=self.nCores())
         return None
 
     def decomposePar(self):
-        cmd = "decomposePar | tee -a logPar.txt"  # latestTime by default in OF-2.0
-        threads.queue_fun("cfdRun", waitSTDOUT, (cmd, self.caseDir()))
+        self.queueCommand("decomposePar", "logPar.txt", mode='a')  # latestTime by default in OF-2.0
         return{'FINISHED'}
 
     def reconstructPar(self):
-        cmd = "reconstructPar -latestTime | tee -a logPar.txt"
-        threads.queue_fun("cfdRun", waitSTDOUT, (cmd, self.caseDir()))
+        self.queueCommand("reconstructPar -latestTime", "logPar.txt", mode='a')
         return None
 
     def reconstructParMesh(self):
-        cmd = "reconstructParMesh -constant -mergeTol 1e-6 | tee -a logPar.txt"
-        threads.queue_fun("cfdRun", waitSTDOUT, (cmd, self.caseDir()))
+        self.queueCommand("reconstructParMesh -constant -mergeTol 1e-6", "logPar.txt", mode='a')
         return None
 
     def paraView(self):
-        cmd = "paraFoam | tee -a logPP.txt"
-        threads.queue_fun("cfdPost", waitSTDOUT, (cmd, self.caseDir()))
+        self.queueCommand("paraFoam", "logPP.txt", mode='a', queue="cfdPost")
         return None
 
     def runFoamCase(self):
         CFD = bpy.context.scene.Compute.CFD
-        cmd = "%s %s %s | tee -a log.txt"%(self.getMpiCall(), CFD.solver.name, self.parStr())
-        threads.queue_fun("cfdRun", waitSTDOUT, (cmd, self.caseDir()))
+        cmd = "%s %s %s"%(self.getMpiCall(), CFD.solver.name, self.parStr())
+        # The residuals are parsed as the solver runs (subprocesses.runs['cfdRun'].parser)
+        convergence = CFD.control.convergence()
+        log = FoamLog(**(convergence or {}))
+        threads.queue_fun("cfdRun", runSolver, (cmd, self.caseDir(), log), {'stopEarly': convergence is not None}, cores=self.nCores())
         return None
 
     def copyMeshLevels(self):
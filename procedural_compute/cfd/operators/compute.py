@@ -17,6 +17,8 @@ import re
 import time
 
 from procedural_compute.cfd.utils import foamCaseFiles, asciiSTLExport, mesh, foamUtils
+from procedural_compute.cfd.utils.pipeline import Pipeline
+from procedural_compute.cfd.utils.windtunnel import WindTunnel
 from procedural_compute.core.utils import subprocesses, fileUtils, threads, to_json
 from procedural_compute.core.utils.subprocesses import waitSTDOUT
 from procedural_compute.core.utils.secrets import secure_login
@@ -24,8 +26,9 @@ import procedural_compute.cfd.solvers
 
 from procedural_compute.core.utils.compute.auth import USER, User
 from procedural_compute.core.utils.compute.view import GenericViewSet
+from procedural_compute.core.utils.compute.taskgraph import TaskGraph
 
-from .utils import get_sets_from_selected, color_object
+from .utils import get_sets_from_selected, parse_probe_data, color_object_points
 
 import logging
 logger = logging.getLogger(__name__)
@@ -117,23 +120,35 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
         (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
 
         geometry_objects = [obj for obj in bpy.context.visible_objects if not self._separate_stl(obj)]
-        geometry = io.StringIO()
-        asciiSTLExport.writeObjectsToFile(geometry, objects=geometry_objects)
-        geometry.seek(0)
-        logger.info("Cast geometry to STL format")
-
-        response = GenericViewSet(
-            f'/api/task/{task_id}/file/foam/constant/triSurface/cfdGeom.stl/'
-        ).update(
-            None,
-            geometry.read().encode('utf8'),
-            raw=True
+        # Always ASCII: the solid names in cfdGeom.stl are the patch names
+        logger.info("Streaming geometry in STL format")
+        response = self._upload_stl(
+            f'/api/task/{task_id}/file/foam/constant/triSurface/cfdGeom.stl/',
+            geometry_objects,
+            binary=False
         )
 
         self.upload_separate_surfaces()
 
         return response
 
+    def _upload_stl(self, path, objects, binary=False, retries=2):
+        """ Stream the STL of the objects to the server as it is generated.  The
+        file endpoint has no resumable offsets, so a dropped connection restarts
+        the upload by regenerating the stream.
+        """
+        for attempt in range(retries + 1):
+            try:
+                return GenericViewSet(path).update(
+                    None,
+                    asciiSTLExport.iterSTL(objects=objects, binary=binary),
+                    raw=True
+                )
+            except ConnectionError as err:
+                if attempt == retries:
+                    raise
+                logger.info(f"Upload of {path} failed ({err}). Retrying ({attempt + 1}/{retries})")
+
     def _separate_stl(self, obj):
         return obj.Compute.CFD.mesh.makeRefinementRegion or obj.Compute.CFD.mesh.makeCellSet
 
@@ -145,20 +160,16 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
         (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
 
         logger.info("Writing refinement regions")
+        binary = bpy.context.scene.Compute.CFD.task.stl_binary
         separate_objects = [obj for obj in bpy.context.visible_objects if self._separate_stl(obj)]
         for obj in separate_objects:
             name = foamUtils.formatObjectName(obj.name)
             logger.info(f" - Writing separate stl region: {name}")
-            geometry = io.StringIO()
-            asciiSTLExport.writeObjectsToFile(geometry, objects = [obj])
-            geometry.seek(0)
-            logger.info(" -- Cast refinement regions and cell sets to STL format")
-            response = GenericViewSet(
-                f'/api/task/{task_id}/file/foam/constant/triSurface/{name}.stl/'
-            ).update(
-                None,
-                geometry.read().encode('utf8'),
-                raw=True
+            logger.info(" -- Streaming refinement regions and cell sets in STL format")
+            response = self._upload_stl(
+                f'/api/task/{task_id}/file/foam/constant/triSurface/{name}.stl/',
+                [obj],
+                binary=binary
             )
 
     def upload_setset(self):
@@ -204,29 +215,56 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
         )
         return action_task
 
+    def task_graph(self):
+        """ The sub-tasks of the CFD task: setup -> mesh -> solution/VWT -> post-processing
+        The task UIDs are cached on the scene between calls (see save_task_graph)
+        """
+        _settings = bpy.context.scene.Compute.CFD.task
+        (project_id, task_id) = _settings.ids
+        cache = json.loads(_settings.task_graph) if _settings.task_graph else None
+
+        graph = TaskGraph(project_id, task_id, cache=cache)
+        setup = graph.task('setup')
+        graph.task('setup mesh', parent=setup)
+        graph.task('setup solution', parent=setup)
+        mesh = graph.task('mesh', dependent_on=setup)
+        graph.task('solution', dependent_on=mesh)
+        vwt = graph.task('VirtualWindTunnel', dependent_on=mesh)
+        graph.task('WindThreshold', dependent_on=vwt, config={
+            'task_type': 'cfd',
+            'cmd': 'run_wind_thresholds',
+            'case_dir': "foam",
+            'cpus': [6, 4, 1],
+            'patches': [],
+            'epw_file': ''
+        })
+        graph.task('PostProcess')
+        return graph
+
+    def save_task_graph(self, graph):
+        bpy.context.scene.Compute.CFD.task.task_graph = json.dumps(graph.cache)
+
+    def dispatch(self, key, action=None, config=None):
+        """ Reconcile the task graph up to the task with the key and send it the action.
+        The config (if given) is used when the task has to be created.
+        """
+        graph = self.task_graph()
+        node = graph.nodes[key]
+        node.action = action
+        node.config = config or node.config
+        try:
+            tasks = graph.reconcile([node])
+        finally:
+            self.save_task_graph(graph)
+        return tasks[key]
+
     def write_mesh_files(self):
         """ Upload the geometry and dispatch the task in one operation
         """
         mesh_properties = bpy.context.scene.Compute.CFD.mesh
-        solver_properties = bpy.context.scene.Compute.CFD.solver
-        (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
-
-        # Get or create an empty setup task
-        setup_task = self.get_or_create_task(
-            project_id, 'setup', task_id,
-        )
-
-        # Get or create the mesh setup task as a child
-        setup_mesh_task = self.get_or_create_task(
-            project_id, 'setup mesh', setup_task['uid']
-        )
 
         # Write the mesh files
-        setup_mesh_task = GenericViewSet(
-            f'/api/project/{project_id}/task/'
-        ).update(
-            setup_mesh_task['uid'],
-        {
+        return self.dispatch('setup/setup mesh', {
             'status': "pending",
             'config': {
                 'task_type': 'magpy',
@@ -236,54 +274,20 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
             }
         })
 
-        return setup_mesh_task
-
     def write_solver_files(self):
         solver_properties = bpy.context.scene.Compute.CFD.solver
-        (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
-
-        # Get or create an empty setup task
-        setup_task = self.get_or_create_task(
-            project_id, 'setup', task_id
-        )
-
-        # Get or create the mesh setup task as a child
-        setup_solution_task = self.get_or_create_task(
-            project_id, 'setup solution', setup_task['uid']
-        )
 
         # the action to create the CFD files
-        setup_solution_task = GenericViewSet(
-            f'/api/project/{project_id}/task/'
-        ).update(
-            setup_solution_task['uid'],
-            {
-                'status': "pending",
-                'config': {
-                    'task_type': 'magpy',
-                    'cmd': 'cfd.io.tasks.write_solution',
-                    'solution': solver_properties.to_json()
-                }
+        return self.dispatch('setup/setup solution', {
+            'status': "pending",
+            'config': {
+                'task_type': 'magpy',
+                'cmd': 'cfd.io.tasks.write_solution',
+                'solution': solver_properties.to_json()
             }
-        )
-
-        return setup_solution_task
-
-
-    def run_mesh_pipeline(self):
-        (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
-        decompN = bpy.context.scene.Compute.CFD.task.decompN
-
-        # Get or create an empty setup task
-        setup_task = self.get_or_create_task(
-            project_id, 'setup', task_id
-        )
-
-        # Get or create the mesh task
-        mesh_task = self.get_or_create_task(
-            project_id, 'mesh', task_id, dependent_on=setup_task['uid']
-        )
+        })
 
+    def mesh_pipeline_commands(self):
         commands = [
             'blockMesh',
             "snappyHexMesh -overwrite",
@@ -295,77 +299,69 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
         cellset_objects = [obj for obj in bpy.context.visible_objects if obj.Compute.CFD.mesh.makeCellSet]
         if len(cellset_objects) > 0:
             commands.append("!setSet -batch zones.setSet")
+        return commands
 
-        # Get or create the mesh task
-        mesh_task = GenericViewSet(
-            f'/api/project/{project_id}/task/'
-        ).update(
-            mesh_task['uid'],
-            {
-                'status': "pending",
-                'config': {
-                    'task_type': 'cfd',
-                    'cmd': 'pipeline',
-                    'cpus': [i for i in decompN],
-                    'commands': commands
-                }
-            }
-        )
+    def solver_commands(self):
+        solver_properties = bpy.context.scene.Compute.CFD.solver
+        return [
+            solver_properties.name,
+            "reconstructPar -noZero"
+        ]
+
+    def run_mesh_pipeline(self):
+        decompN = bpy.context.scene.Compute.CFD.task.decompN
 
-        return mesh_task
+        # Dispatch to the mesh task
+        return self.dispatch('mesh', {
+            'status': "pending",
+            'config': {
+                'task_type': 'cfd',
+                'cmd': 'pipeline',
+                'cpus': [i for i in decompN],
+                'commands': self.mesh_pipeline_commands()
+            }
+        })
 
     def run_solver(self):
-        solver_properties = bpy.context.scene.Compute.CFD.solver
         control_properties = bpy.context.scene.Compute.CFD.control
-        (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
         decompN = bpy.context.scene.Compute.CFD.task.decompN
 
-        # Get or create the mesh task
-        mesh_task = self.get_or_create_task(
-            project_id, 'mesh', task_id
-        )
-
-        # Get or create an empty setup task
-        solver_task = self.get_or_create_task(
-            project_id, 'solution', task_id, dependent_on=mesh_task['uid']
-        )
-
-        # Dispatch to the mesh task
-        solver_task = GenericViewSet(
-            f'/api/project/{project_id}/task/'
-        ).update(
-            solver_task['uid'],
-            {
-                'status': "pending",
-                'config': {
-                    'task_type': 'cfd',
-                    'cmd': 'pipeline',
-                    'commands': [
-                        solver_properties.name,
-                        "reconstructPar -noZero"
-                    ],
-                    'cpus': [i for i in decompN],
-                    'iterations': {
-                        'init': control_properties.endTime
-                    }
+        # Dispatch to the solution task
+        return self.dispatch('solution', {
+            'status': "pending",
+            'config': {
+                'task_type': 'cfd',
+                'cmd': 'pipeline',
+                'commands': self.solver_commands(),
+                'cpus': [i for i in decompN],
+                'iterations': {
+                    'init': control_properties.endTime
                 }
             }
-        )
+        })
 
-        return solver_task
+    def _run_local(self, name, commands):
+        """ Run the pipeline commands in the local case directory (decomposed as the local case)
+        """
+        system = bpy.context.scene.Compute.CFD.system
+        case_dir = bpy.path.abspath(system.caseDir)
+        cores = system.decompN[0] * system.decompN[1] * system.decompN[2]
+        convergence = bpy.context.scene.Compute.CFD.control.convergence()
+        pipeline = Pipeline.fromCommands(name, commands, cores=cores, convergence=convergence)
+        logger.info(f"Running the {name} pipeline locally in {case_dir}: {list(pipeline.steps)}")
+        return threads.queue_fun("cfdRun", pipeline.run, (case_dir,), cores=0)
 
-    def run_wind_tunnel(self):
-        solver_properties = bpy.context.scene.Compute.CFD.solver
+    def run_mesh_pipeline_local(self):
+        return self._run_local('mesh', self.mesh_pipeline_commands())
+
+    def run_solver_local(self):
+        return self._run_local('run', self.solver_commands())
+
+    def _wind_tunnel_config(self):
         mesh_properties = bpy.context.scene.Compute.CFD.mesh
         control_properties = bpy.context.scene.Compute.CFD.control
-        (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
         decompN = bpy.context.scene.Compute.CFD.task.decompN
 
-        # Get or create the mesh task
-        mesh_task = self.get_or_create_task(
-            project_id, 'mesh', task_id
-        )
-
         # Angles and increments
         n_angles = control_properties.n_angles
         incr = 360 / n_angles
@@ -377,52 +373,38 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
         bb = mesh_properties_json['bounding_box']
         bounding_box = [abs(bb['max'][i] - bb['min'][i]) for i in range(3)]
 
-        # Get or create an empty setup task
-        solver_task = self.get_or_create_task(
-            project_id, 'VirtualWindTunnel', task_id,
-            dependent_on=mesh_task['uid'],
-            config = {
-                'task_type': 'cfd',
-                'cmd': 'wind_tunnel',
-                'case_dir': "foam",
-                'commands': [i * incr for i in range(n_angles)],
-                'cpus': [i for i in decompN],
-                'cell_dimensions': {"x": cell_dimensions, "y": cell_dimensions, "z": cell_dimensions},
-                'bounding_box': {"x": bounding_box[0], "y": bounding_box[1], "z": bounding_box[2]},
-                'iterations': {
-                    'init': control_properties.endTime,
-                    'run': control_properties.iters_n or control_properties.endTime
-                }
+        return {
+            'task_type': 'cfd',
+            'cmd': 'wind_tunnel',
+            'case_dir': "foam",
+            'commands': [i * incr for i in range(n_angles)],
+            'cpus': [i for i in decompN],
+            'cell_dimensions': {"x": cell_dimensions, "y": cell_dimensions, "z": cell_dimensions},
+            'bounding_box': {"x": bounding_box[0], "y": bounding_box[1], "z": bounding_box[2]},
+            'iterations': {
+                'init': control_properties.endTime,
+                'run': control_properties.iters_n or control_properties.endTime
             }
-        )
+        }
 
-        return solver_task
+    def run_wind_tunnel(self):
+        # The wind tunnel is dispatched with its config when the task is created
+        return self.dispatch('VirtualWindTunnel', config=self._wind_tunnel_config())
 
-    def run_wind_thresholds(self):
+    def run_wind_tunnel_local(self):
+        """ Run the wind tunnel angles in the local case directory (in VWT/<angle>)
+        """
+        system = bpy.context.scene.Compute.CFD.system
         solver_properties = bpy.context.scene.Compute.CFD.solver
-        control_properties = bpy.context.scene.Compute.CFD.control
-        (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
-
-        # Get or create an empty setup task
-        vwt_task = self.get_or_create_task(
-            project_id, 'VirtualWindTunnel', task_id, dependent_on=mesh_task['uid']
-        )
-
-        # Get or create an empty setup task
-        solver_task = self.get_or_create_task(
-            project_id, 'WindThreshold', task_id,
-            dependent_on=vwt_task['uid'],
-            config = {
-                'task_type': 'cfd',
-                'cmd': 'run_wind_thresholds',
-                'case_dir': "foam",
-                'cpus': [6, 4, 1],
-                'patches': [],
-                'epw_file': ''
-            }
-        )
+        config = self._wind_tunnel_config()
+        case_dir = bpy.path.abspath(system.caseDir)
+        cores = system.decompN[0] * system.decompN[1] * system.decompN[2]
+        tunnel = WindTunnel(case_dir, config['commands'], solver_properties.name, cores, config['iterations'],
+                            convergence=bpy.context.scene.Compute.CFD.control.convergence())
+        return threads.queue_fun("cfdRun", tunnel.run, (), cores=0)
 
-        return solver_task
+    def run_wind_thresholds(self):
+        return self.dispatch('WindThreshold')
 
     def clean_processor_dirs(self, path_prefix="foam"):
         solver_properties = bpy.context.scene.Compute.CFD.solver
@@ -441,13 +423,11 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
             processor_paths = processor_paths.union(set(processors))
         logger.info(f"Got processor folder paths: {processor_paths}")
 
-        # Delete each of the paths
-        for path in processor_paths:
-            response = GenericViewSet(
-                f'/api/task/{task_id}/file/'
-            ).delete(path)
-            logger.info(f"Deleted processor path: {path}")
-            time.sleep(0.05)     # Sleep for a bit to avoid throttling
+        # Delete the paths concurrently (backing off if throttled)
+        (deleted, failed) = GenericViewSet(
+            f'/api/task/{task_id}/file/'
+        ).bulk_delete(processor_paths)
+        self._log_failures("processor path", failed)
 
     def clean_mesh_files(self, path_prefix="foam/constant"):
         solver_properties = bpy.context.scene.Compute.CFD.solver
@@ -475,23 +455,14 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
 
         logger.info(f"Got mesh file and folder paths: {mesh_files}")
 
-        # Delete each of the paths
-        for path in mesh_files:
-            response = GenericViewSet(
-                f'/api/task/{task_id}/file/'
-            ).delete(path)
-            logger.info(f"Deleted mesh file path: {path}")
-            time.sleep(0.05)     # Sleep for a bit to avoid throttling
+        # Delete the paths concurrently (backing off if throttled)
+        (deleted, failed) = GenericViewSet(
+            f'/api/task/{task_id}/file/'
+        ).bulk_delete(mesh_files)
+        self._log_failures("mesh file path", failed)
 
     def probe_selected(self):
-        solver_properties = bpy.context.scene.Compute.CFD.solver
         postproc_properties = bpy.context.scene.Compute.CFD.postproc
-        (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
-
-        # Get or create an empty setup task
-        sub_task = self.get_or_create_task(
-            project_id, 'PostProcess', task_id
-        )
 
         fields = [i.strip() for i in postproc_properties.probe_fields.split(',')]
 
@@ -508,16 +479,11 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
             "sets": get_sets_from_selected()
         }
 
-        # the action to create the CFD files
-        setup_task = GenericViewSet(
-            f'/api/project/{project_id}/task/'
-        ).update(
-            sub_task['uid'],
-            {
-                'status': "pending",
-                'config': config
-            }
-        )
+        # the action to sample the selected objects
+        setup_task = self.dispatch('PostProcess', {
+            'status': "pending",
+            'config': config
+        })
 
         # Start polling for the probe results
         if postproc_properties.auto_load_probes:
@@ -526,25 +492,40 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
         return setup_task
 
     def load_selected_probes(self):
-        from procedural_compute.core.operators import fetch_async, fetch_sync
+        from procedural_compute.core.operators import fetch_all_async
 
-        solver_properties = bpy.context.scene.Compute.CFD.solver
         postproc_properties = bpy.context.scene.Compute.CFD.postproc
         (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
+        scale = [postproc_properties.probe_min_range, postproc_properties.probe_max_range]
+        colormap = None if postproc_properties.probe_colormap == "greyscale" else postproc_properties.probe_colormap
 
         # We should first check the VWT folder and get all of the angles that are available
 
-        first_object = bpy.context.selected_objects[0]
         base_url = f"/api/task/{task_id}/file"  # {_settings.host}
-        file_url = f"{base_url}/{postproc_properties.task_case_dir}/postProcessing/internalCloud/{postproc_properties.probe_time_dir}/{first_object.name}_{postproc_properties.load_probe_field}.xy/"
-
-        def handle_probe_data(data):
-            lines = data.splitlines()
-            logger.info(f"GOT DATA FOR {file_url}. Lines: {len(lines)}.  Applying to object: {first_object.name}")
-            color_object(first_object, lines, scale=[postproc_properties.probe_min_range, postproc_properties.probe_max_range])
-
-        logger.info(f"Waiting for file from url: {file_url}")
-        fetch_async(file_url, callback=handle_probe_data, timeout=30, query_params={'download': 'true'})
+        probe_dir = f"{base_url}/{postproc_properties.task_case_dir}/postProcessing/internalCloud/{postproc_properties.probe_time_dir}"
+
+        def parse(data):
+            # Runs on the request thread
+            return parse_probe_data(data, scale=scale)
+
+        def probe_data_handler(name, file_url):
+            # Look the object up again when the data arrives (it may have been deleted)
+            def handle_probe_data(point_values):
+                obj = bpy.data.objects.get(name)
+                if obj is None:
+                    logger.info(f"Object {name} no longer exists. Skipping probe data from {file_url}")
+                    return
+                logger.info(f"GOT DATA FOR {file_url}. Points: {len(point_values[0])}.  Applying to object: {name}")
+                color_object_points(obj, point_values, colormap=colormap)
+            return handle_probe_data
+
+        fetches = []
+        for obj in bpy.context.selected_objects:
+            file_url = f"{probe_dir}/{obj.name}_{postproc_properties.load_probe_field}.xy/"
+            logger.info(f"Waiting for file from url: {file_url}")
+            fetches.append((file_url, probe_data_handler(obj.name, file_url), parse))
+
+        fetch_all_async(fetches, limit=4, timeout=30, query_params={'download': 'true'})
 
     def clean_task(self):
         (project_id, task_id) = bpy.context.scene.Compute.CFD.task.ids
@@ -574,22 +555,26 @@ class SCENE_OT_cfdOperators(bpy.types.Operator):
         #to_json(tasks, log=True)
 
 
-        # Delete each of the paths
-        for path in root_paths:
-            response = GenericViewSet(
-                f"/api/task/{task_id}/file/"
-            ).delete(path)
-            logger.info(f"Deleting root path: {path}")
-            time.sleep(0.2)     # Sleep for a bit to avoid throttling
+        # Delete the paths concurrently (backing off if throttled)
+        (deleted, failed) = GenericViewSet(
+            f"/api/task/{task_id}/file/"
+        ).bulk_delete(root_paths)
+        self._log_failures("root path", failed)
 
         # Delete the tasks
-        for task in tasks:
-            _id = task.get("uid") 
-            response = GenericViewSet(
-                f"/api/task/"
-            ).delete(_id)
-            logger.info(f"Deleting task: {_id}")
-            time.sleep(0.2)     # Sleep for a bit to avoid throttling
+        (deleted, failed) = GenericViewSet(
+            f"/api/task/"
+        ).bulk_delete([task.get("uid") for task in tasks])
+        self._log_failures("task", failed)
+
+        # The cached sub-task ids are no longer valid
+        bpy.context.scene.Compute.CFD.task.task_graph = ""
+
+    def _log_failures(self, label, failed):
+        for (item, error) in failed.items():
+            logger.info(f"Failed to delete {label}: {item} ({error})")
+        if failed:
+            self.report({'WARNING'}, f"Failed to delete {len(failed)} {label}(s). See the log for details")
 
 
 bpy.utils.register_class(SCENE_OT_cfdOperators)
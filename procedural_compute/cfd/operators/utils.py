@@ -1,11 +1,12 @@
 import bpy
-import mathutils
+import itertools
+import numpy as np
 
-from procedural_compute.core.operators.utils import explode_polygons_to_mesh, color_polygons
+from procedural_compute.core.operators.utils import color_polygons
 
 
 def object_face_centers(obj):
-    return [(obj.matrix_world @ p.center).to_tuple() for p in obj.data.polygons]
+    return object_face_centers_array(obj).tolist()
 
 
 def object_to_set(obj):
@@ -19,57 +20,142 @@ def get_sets_from_selected():
     return [object_to_set(obj) for obj in bpy.context.selected_objects]
 
 
-def _value(values, scale=[0, 1]):
-    # Get the raw value
-    value = mathutils.Vector(values).magnitude if (not len(values) == 0) else values[0]
-    # Fit it as a fraction within the color scale
-    if value < scale[0]:
-        value = 0
-    elif value > scale[1]:
-        value = 1
-    else:
-        value = (value - scale[0]) / (scale[1] - scale[0])
-    return value
-
-
-def get_point_value(line: str, scale=[0, 1]):
-    parts = [float(i) for i in line.split()]
-    return parts[:3], _value(parts[3:], scale=scale)
-
-
-def map_to_polygons(obj, point_values, default=0.0, warning_tol=1e-3):
+def parse_probe_data(data: str, scale=[0, 1]):
+    """ Get the points (N, 3) and values (N,) scaled to a fraction of the colour
+    scale from the text of a probe .xy file.  Values with more than one component
+    are reduced to their magnitude.  This does not touch any blender data so can
+    be run off the main thread.
+    """
+    lines = [line for line in data.splitlines() if line.strip() and not line.startswith('#')]
+    if not lines:
+        return (np.empty((0, 3)), np.empty(0))
+    n_cols = len(lines[0].split())
+    array = np.array(' '.join(lines).split(), dtype=np.float64).reshape(-1, n_cols)
+    print(f"Got points and values for {len(array)}")
+
+    points = array[:, :3]
+    values = np.linalg.norm(array[:, 3:], axis=1)
+    # Fit them as a fraction within the color scale
+    values = np.clip((values - scale[0]) / (scale[1] - scale[0]), 0.0, 1.0)
+    return (points, values)
+
+
+def object_face_centers_array(obj):
+    """ The world-space polygon centers of the object as an (N, 3) array
+    """
     mesh = obj.data
-    size = len(mesh.polygons)
-
-    # Populate a kdtree with polygon centers
-    kd = mathutils.kdtree.KDTree(size)
-    for p in mesh.polygons:
-        kd.insert(obj.matrix_world @ p.center, p.index)
-    kd.balance()
-
-    # Use the kdtree to find the
-    face_values = [default]*size
-    for point, value in point_values:
-        # Get the nearest polygon face to the point
-        co, index, dist = kd.find(point)
-        if dist > warning_tol:
-            print(f"Point {point} not within {warning_tol} of face center.  Got distance {dist} to polygon {index} at {co}")
-        face_values[index] = value
+    centers = np.empty(len(mesh.polygons) * 3, dtype=np.float64)
+    mesh.polygons.foreach_get("center", centers)
+    matrix = np.array(obj.matrix_world)
+    return centers.reshape(-1, 3) @ matrix[:3, :3].T + matrix[:3, 3]
+
+
+def match_points(points, centers, tol=1e-3, chunk=10**6):
+    """ The index of the nearest center to each point and the distance to it.
+    Points within tol of a center are found in one batch on a grid of tol sized
+    cells (checking the neighbouring cells too), the rest by a distance search
+    over all the centers in chunks of about chunk point-center pairs.
+    """
+    index = np.full(len(points), -1, dtype=np.int64)
+    dist = np.full(len(points), np.inf)
+    if len(points) == 0 or len(centers) == 0:
+        return (index, dist)
+
+    # Number the cells by the rank of their key among the center keys along each axis
+    cells = np.floor(centers / tol).astype(np.int64)
+    axes = [np.unique(cells[:, j]) for j in range(3)]
+    center_ids = np.zeros(len(centers), dtype=np.int64)
+    for (j, axis) in enumerate(axes):
+        center_ids = center_ids * len(axis) + np.searchsorted(axis, cells[:, j])
+    order = np.argsort(center_ids, kind='stable')
+    (cell_ids, cell_first, cell_count) = np.unique(center_ids[order], return_index=True, return_counts=True)
+
+    # The rank of each point's key offset by -1, 0 and 1 along each axis (-1 where no center has it),
+    # with the points in the order of their cells so that the lookups below run in order
+    keys = np.floor(points / tol).astype(np.int64)
+    by_cell = np.lexsort(keys.T[::-1])
+    keys = keys[by_cell]
+    ranks = []
+    for (j, axis) in enumerate(axes):
+        rank = np.searchsorted(axis, keys[:, j])
+        present = axis[rank.clip(max=len(axis) - 1)] == keys[:, j]
+        above = rank + present
+        ranks.append({
+            -1: np.where(axis[(rank - 1).clip(min=0)] == keys[:, j] - 1, rank - 1, -1),
+            0: np.where(present, rank, -1),
+            1: np.where(axis[above.clip(max=len(axis) - 1)] == keys[:, j] + 1, above, -1),
+        })
+    # The squared distance (in cells) along each axis to the cells below, at and above each point
+    fraction = points[by_cell] / tol - keys
+    gaps = {-1: fraction**2, 0: np.zeros_like(fraction), 1: (1.0 - fraction)**2}
+
+    # The point's own cell first, then only the neighbouring cells that could hold a nearer center
+    for offset in sorted(itertools.product((-1, 0, 1), repeat=3), key=lambda o: np.abs(o).sum()):
+        gap = gaps[offset[0]][:, 0] + gaps[offset[1]][:, 1] + gaps[offset[2]][:, 2]
+        near = np.flatnonzero(gap * tol**2 < dist[by_cell]**2)
+        rank = np.stack([ranks[j][offset[j]][near] for j in range(3)], axis=1)
+        near = near[(rank >= 0).all(axis=1)]
+        rank = rank[(rank >= 0).all(axis=1)]
+        ids = (rank[:, 0] * len(axes[1]) + rank[:, 1]) * len(axes[2]) + rank[:, 2]
+        cell = np.searchsorted(cell_ids, ids).clip(max=len(cell_ids) - 1)
+        (first, count) = (cell_first[cell], np.where(cell_ids[cell] == ids, cell_count[cell], 0))
+        # Every (point, center in the cell) pair, nearest first for each point
+        rows = np.repeat(by_cell[near], count)
+        starts = np.cumsum(count) - count
+        candidates = order[np.repeat(first - starts, count) + np.arange(len(rows))]
+        d = np.linalg.norm(centers[candidates] - points[rows], axis=1)
+        if len(count) and count.max() > 1:
+            pairs = np.lexsort((d, rows))
+            nearest = pairs[np.r_[True, rows[pairs][1:] != rows[pairs][:-1]]]
+        else:
+            nearest = np.arange(len(rows))
+        closer = nearest[d[nearest] < dist[rows[nearest]]]
+        (index[rows[closer]], dist[rows[closer]]) = (candidates[closer], d[closer])
+
+    far = np.flatnonzero(dist > tol)
+    for rows in np.array_split(far, len(far) * len(centers) // chunk + 1):
+        if len(rows):
+            d = np.linalg.norm(points[rows, None, :] - centers[None, :, :], axis=2)
+            index[rows] = d.argmin(axis=1)
+            dist[rows] = d[np.arange(len(rows)), index[rows]]
+    return (index, dist)
+
+
+def map_to_polygons(obj, points, values, default=0.0, warning_tol=1e-3, relative_tol=1e-5):
+    """ Map the point values onto the polygons of the object.  The points are
+    normally the polygon centers (sent by get_sets_from_selected), so each is
+    given to its nearest center.  The tolerance is warning_tol or relative_tol
+    of the largest coordinate, whichever is larger, as OpenFOAM writes the
+    points to 6 significant digits.
+    """
+    centers = object_face_centers_array(obj)
+    face_values = np.full(len(centers), default, dtype=np.float64)
+    if len(points) == 0 or len(centers) == 0:
+        return face_values
+
+    tol = max(warning_tol, relative_tol * np.abs(np.vstack([centers, points])).max())
+    (index, dist) = match_points(points, centers, tol=tol)
+    face_values[index] = values
+
+    for i in np.flatnonzero(dist > tol):
+        print(f"Point {points[i]} not within {tol} of face center.  Got distance {dist[i]} to polygon {index[i]} at {centers[index[i]]}")
 
     # Return the face values
     return face_values
 
 
-def color_object(obj, lines, scale=[0, 1]):
+def color_object(obj, lines, scale=[0, 1], colormap=None):
     # Get the values in the strings as floats
-    print(f"Converting strings to points and values")
-    point_values = [get_point_value(line, scale=scale) for line in lines]
-    print(f"Got points and values for {len(point_values)}")
+    color_object_points(obj, parse_probe_data('\n'.join(lines), scale=scale), colormap=colormap)
+
+
+def color_object_points(obj, point_values, colormap=None):
+    (points, values) = point_values
     # Match the points to the polygon centers (because openfoam crops them out)
     print("Mapping points and values to polygon centers")
-    face_values = map_to_polygons(obj, point_values)
+    face_values = map_to_polygons(obj, points, values)
     print("Done mapping points and values to polygon centers")
     # Color the polygons with these values
     print(f"Setting vertex colors on object {obj.name}")
-    color_polygons(obj, values = face_values, alpha=1.0)
+    color_polygons(obj, values = face_values, alpha=1.0, colormap=colormap)
     print(f"Done coloring object")
@@ -50,19 +50,39 @@ class SCENE_PROPS_COMPUTE_CFDControl(bpy.types.PropertyGroup):
     n_angles: bpy.props.IntProperty(name="nAngles", default=16, description="Number of Angles for VWT")
     iters_n: bpy.props.IntProperty(name="itersN", default=0, description="Number of iterations for follow-on (series) simulations.  Set to zero to equal endTime")
 
+    stopEarly: bpy.props.BoolProperty(name="stopEarly", description="Stop local runs once the residuals have converged (rather than at endTime)", default=False)
+    stopTolerance: bpy.props.FloatProperty(name="tolerance", description="Initial residual below which a local run has converged", default=1e-4, precision=6)
+    stopPatience: bpy.props.IntProperty(name="patience", description="Number of consecutive converged steps before a local run is stopped", default=5, min=1)
+
+    def convergence(self):
+        """ The FoamLog arguments to stop local runs at, or None to run to endTime
+        """
+        if not self.stopEarly:
+            return None
+        return {'tolerance': self.stopTolerance, 'patience': self.stopPatience}
+
     def drawMenu(self, layout):
         sc = bpy.context.scene
         split = layout.split()
 
         layout.row().prop(self, "endTime")
-        layout.row().operator("scene.compute_operators_cfd", text="Run Solver").command = "run_solver"
+        row = layout.row()
+        row.operator("scene.compute_operators_cfd", text="Run Solver").command = "run_solver"
+        row.operator("scene.compute_operators_cfd", text="Run Locally").command = "run_solver_local"
+        row = layout.row()
+        row.prop(self, "stopEarly")
+        if self.stopEarly:
+            row.prop(self, "stopTolerance")
+            row.prop(self, "stopPatience")
 
         box = layout.box()
         box.row().label(text="Virtual Wind Tunnel")
         split = box.split()
         split.column().prop(self, "n_angles")
         split.column().prop(self, "iters_n")
-        box.row().operator("scene.compute_operators_cfd", text="Run Wind Tunnel").command = "run_wind_tunnel"
+        row = box.row()
+        row.operator("scene.compute_operators_cfd", text="Run Wind Tunnel").command = "run_wind_tunnel"
+        row.operator("scene.compute_operators_cfd", text="Run Locally").command = "run_wind_tunnel_local"
 
         #layout.row().prop(self, "stopAt", expand=False)
         #row = layout.row()
@@ -96,7 +96,9 @@ class SCENE_PROPS_COMPUTE_CFDMesh(bpy.types.PropertyGroup):
         layout.row().operator("scene.compute_operators_cfd", text="Write Mesh Files").command = "write_mesh_files"
         layout.row().operator("scene.compute_operators_cfd", text="Write Solver Files").command = "write_solver_files"
 
-        layout.row().operator("scene.compute_operators_cfd", text="Run Mesh Pipeline").command = "run_mesh_pipeline"
+        row = layout.row()
+        row.operator("scene.compute_operators_cfd", text="Run Mesh Pipeline").command = "run_mesh_pipeline"
+        row.operator("scene.compute_operators_cfd", text="Run Locally").command = "run_mesh_pipeline_local"
 
         box_layout = layout.box()
         box_layout.row().label(text="Clean/delete methods (use with caution):")
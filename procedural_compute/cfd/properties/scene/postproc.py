@@ -22,6 +22,7 @@ class SCENE_PROPS_COMPUTE_CFDPostProc(bpy.types.PropertyGroup):
     load_probe_field: bpy.props.StringProperty(name="Load probe field", default='Utrans', description="Load these fields from the probes")
     probe_min_range: bpy.props.FloatProperty(name="Probe Min Range", default=0.0, description="Probe Min Range")
     probe_max_range: bpy.props.FloatProperty(name="Probe Max Range", default=5.0, description="Probe Max Range")
+    probe_colormap: bpy.props.EnumProperty(name="Colormap", items=make_tuples(["greyscale", "blue-red", "viridis"]), default="greyscale", description="Colormap for the probe values")
 
 
     def drawMenu(self, layout):
@@ -39,6 +40,7 @@ class SCENE_PROPS_COMPUTE_CFDPostProc(bpy.types.PropertyGroup):
         row = box.row()
         row.prop(self, "probe_min_range")
         row.prop(self, "probe_max_range")
+        box.row().prop(self, "probe_colormap")
         row = box.row()
         row.operator("scene.compute_operators_cfd", text="Probe Selected", ).command = "probe_selected"
         row.prop(self, "auto_load_probes", text="Auto Load")
@@ -20,9 +20,12 @@ class SCENE_PROPS_COMPUTE_CFD_Task(bpy.types.PropertyGroup):
     task_name: bpy.props.StringProperty(name="Task Name", default='', description="Task name")
     task_id: bpy.props.StringProperty(name="Task ID", default='', description="Task ID")
     task_data: bpy.props.StringProperty(name="Task data", default='', description="Task data")
+    task_graph: bpy.props.StringProperty(name="Task graph", default='', description="Cached sub-task ids (JSON)")
 
     decompN: bpy.props.IntVectorProperty(name="Nxyz", description="Splits in XYZ", default=(1, 1, 1), min=1)
 
+    stl_binary: bpy.props.BoolProperty(name="Binary STL", default=False, description="Upload single-object surfaces (refinement regions and cell sets) as binary STL")
+
     @property
     def ids(self):
         return (self.project_id, self.task_id)
@@ -46,5 +49,6 @@ class SCENE_PROPS_COMPUTE_CFD_Task(bpy.types.PropertyGroup):
         L.row().operator("scene.compute_operators_cfd", text="Get or Create").command = "get_or_create_project_and_task"
 
         L.row().prop(self, "decompN")
+        L.row().prop(self, "stl_binary")
         
 bpy.utils.register_class(SCENE_PROPS_COMPUTE_CFD_Task)
\ No newline at end of file
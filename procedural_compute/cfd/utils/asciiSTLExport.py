@@ -8,10 +8,36 @@
 
 
 import bpy
+import struct
+import numpy as np
 from procedural_compute.cfd.utils import foamUtils
+from procedural_compute.core.utils import triangles
 from mathutils.geometry import normal
 
 
+SPECIAL_NAMES = ['cfdBoundingBox', 'cfdMeshKeepPoint', 'MinX', 'MaxX', 'MinY', 'MaxY', 'MinZ', 'MaxZ']
+
+# Number of triangles formatted per write when exporting in bulk
+CHUNK_SIZE = 65536
+
+ASCII_FACET = (
+    "facet normal %f %f %f\n"
+    "  outer loop\n"
+    "    vertex %f %f %f\n"
+    "    vertex %f %f %f\n"
+    "    vertex %f %f %f\n"
+    "  endloop\n"
+    "endfacet\n"
+)
+
+# Binary STL record: normal, 3 vertices and a 16-bit attribute (50 bytes)
+BINARY_FACET = np.dtype([
+    ('normal', '<f4', (3,)),
+    ('vertices', '<f4', (3, 3)),
+    ('attribute', '<u2'),
+])
+
+
 def porousWriteCheck(obj, writePorous, writeNonPorous):
     passedPorousWriteCheck = True
     if (not writePorous) and (obj.Compute.CFD.porous_isPorous):
@@ -52,7 +78,7 @@ def writeObjectsToFile(f, objects = None, writePorous=True, writeNonPorous=True)
     if objects is None:
         objects = bpy.context.visible_objects
 
-    specialNames = ['cfdBoundingBox', 'cfdMeshKeepPoint', 'MinX', 'MaxX', 'MinY', 'MaxY', 'MinZ', 'MaxZ']
+    specialNames = SPECIAL_NAMES
 
     for obj in objects:
 
@@ -84,15 +110,115 @@ def writeObjectsToFile(f, objects = None, writePorous=True, writeNonPorous=True)
                     # unless faceToTriangles split a quad to 2 triangles)
                     write_triangle(f, tri)
             f.write("endsolid\n")
+            obj.to_mesh_clear()
+
+
+def exportableObjects(objects=None, writePorous=True, writeNonPorous=True):
+    """ Yield the mesh objects that should be written to STL
+    """
+    if objects is None:
+        objects = bpy.context.visible_objects
+
+    for obj in objects:
+        if (not obj.type == 'MESH') or (len(obj.data.polygons) == 0):
+            continue
+        if obj.name.split('.')[0] in SPECIAL_NAMES:
+            continue
+        if not porousWriteCheck(obj, writePorous, writeNonPorous):
+            continue
+        yield obj
+
+
+def objectTriangles(obj):
+    """ Get the world-space triangles of an object as an (N, 3, 3) float32 array
+    from the shared triangulation cache.  Returns None if the object cannot be
+    converted to a mesh.
+    """
+    return triangles.objectTriangles(obj)
+
+
+def triangleNormals(tris):
+    """ Unit normals of an (N, 3, 3) array of triangles (zero for degenerate faces)
+    """
+    n = np.cross(tris[:, 1] - tris[:, 0], tris[:, 2] - tris[:, 0])
+    length = np.linalg.norm(n, axis=1, keepdims=True)
+    np.divide(n, length, out=n, where=length > 0)
+    n[length[:, 0] == 0] = 0
+    return n
+
+
+def iterAsciiSolid(name, tris):
+    """ Yield the ASCII STL text of a named solid in chunks of CHUNK_SIZE facets
+    """
+    yield "solid %s\n" % name
+    for start in range(0, len(tris), CHUNK_SIZE):
+        chunk = tris[start:start + CHUNK_SIZE]
+        facets = np.hstack([triangleNormals(chunk), chunk.reshape(-1, 9)])
+        yield (ASCII_FACET * len(facets)) % tuple(facets.ravel().tolist())
+    yield "endsolid\n"
+
+
+def iterBinarySTL(solids):
+    """ Yield a binary STL of the (name, triangles) solids in chunks of bytes.
+
+    Binary STL has no solid names, so each facet carries the index of its solid
+    in the attribute field (which is how OpenFOAM reads binary STL zones).
+    Use ASCII where the patch names of a multi-solid file are required.
+    """
+    n_tris = sum(len(tris) for (name, tris) in solids)
+    names = ' '.join(name for (name, tris) in solids)
+    # Not "solid ...": readers that see that at the start of the file parse it as ASCII
+    yield ("binary STL: %s" % names).encode('ascii', 'replace')[:80].ljust(80)
+    yield struct.pack('<I', n_tris)
+    for (index, (name, tris)) in enumerate(solids):
+        for start in range(0, len(tris), CHUNK_SIZE):
+            chunk = tris[start:start + CHUNK_SIZE]
+            records = np.empty(len(chunk), dtype=BINARY_FACET)
+            records['normal'] = triangleNormals(chunk)
+            records['vertices'] = chunk
+            records['attribute'] = index
+            yield records.tobytes()
+
+
+def iterSTL(objects=None, writePorous=True, writeNonPorous=True, binary=False):
+    """ Generate STL data for the objects in chunks.  ASCII chunks are str,
+    binary chunks are bytes.
+    """
+    solids = []
+    for obj in exportableObjects(objects, writePorous, writeNonPorous):
+        tris = objectTriangles(obj)
+        if tris is None:
+            continue
+        name = foamUtils.formatObjectName(obj.name)
+        if binary:
+            solids.append((name, tris))
+        else:
+            yield from iterAsciiSolid(name, tris)
+
+    if binary:
+        yield from iterBinarySTL(solids)
 
 
-def writeTriSurface(filename='constant/triSurface/cfdGeom.stl', writePorous=True, writeNonPorous=True):
+def writeObjectsToFileVectorized(f, objects=None, writePorous=True, writeNonPorous=True, binary=False):
+    """ Write objects in STL format to a file-like object using bulk array
+    operations.  This is a drop-in replacement for writeObjectsToFile. With
+    binary=True the file-like object must be opened in binary mode.
+    """
+    for chunk in iterSTL(objects, writePorous, writeNonPorous, binary=binary):
+        f.write(chunk)
+
+
+def writeTriSurface(filename='constant/triSurface/cfdGeom.stl', writePorous=True, writeNonPorous=True, vectorized=True, binary=False):
     sc = bpy.context.scene
     filename = '%s/%s'%(sc.Compute.CFD.system.caseDir, filename)
-    print('Starting Ascii STL Export of Selected Objects to: %s...' % bpy.path.abspath(filename))
-
-    f = foamUtils.openFileWrite(filename)
-    writeObjectsToFile(f, writePorous=writePorous, writeNonPorous=writeNonPorous)
+    print('Starting %s STL Export of Selected Objects to: %s...' % ('Binary' if binary else 'Ascii', bpy.path.abspath(filename)))
+
+    if vectorized:
+        f = foamUtils.openFileWrite(filename, mode='wb' if binary else 'w')
+        writeObjectsToFileVectorized(f, writePorous=writePorous, writeNonPorous=writeNonPorous, binary=binary)
+    else:
+        f = foamUtils.openFileWrite(filename)
+        writeObjectsToFile(f, writePorous=writePorous, writeNonPorous=writeNonPorous)
     f.close()
 
     print('asciiSTLExport Completed.')
@@ -0,0 +1,200 @@
+###########################################################
+# Blender Addon for Procedural Cloud-based Design Tools
+# Copyright (C) 2021, Procedural
+# License : procedural.build license
+# Version : 1.2
+# Web     : www.procedural.build
+###########################################################
+
+"""
+Live parsing of OpenFOAM solver output (Time =, residuals, continuity errors
+and execution times) into arrays for plotting, with convergence and
+divergence detection so a local run can (optionally) be stopped early.
+
+    log = FoamLog()
+    run = runSolver("simpleFoam", caseDir, log)
+    log.arrays()['residuals']['Ux']
+"""
+
+import os
+import re
+import math
+import time
+import threading
+import numpy as np
+
+from procedural_compute.core.utils.subprocesses import StreamingProcess
+
+TIME = re.compile(r"^Time = (\S+)")
+RESIDUAL = re.compile(r"Solving for (\w+), Initial residual = (\S+), Final residual = (\S+), No Iterations (\d+)")
+CONTINUITY = re.compile(r"time step continuity errors : sum local = (\S+), global = (\S+), cumulative = (\S+)")
+EXECUTION = re.compile(r"^ExecutionTime = (\S+) s\s+ClockTime = (\S+) s")
+CONVERGED = re.compile(r"solution converged in|reached convergence criteria", re.IGNORECASE)
+FATAL = re.compile(r"FOAM FATAL|Floating point exception|sigFpe", re.IGNORECASE)
+
+
+class FoamLog():
+    """ Parser of a solver's output, called with each line (see StreamingProcess).
+
+    The run has converged once the initial residual of every field has been
+    below tolerance for patience consecutive steps (or the solver reports its
+    residualControl has been met).  It has diverged if a residual is not
+    finite or above divergence, or the solver fails.  on_status(log) is
+    called once when either happens.
+    """
+
+    def __init__(self, tolerance=1e-4, divergence=10.0, patience=5, on_status=None):
+        self.tolerance = tolerance
+        self.divergence = divergence
+        self.patience = patience
+        self.on_status = on_status
+        self.status = 'running'
+        self.message = ""
+        self.steps = []
+        self.fields = []
+        self._below = 0
+        self._wall = None
+        self._lock = threading.Lock()
+
+    def __call__(self, stream, line):
+        self.parse(line)
+
+    def parse(self, line):
+        line = line.strip()
+        m = TIME.match(line)
+        if m:
+            self._newStep(float(m.group(1)))
+            return None
+        if not self.steps:
+            if FATAL.search(line):
+                self._setStatus('diverged', line)
+            return None
+        step = self.steps[-1]
+
+        m = RESIDUAL.search(line)
+        if m:
+            field = m.group(1)
+            initial = float(m.group(2))
+            with self._lock:
+                # Keep the first solution of each field in the step (eg. before the pressure correctors)
+                if field not in step['residuals']:
+                    step['residuals'][field] = initial
+                    if field not in self.fields:
+                        self.fields.append(field)
+            if not math.isfinite(initial) or initial > self.divergence:
+                self._setStatus('diverged', f"{field} initial residual {initial:g} at time {step['time']:g}")
+            return None
+
+        m = CONTINUITY.search(line)
+        if m:
+            step['continuity'] = tuple(float(v) for v in m.groups())
+            return None
+
+        m = EXECUTION.match(line)
+        if m:
+            step['execution'] = (float(m.group(1)), float(m.group(2)))
+            self._checkConverged(step)
+            return None
+
+        if CONVERGED.search(line):
+            self._setStatus('converged', line)
+        elif FATAL.search(line):
+            self._setStatus('diverged', line)
+        return None
+
+    def _newStep(self, t):
+        now = time.monotonic()
+        with self._lock:
+            if self.steps and self._wall is not None:
+                self.steps[-1]['wall'] = now - self._wall
+            self.steps.append({'time': t, 'residuals': {}, 'continuity': (np.nan,)*3, 'execution': (np.nan,)*2, 'wall': np.nan})
+        self._wall = now
+        return None
+
+    def _checkConverged(self, step):
+        residuals = step['residuals']
+        if residuals and max(residuals.values()) < self.tolerance:
+            self._below += 1
+        else:
+            self._below = 0
+        if self._below >= self.patience:
+            self._setStatus('converged', f"initial residuals below {self.tolerance:g} for {self._below} steps at time {step['time']:g}")
+        return None
+
+    def _setStatus(self, status, message):
+        if self.status != 'running':
+            return None
+        self.status = status
+        self.message = message
+        print(f"Solver {status}: {message}")
+        if self.on_status:
+            self.on_status(self)
+        return None
+
+    def arrays(self):
+        """ The parsed steps as arrays (NaN where a value was not reported):
+            time, stepWallTime, executionTime, clockTime  (n,)
+            residuals                                      {field: (n,) initial residuals}
+            continuity                                     (n, 3) sum local, global, cumulative
+        """
+        with self._lock:
+            steps = list(self.steps)
+            fields = list(self.fields)
+        execution = np.array([s['execution'] for s in steps], dtype=float).reshape(-1, 2)
+        return {
+            'time': np.array([s['time'] for s in steps], dtype=float),
+            'stepWallTime': np.array([s['wall'] for s in steps], dtype=float),
+            'executionTime': execution[:, 0],
+            'clockTime': execution[:, 1],
+            'residuals': {f: np.array([s['residuals'].get(f, np.nan) for s in steps], dtype=float) for f in fields},
+            'continuity': np.array([s['continuity'] for s in steps], dtype=float).reshape(-1, 3),
+        }
+
+
+def stopAtWriteNow(caseDir):
+    """ Ask a running solver (runTimeModifiable) to write the current time and
+    stop.  Returns the original controlDict text, or None if it has no stopAt.
+    """
+    filename = os.path.join(caseDir, "system", "controlDict")
+    with open(filename) as f:
+        text = f.read()
+    (newText, n) = re.subn(r"^(\s*stopAt\s+)\w+;", r"\1writeNow;", text, flags=re.MULTILINE)
+    if not n:
+        return None
+    with open(filename, 'w') as f:
+        f.write(newText)
+    return text
+
+
+def runSolver(cmd, caseDir, log=None, logfile="log.txt", mode='a', stopEarly=False, name="cfdRun"):
+    """ Run the solver command in caseDir, streaming its output through log.
+    By default the run goes to its endTime.  With stopEarly a run that
+    converges (by the log's tolerance and patience) is told to write and stop
+    (the controlDict is restored afterwards) and a diverged run is
+    terminated.  Returns the StreamingProcess.
+    """
+    log = log or FoamLog()
+    run = StreamingProcess(cmd, caseDir, name, logfile, mode, log)
+    controlDict = []
+
+    def on_status(log):
+        if not stopEarly:
+            return None
+        if log.status == 'converged':
+            original = stopAtWriteNow(caseDir)
+            if original is not None:
+                controlDict.append(original)
+        elif log.status == 'diverged':
+            run.stop()
+        return None
+
+    log.on_status = on_status
+    run.start()
+    try:
+        returncode = run.wait()
+    finally:
+        if controlDict:
+            with open(os.path.join(caseDir, "system", "controlDict"), 'w') as f:
+                f.write(controlDict[0])
+    print("Solver %s (%i) after %i steps in %.1fs"%(log.status, returncode, len(log.steps), run.elapsed))
+    return run
@@ -0,0 +1,340 @@
+###########################################################
+# Blender Addon for Procedural Cloud-based Design Tools
+# Copyright (C) 2021, Procedural
+# License : procedural.build license
+# Version : 1.2
+# Web     : www.procedural.build
+###########################################################
+
+"""
+Local executor for OpenFOAM pipelines.  Each Step declares its inputs and
+outputs (relative to the case directory), the steps it runs after and the
+number of cores it uses.  Steps whose dependencies have finished run
+concurrently on the cfdSteps pool (within the core budget), and like make a
+step is skipped when its stamp (.pipeline/<pipeline>/<step>) is newer than
+its inputs and the stamps of the steps it runs after.
+
+Pipelines can be built from the same command lists that are sent to the
+server pipeline (see Pipeline.fromCommands), eg.
+
+    Pipeline.fromCommands("mesh", ["blockMesh", "snappyHexMesh -overwrite"], cores=4).run(caseDir)
+"""
+
+import os
+import glob
+import time
+from concurrent.futures import wait, FIRST_COMPLETED
+
+from procedural_compute.core.utils import threads
+from procedural_compute.core.utils.subprocesses import streamSTDOUT
+from procedural_compute.cfd.utils.foamLog import FoamLog, runSolver
+
+STAMP_DIR = ".pipeline"
+
+# What the known OpenFOAM utilities read and write, which steps they follow
+# and whether they run in parallel.  Steps follow the listed steps that are in
+# the pipeline (or the previous command if none are), or nothing if after is ().
+# clobbers are the steps whose outputs are overwritten (so must be re-run first)
+# and decomposed steps are left out of pipelines that do not run in parallel.
+STEPS = {
+    'blockMesh': {
+        'inputs': ('system/blockMeshDict',),
+        'outputs': ('constant/polyMesh/boundary',),
+        'after': (),
+        'logfile': 'logBM.txt',
+    },
+    'surfaceFeatureExtract': {
+        'inputs': ('system/surfaceFeatureExtractDict', 'constant/triSurface'),
+        'after': (),
+        'logfile': 'logSFE.txt',
+    },
+    'decomposePar': {
+        # The processor directories are removed once reconstructed, so are not an
+        # output, and the mesh it reads is that of blockMesh (constant/polyMesh is
+        # rewritten by reconstructParMesh, so would always look newer)
+        'inputs': ('system/decomposeParDict', '0'),
+        'after': ('blockMesh',),
+        'logfile': 'logPar.txt',
+        'mode': 'a',
+    },
+    'snappyHexMesh': {
+        'inputs': ('system/snappyHexMeshDict', 'constant/triSurface'),
+        'after': ('blockMesh', 'surfaceFeatureExtract', 'decomposePar'),
+        'clobbers': ('blockMesh', 'decomposePar'),
+        'parallel': True,
+        'logfile': 'logSHM.txt',
+    },
+    'reconstructParMesh': {
+        'after': ('snappyHexMesh',),
+        'decomposed': True,
+        'logfile': 'logPar.txt',
+        'mode': 'a',
+    },
+    'reconstructPar': {
+        'decomposed': True,
+        'logfile': 'logPar.txt',
+        'mode': 'a',
+    },
+    'checkMesh': {
+        'after': ('snappyHexMesh', 'reconstructParMesh'),
+        'logfile': 'logCM.txt',
+    },
+    'foamToSurface': {
+        'after': ('snappyHexMesh', 'reconstructParMesh'),
+        'logfile': 'logFTS.txt',
+    },
+    'setSet': {
+        'after': ('snappyHexMesh', 'reconstructParMesh', 'checkMesh'),
+        'logfile': 'logPMesh.txt',
+    },
+}
+
+# Inputs of the solvers
+SOLVER_INPUTS = ('0', 'constant', 'system/controlDict', 'system/fvSchemes', 'system/fvSolution')
+
+
+def newestTime(caseDir, paths):
+    """ The latest modification time of the paths (searched recursively), or 0 if none exist
+    """
+    newest = 0.0
+    for path in paths:
+        for p in glob.glob(os.path.join(caseDir, path)):
+            newest = max(newest, os.path.getmtime(p))
+            for (root, dirs, files) in os.walk(p):
+                for name in files:
+                    newest = max(newest, os.path.getmtime(os.path.join(root, name)))
+    return newest
+
+
+class Step():
+    """ A command (or function(caseDir)) of a pipeline
+    """
+
+    def __init__(self, name, cmd, inputs=(), outputs=(), after=(), cores=1, logfile=None, mode='w',
+                 clobbers=(), allowFail=False, solver=False, convergence=None):
+        self.name = name
+        self.cmd = cmd
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.after = tuple(after)
+        self.cores = cores
+        self.logfile = logfile or "log%s.txt"%(name)
+        self.mode = mode
+        self.clobbers = tuple(clobbers)
+        self.allowFail = allowFail
+        self.solver = solver
+        # FoamLog arguments (eg. tolerance, patience) to stop the solver once converged
+        self.convergence = convergence
+        self.pipeline = ""
+
+    def stamp(self, caseDir):
+        return os.path.join(caseDir, STAMP_DIR, self.pipeline, self.name)
+
+    def stampTime(self, caseDir):
+        stamp = self.stamp(caseDir)
+        return os.path.getmtime(stamp) if os.path.exists(stamp) else None
+
+    def upToDate(self, caseDir, after=()):
+        """ True if the step has run since its inputs (and the stamps of the steps after) changed
+        """
+        stamp = self.stampTime(caseDir)
+        if stamp is None:
+            return False
+        if any(not glob.glob(os.path.join(caseDir, o)) for o in self.outputs):
+            return False
+        newest = max([newestTime(caseDir, self.inputs)] + [s.stampTime(caseDir) or 0.0 for s in after])
+        return newest <= stamp
+
+    def run(self, caseDir):
+        print("Running step %s: %s"%(self.name, self.cmd))
+        if callable(self.cmd):
+            self.cmd(caseDir)
+        elif self.solver:
+            run = runSolver(self.cmd, caseDir, FoamLog(**(self.convergence or {})), logfile=self.logfile,
+                            mode=self.mode, stopEarly=self.convergence is not None)
+            self._check(run)
+        else:
+            run = streamSTDOUT(self.cmd, caseDir, name="cfdRun", logfile=self.logfile, mode=self.mode)
+            self._check(run)
+        os.makedirs(os.path.dirname(self.stamp(caseDir)), exist_ok=True)
+        with open(self.stamp(caseDir), 'w') as f:
+            f.write("%s\n"%(time.ctime()))
+        return self.name
+
+    def _check(self, run):
+        if run.returncode != 0 and not self.allowFail:
+            raise RuntimeError("Step %s failed (%s). See %s"%(self.name, run.returncode, self.logfile))
+        return None
+
+
+class Pipeline():
+
+    def __init__(self, name, steps=()):
+        self.name = name
+        self.steps = {}
+        for step in steps:
+            self.add(step)
+
+    def add(self, step):
+        if step.name in self.steps:
+            raise ValueError("Duplicate pipeline step %s"%(step.name))
+        step.pipeline = self.name
+        self.steps[step.name] = step
+        return step
+
+    @classmethod
+    def fromCommands(cls, name, commands, cores=1, mpiCall=None, convergence=None):
+        """ A pipeline of the server-style command list: known utilities follow
+        the steps they depend on, other commands follow the previous command.
+        A leading ! marks a command whose failure does not stop the pipeline.
+        Parallel commands (snappyHexMesh and the solvers) are run with mpiCall
+        (default mpirun -np cores) and decomposePar (always with -force) is
+        added before them if the list does not have it.  Without parallel
+        commands the reconstruct utilities are left out.  The solvers run to
+        their endTime unless convergence gives the FoamLog tolerance and
+        patience to stop them at.
+        """
+        mpiCall = mpiCall or "mpirun -np %i"%(cores)
+        pipeline = cls(name)
+        previous = None
+        decomposed = any(c.lstrip('!').split()[0] == 'decomposePar' for c in commands)
+        for command in commands:
+            allowFail = command.startswith('!')
+            command = command.lstrip('!')
+            utility = command.split()[0]
+            spec = STEPS.get(utility)
+            solver = spec is None and utility.endswith('Foam')
+            parallel = cores > 1 and (solver or (spec or {}).get('parallel', False))
+            if (spec or {}).get('decomposed') and not decomposed:
+                print("Skipping %s: the case is not decomposed"%(command))
+                continue
+            if parallel and not decomposed:
+                pipeline.add(Step('decomposePar', 'decomposePar -force', after=pipeline._after('decomposePar', previous),
+                                  **pipeline._decomposeArgs()))
+                previous = 'decomposePar'
+                decomposed = True
+
+            # Commands such as setSet can appear more than once
+            key = utility
+            n = 1
+            while key in pipeline.steps:
+                n += 1
+                key = "%s%i"%(utility, n)
+
+            after = pipeline._after(utility, previous)
+            if utility == 'decomposePar':
+                kwargs = pipeline._decomposeArgs()
+            elif spec is not None:
+                kwargs = cls._specArgs(utility)
+            else:
+                kwargs = {'inputs': SOLVER_INPUTS if solver else (), 'logfile': 'log.txt' if solver else None, 'mode': 'a' if solver else 'w'}
+            # Re-runs would otherwise fail on the processor directories of the last run
+            if utility == 'decomposePar' and '-force' not in command.split():
+                command += " -force"
+            cmd = "%s %s -parallel"%(mpiCall, command) if parallel else command
+            pipeline.add(Step(key, cmd, after=after, cores=cores if parallel else 1, allowFail=allowFail,
+                              solver=solver, convergence=convergence if solver else None, **kwargs))
+            previous = key
+        return pipeline
+
+    def _after(self, name, previous):
+        spec = STEPS.get(name, {})
+        if 'after' in spec:
+            after = [a for a in spec['after'] if a in self.steps]
+            if after or not spec['after']:
+                return after
+        return [previous] if previous else []
+
+    def _decomposeArgs(self):
+        # Without blockMesh in the pipeline (eg. a solver run) the mesh is an input
+        kwargs = self._specArgs('decomposePar')
+        if 'blockMesh' not in self.steps:
+            kwargs['inputs'] = kwargs['inputs'] + ('constant/polyMesh',)
+        return kwargs
+
+    @staticmethod
+    def _specArgs(name):
+        spec = STEPS[name]
+        return {k: spec[k] for k in ('inputs', 'outputs', 'logfile', 'mode', 'clobbers') if k in spec}
+
+    def order(self):
+        """ The steps in dependency order
+        """
+        (ordered, seen) = ([], set())
+
+        def visit(name, path=()):
+            if name in seen:
+                return None
+            if name in path:
+                raise ValueError("Pipeline has a cycle through %s"%(name))
+            for a in self.steps[name].after:
+                visit(a, path + (name,))
+            seen.add(name)
+            ordered.append(self.steps[name])
+
+        for name in self.steps:
+            visit(name)
+        return ordered
+
+    def plan(self, caseDir, force=False):
+        """ The names of the steps that need to run (like make)
+        """
+        ordered = self.order()
+        dirty = set(self.steps) if force else set()
+        while True:
+            before = set(dirty)
+            for step in ordered:
+                after = [self.steps[a] for a in step.after]
+                if step.name in dirty or any(a.name in dirty for a in after) or not step.upToDate(caseDir, after):
+                    dirty.add(step.name)
+            # Steps that overwrite the outputs of others need those re-run first
+            for step in ordered:
+                if step.name in dirty:
+                    dirty.update(c for c in step.clobbers if c in self.steps)
+            if dirty == before:
+                return dirty
+
+    def runInline(self, caseDir, force=False):
+        """ Run the out of date steps one after another in the calling thread
+        (eg. from a job that has already taken the cores of the steps).
+        Returns the names of the steps that ran.
+        """
+        todo = self.plan(caseDir, force)
+        ran = []
+        for step in self.order():
+            if step.name not in todo:
+                print("Skipping up to date step %s"%(step.name))
+                continue
+            step.run(caseDir)
+            ran.append(step.name)
+        return ran
+
+    def run(self, caseDir, force=False, pool="cfdSteps"):
+        """ Run the out of date steps, each as soon as the steps it follows have
+        finished.  Stops (cancelling the queued steps) at the first failure.
+        Returns the names of the steps that ran.
+        """
+        todo = self.plan(caseDir, force)
+        for step in self.order():
+            if step.name not in todo:
+                print("Skipping up to date step %s"%(step.name))
+        (running, finished) = ({}, set(self.steps) - todo)
+        ran = []
+        while todo or running:
+            for name in [n for n in todo if all(a in finished for a in self.steps[n].after)]:
+                step = self.steps[name]
+                running[threads.submit(pool, step.run, caseDir, cores=step.cores, name=name)] = name
+                todo.discard(name)
+            if not running:
+                raise RuntimeError("Pipeline %s cannot run steps %s"%(self.name, ", ".join(sorted(todo))))
+            (done, _pending) = wait(list(running), return_when=FIRST_COMPLETED)
+            for job in done:
+                name = running.pop(job)
+                if job.exception() is not None:
+                    for other in running:
+                        other.cancel()
+                    wait(list(running))
+                    raise job.exception()
+                finished.add(name)
+                ran.append(name)
+        return ran
@@ -0,0 +1,369 @@
+###########################################################
+# Blender Addon for Procedural Cloud-based Design Tools
+# Copyright (C) 2021, Procedural
+# License : procedural.build license
+# Version : 1.2
+# Web     : www.procedural.build
+###########################################################
+
+"""
+Local virtual wind tunnel: the meshed case is run for each wind angle in
+VWT/<angle> (the layout of the remote wind tunnel task).
+
+Each angle is a clone of the case in which the mesh (constant) is hard
+linked and only system and 0 are copied, so the clones cost no more disk
+than their results.  The wind is turned by the angle about +z (anticlockwise
+seen from above): the uniform velocities of 0/U (inlet values and the
+initial field) are rotated, and the sides of the domain (MinX, MaxX, MinY,
+MaxY) are given the boundary conditions of their role for that wind.  Sides
+facing the wind take those of the inlet of the case, sides facing away those
+of the side opposite the inlet (the outlet) and sides along the wind those
+of a side of the case, in every field and in the patch types of
+polyMesh/boundary (which is then copied rather than linked).  So the wind
+always enters through an inlet, at any angle.
+
+The angles run concurrently on the vwt pool, as many at once as the core
+budget allows, and each angle after the first few starts from the fields of
+the nearest converged angle (rotated into its direction) and runs the
+shorter follow-on number of iterations.  Angles that already have a case in
+VWT are kept (and skipped) unless the tunnel is run with overwrite.
+"""
+
+import os
+import re
+import glob
+import shutil
+from concurrent.futures import wait, FIRST_COMPLETED
+
+import numpy as np
+
+from procedural_compute.core.utils import threads
+from procedural_compute.cfd.utils.pipeline import Pipeline
+
+VWT_DIR = "VWT"
+LINKED = ('constant',)
+COPIED = ('system', '0')
+
+# Outward normals of the sides of the domain (the cfdBoundingBox patches)
+SIDES = {'MinX': (-1.0, 0.0, 0.0), 'MaxX': (1.0, 0.0, 0.0), 'MinY': (0.0, -1.0, 0.0), 'MaxY': (0.0, 1.0, 0.0)}
+
+VECTOR = r"\(\s*([-+0-9.eE]+)\s+([-+0-9.eE]+)\s+([-+0-9.eE]+)\s*\)"
+INTERNAL_FIELD = re.compile(r"internalField\s+(uniform\s+[^;]+|nonuniform\s+List<(\w+)>\s*(\d+)\s*\((.*?)\)\s*);", re.DOTALL)
+
+
+def angleName(angle):
+    return str(float(angle))
+
+
+def linkTree(source, target):
+    """ Hard link the files of source into target (copying where links are not possible)
+    """
+    for (root, dirs, files) in os.walk(source):
+        dest = os.path.join(target, os.path.relpath(root, source))
+        os.makedirs(dest, exist_ok=True)
+        for name in files:
+            try:
+                os.link(os.path.join(root, name), os.path.join(dest, name))
+            except OSError:
+                shutil.copy2(os.path.join(root, name), os.path.join(dest, name))
+    return None
+
+
+def cloneCase(caseDir, target, overwrite=False):
+    """ A fresh clone of the case in target, sharing the mesh with the case.
+    An existing target (eg. the results of an earlier run) is only replaced
+    with overwrite.
+    """
+    if os.path.exists(target):
+        if not overwrite:
+            raise FileExistsError("%s already exists"%(target))
+        shutil.rmtree(target)
+    os.makedirs(target)
+    for d in LINKED:
+        if os.path.isdir(os.path.join(caseDir, d)):
+            linkTree(os.path.join(caseDir, d), os.path.join(target, d))
+    # These are rewritten for each angle (and controlDict while running), so are never shared
+    for d in COPIED:
+        shutil.copytree(os.path.join(caseDir, d), os.path.join(target, d))
+    return target
+
+
+def rotationMatrix(angle):
+    a = np.radians(angle)
+    return np.array([[np.cos(a), -np.sin(a), 0.0], [np.sin(a), np.cos(a), 0.0], [0.0, 0.0, 1.0]])
+
+
+def rotateUniformVectors(text, angle):
+    """ Rotate every uniform vector (eg. U inlet and initial values) of a field file
+    """
+    R = rotationMatrix(angle)
+
+    def rotate(m):
+        v = R @ np.array([float(c) for c in m.groups()])
+        return "uniform (%g %g %g)"%tuple(np.where(np.abs(v) < 1e-12, 0.0, v))
+
+    return re.sub(r"uniform\s+" + VECTOR, rotate, text)
+
+
+def sideEntries(text):
+    """ {side: (start, end)} of the dictionaries of the sides of the domain in a
+    field (boundaryField) or polyMesh/boundary file
+    """
+    entries = {}
+    for m in re.finditer(r"(?<![\w.])(%s)\s*\{"%("|".join(SIDES)), text):
+        if m.group(1) in entries:
+            continue
+        depth = 0
+        for i in range(m.end() - 1, len(text)):
+            if text[i] == '{':
+                depth += 1
+            elif text[i] == '}':
+                depth -= 1
+                if depth == 0:
+                    entries[m.group(1)] = (m.end() - 1, i + 1)
+                    break
+    return entries
+
+
+def inletSide(U):
+    """ The side the wind of the field file U enters through (the side with a
+    uniform velocity into the domain) and the direction of that wind, or (None, None)
+    """
+    for (side, (start, end)) in sideEntries(U).items():
+        for m in re.finditer(r"uniform\s+" + VECTOR, U[start:end]):
+            v = np.array([float(c) for c in m.groups()])
+            if np.dot(v, SIDES[side]) < 0.0:
+                return (side, v / np.linalg.norm(v))
+    return (None, None)
+
+
+def sideSources(inlet, direction, angle):
+    """ {side: the side of the case whose boundary conditions it takes} for the
+    wind direction turned by angle.  Sides facing the wind take those of the
+    inlet, sides facing away those of the outlet (opposite the inlet) and sides
+    along the wind keep their own (or take those of a side along the wind of the case).
+    """
+    outlet = min(SIDES, key=lambda s: np.dot(SIDES[s], SIDES[inlet]))
+    along = [s for s in SIDES if s not in (inlet, outlet)]
+    d = rotationMatrix(angle) @ direction
+    sources = {}
+    for (side, normal) in SIDES.items():
+        c = np.dot(d, normal)
+        if c < -1e-6:
+            sources[side] = inlet
+        elif c > 1e-6:
+            sources[side] = outlet
+        else:
+            sources[side] = side if side in along else along[0]
+    return sources
+
+
+def remapSides(text, sources, entry=lambda source, target: source):
+    """ Replace the dictionary of each side of text by entry(dictionary of its
+    source, its own dictionary).  Sides missing from text are left as they are.
+    """
+    entries = sideEntries(text)
+    spans = sorted((entries[side], entries[source]) for (side, source) in sources.items()
+                   if side in entries and source in entries)
+    (parts, previous) = ([], 0)
+    for ((start, end), (sourceStart, sourceEnd)) in spans:
+        parts += [text[previous:start], entry(text[sourceStart:sourceEnd], text[start:end])]
+        previous = end
+    return "".join(parts) + text[previous:]
+
+
+def boundaryEntry(source, target):
+    """ The polyMesh/boundary dictionary target with the patch type (and groups) of source
+    """
+    faces = dict(re.findall(r"^\s*(nFaces|startFace)\s+(\d+)\s*;", target, flags=re.MULTILINE))
+    return re.sub(r"^(\s*(nFaces|startFace)\s+)\d+", lambda m: m.group(1) + faces[m.group(2)], source,
+                  flags=re.MULTILINE)
+
+
+def rewrite(filename, edit):
+    """ Rewrite filename with edit(text), unlinking it first so that a file hard
+    linked with the case is replaced rather than changed in place.  Returns
+    whether the file changed.
+    """
+    with open(filename) as f:
+        text = f.read()
+    edited = edit(text)
+    if edited == text:
+        return False
+    os.unlink(filename)
+    with open(filename, 'w') as f:
+        f.write(edited)
+    return True
+
+
+def setControl(text, key, value):
+    """ Set a keyword of controlDict (adding it if missing)
+    """
+    (text, n) = re.subn(r"^(\s*%s\s+)[^;]*;"%(key), r"\g<1>%s;"%(value), text, flags=re.MULTILINE)
+    return text if n else text + "\n%s %s;\n"%(key, value)
+
+
+def latestTime(caseDir):
+    """ The latest (non-zero) time directory of the case, or None
+    """
+    times = []
+    for d in os.listdir(caseDir):
+        try:
+            t = float(d)
+        except ValueError:
+            continue
+        if t > 0 and os.path.isdir(os.path.join(caseDir, d)):
+            times.append((t, d))
+    return os.path.join(caseDir, max(times)[1]) if times else None
+
+
+def warmStart(source, target, angle):
+    """ Replace the initial (internal) fields of target/0 with those of the
+    latest time of source, rotating vectors by angle.  The boundary
+    conditions of target are kept.  Returns the fields that were replaced.
+    """
+    latest = latestTime(source)
+    if latest is None:
+        return []
+    R = rotationMatrix(angle)
+    replaced = []
+    for filename in glob.glob(os.path.join(target, "0", "*")):
+        field = os.path.basename(filename)
+        if not os.path.isfile(filename) or not os.path.isfile(os.path.join(latest, field)):
+            continue
+        with open(os.path.join(latest, field)) as f:
+            m = INTERNAL_FIELD.search(f.read())
+        # Binary or compact fields are left to start cold
+        if m is None:
+            continue
+        internal = m.group(0)
+        if m.group(2) == 'vector':
+            values = np.array(re.findall(VECTOR, m.group(4)), dtype=float).reshape(-1, 3)
+            if len(values) != int(m.group(3)):
+                continue
+            values = values @ R.T
+            rows = "\n".join("(%g %g %g)"%tuple(v) for v in values)
+            internal = "internalField   nonuniform List<vector> \n%i\n(\n%s\n)\n;"%(len(values), rows)
+        elif m.group(1).startswith('uniform') and field == 'U':
+            internal = rotateUniformVectors(internal, angle)
+        with open(filename) as f:
+            text = f.read()
+        (text, n) = INTERNAL_FIELD.subn(lambda _m: internal, text, count=1)
+        if n:
+            with open(filename, 'w') as f:
+                f.write(text)
+            replaced.append(field)
+    return replaced
+
+
+def circularDistance(a, b):
+    d = abs(a - b) % 360.0
+    return min(d, 360.0 - d)
+
+
+class WindTunnel():
+    """ Run the solver for each angle in caseDir/VWT/<angle>, each with cores.
+    iterations = {'init': cold start iterations, 'run': warm start iterations}
+    convergence = FoamLog tolerance and patience to stop each angle at (see Pipeline.fromCommands)
+    overwrite   = replace the existing angle cases (otherwise they are kept and skipped)
+    """
+
+    def __init__(self, caseDir, angles, solver, cores=1, iterations=None, pool="vwt", convergence=None,
+                 overwrite=False):
+        self.caseDir = caseDir
+        self.angles = [float(a) for a in angles]
+        self.solver = solver
+        self.cores = max(1, cores)
+        self.iterations = iterations or {}
+        self.pool = pool
+        self.convergence = convergence
+        self.overwrite = overwrite
+
+    def angleDir(self, angle):
+        return os.path.join(self.caseDir, VWT_DIR, angleName(angle))
+
+    def nextAngle(self, pending, finished, started):
+        """ The next angle to run and the finished angle to start it from.  Angles
+        next to converged ones come first; otherwise the angle furthest from
+        the started ones is run cold.
+        """
+        if finished:
+            (distance, angle, source) = min((circularDistance(a, f), a, f) for a in pending for f in finished)
+            # A warm start from the other side of the tunnel is no better than a cold one
+            if distance < 90.0:
+                return (angle, source)
+        if not started:
+            return (pending[0], None)
+        angle = max(pending, key=lambda a: min(circularDistance(a, s) for s in started))
+        return (angle, None)
+
+    def run(self):
+        """ Run all the angles.  Returns ({angle: directory}, {angle: exception})
+        """
+        pending = list(self.angles)
+        (finished, failed, running, started) = ({}, {}, {}, [])
+        slots = max(1, threads.budget.total // self.cores)
+        print("Running %i wind tunnel angles, %i at a time on %i cores each"%(len(pending), slots, self.cores))
+        while pending or running:
+            while pending and len(running) < slots:
+                (angle, source) = self.nextAngle(pending, finished, started)
+                pending.remove(angle)
+                started.append(angle)
+                job = threads.submit(self.pool, self.runAngle, angle, source, cores=self.cores, name="VWT %s"%(angleName(angle)))
+                running[job] = angle
+            (done, _pending) = wait(list(running), return_when=FIRST_COMPLETED)
+            for job in done:
+                angle = running.pop(job)
+                if job.exception() is not None:
+                    print("Wind tunnel angle %s failed: %s"%(angleName(angle), job.exception()))
+                    failed[angle] = job.exception()
+                else:
+                    finished[angle] = job.result()
+        print("Wind tunnel finished %i angles (%i failed)"%(len(finished), len(failed)))
+        return (finished, failed)
+
+    def runAngle(self, angle, source=None):
+        if os.path.exists(self.angleDir(angle)) and not self.overwrite:
+            print("Keeping the existing wind tunnel angle %s (run with overwrite to replace it)"%(angleName(angle)))
+            return self.angleDir(angle)
+        target = cloneCase(self.caseDir, self.angleDir(angle), self.overwrite)
+
+        U = os.path.join(target, "0", "U")
+        if os.path.isfile(U):
+            # Give the sides facing the wind the inlet conditions (and patch types)
+            with open(U) as f:
+                (inlet, direction) = inletSide(f.read())
+            if inlet is None:
+                print("No uniform inlet velocity on the sides of the domain: only the velocities of angle %s are rotated"%(angleName(angle)))
+            else:
+                sources = sideSources(inlet, direction, angle)
+                for filename in glob.glob(os.path.join(target, "0", "*")):
+                    if os.path.isfile(filename):
+                        rewrite(filename, lambda text: remapSides(text, sources))
+                boundary = os.path.join(target, "constant", "polyMesh", "boundary")
+                if os.path.isfile(boundary):
+                    rewrite(boundary, lambda text: remapSides(text, sources, boundaryEntry))
+            # Rotate the inlet (and initial) velocities into the wind direction
+            rewrite(U, lambda text: rotateUniformVectors(text, angle))
+
+        iterations = self.iterations.get('init')
+        if source is not None:
+            fields = warmStart(self.angleDir(source), target, angle - source)
+            if fields:
+                print("Angle %s starts from angle %s (%s)"%(angleName(angle), angleName(source), ", ".join(fields)))
+                iterations = self.iterations.get('run') or iterations
+        if iterations:
+            controlDict = os.path.join(target, "system", "controlDict")
+            with open(controlDict) as f:
+                text = f.read()
+            text = setControl(text, "startFrom", "startTime")
+            text = setControl(text, "startTime", "0")
+            text = setControl(text, "endTime", "%g"%(iterations))
+            with open(controlDict, 'w') as f:
+                f.write(text)
+
+        # The cores of this job are already taken, so the steps run inline
+        pipeline = Pipeline.fromCommands("run", [self.solver, "reconstructPar -latestTime"], cores=self.cores,
+                                         convergence=self.convergence)
+        pipeline.runInline(target)
+        return target
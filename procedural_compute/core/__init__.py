@@ -16,6 +16,7 @@ import bpy
 import procedural_compute.core.properties as properties
 import procedural_compute.core.operators as operators
 import procedural_compute.core.menus as menus
+import procedural_compute.core.utils.triangles as triangles
 
 
 def menu_add_north(self, context):
@@ -34,6 +35,7 @@ def register():
     bpy.utils.register_class(menus.material.MATERIAL_PT_COMPUTE)
 
     bpy.utils.register_class(menus.popup.ConfirmDialogue)
+    triangles.register()
     return
 
 
@@ -45,4 +47,5 @@ def unregister():
     bpy.utils.unregister_class(menus.material.MATERIAL_PT_COMPUTE)
 
     bpy.utils.unregister_class(menus.popup.ConfirmDialogue)
+    triangles.unregister()
     return
@@ -1,26 +1,30 @@
 import asyncio
+import functools
 import time
+import traceback
 import bpy
 import random
 from procedural_compute.core.utils.addRemoveMeshObject import addCubeObject
-from procedural_compute.core.utils.threads import queues, get_or_create_queue, queue_fun
+from procedural_compute.core.utils import threads
 from procedural_compute.core.utils.compute.auth import get_current_user
 
 """
 Threading cannot call any blender code from threads other than the
 main thread.  So we can't use that to update the blender viewport dynamically.
 
-So instead we use asyncio to start a thread which makes the http request with
-urllib.  The http request thread will put the response into a cache dictionary
-and the asyncio task will wait until data is available in that object.  It will
-then perform the required function to render that data in the viewport.
+So instead we use asyncio to run the http request on a worker thread
+(loop.run_in_executor).  The asyncio task awaits the future of its request,
+which resolves as soon as the response arrives.  It will then perform the
+required function to render that data in the viewport.  The asyncio loop is
+pumped by the AsyncLoop modal timer in the main thread.
 
 Test queuing an asyncio task like this:
 from procedural_compute.core.operators import fetch_async
 fetch_async("http://blender.org")
 """
 
-RESPONSE_CACHE = {}
+# Worker pool that makes the (blocking) http requests
+executor = threads.get_pool('requests')
 
 timer = None
 
@@ -82,56 +86,100 @@ def handle_data(data):
 
     print("Done handling response data")
 
+def report_exception(task):
+    """ Done-callback of the scheduled tasks (which nobody awaits): print the
+    error of a failed task, which also marks it as retrieved
+    """
+    if task.cancelled():
+        return None
+    error = task.exception()
+    if error is not None:
+        print(f"Async fetch failed: {error!r}")
+        traceback.print_exception(type(error), error, error.__traceback__)
+    return None
+
 def fetch_async(*args, **kwargs):
-    asyncio.ensure_future(
+    """ Schedule fetch_data on the asyncio loop (pumped by the AsyncLoop timer).
+    Returns the asyncio task, which can be cancelled.
+    """
+    task = asyncio.ensure_future(
         fetch_data(*args, **kwargs)
     )
-    bpy.ops.asyncio.loop()
+    task.add_done_callback(report_exception)
+    bpy.ops.asyncio.loop(command='START')
+    return task
 
-def fetch_sync(*args, **kwargs):
-    # Simulate some time to fetch the data
+def fetch_all_async(*args, **kwargs):
+    """ Schedule fetch_all on the asyncio loop. Returns the asyncio task.
+    """
+    task = asyncio.ensure_future(
+        fetch_all(*args, **kwargs)
+    )
+    task.add_done_callback(report_exception)
+    bpy.ops.asyncio.loop(command='START')
+    return task
+
+def fetch_sync(*args, parse=None, **kwargs):
+    """ Make the request (blocking) and return the response data (passed
+    through parse if given)
+    """
     User = get_current_user()
     print("FETCHING DATA", args, kwargs)
     # Fetch the url as requested
     response = User.request(*args, **kwargs)
-    # Set the RESPONSE_CACHE
-    response_data = None
-    if isinstance(response, dict):
+    if isinstance(response, (dict, list)):
         response_data = response
     else:
         response_data = getattr(response, 'read_content', None)
-    #print("GOT RESPONSE FROM fetch_sync", response_data)
-    url = args[1]
-    RESPONSE_CACHE[url] = response_data
+    return parse(response_data) if parse else response_data
 
-async def fetch_data(url, method='GET', callback=None, timeout=20, clear_cache_after=False, **kwargs):
-    ''' Queue a task on another thread to get the data with urllib then
-    await until the data is available and call the callback to handle the
-    response data. The callback will render objects, meshes, etc) as required
-    to view the results.
+async def fetch_all(fetches, limit=4, **kwargs):
+    """ Run fetch_data for each of the (url, callback, parse) fetches with at most
+    limit requests in flight.  The timeout of each fetch starts when its request
+    is sent.  Returns the results (or exceptions) in the order of fetches.
+    """
+    semaphore = asyncio.Semaphore(limit)
+
+    async def _fetch(url, callback, parse):
+        async with semaphore:
+            return await fetch_data(url, callback=callback, parse=parse, **kwargs)
+
+    results = await asyncio.gather(*[_fetch(*i) for i in fetches], return_exceptions=True)
+    for ((url, callback, parse), result) in zip(fetches, results):
+        if isinstance(result, Exception):
+            print(f"Failed to fetch {url}: {result}")
+    return results
+
+async def fetch_data(url, method='GET', callback=None, timeout=20, parse=None, **kwargs):
+    ''' Run the request on a worker thread and call the callback to
+    handle the response data as soon as it arrives. The callback will render
+    objects, meshes, etc) as required to view the results.
 
     This will **not** block the UI while retreiving the data (which may be large
     files) - but it will block while the callback does whatever it does to
     handle the data.  So if the handler does some large operations such as making
     large/complex objects - then the UI will block during that step.
+
+    parse (if given) is called with the response data on the worker thread, so
+    heavy parsing does not block the UI.  Its result is passed to the callback.
+
+    Each call awaits its own future, so any number of fetches (including of the
+    same url) can run at once.  If the request does not complete within timeout
+    seconds it is abandoned and the callback is not called.
     '''
-    # Clear the cache that holds the response data
-    RESPONSE_CACHE[url] = None
-    # Queue up the thread that will get the data
-    queue_fun('requests', fetch_sync, args=(method, url), kwargs=kwargs)
-    # Now loop for timeout seconds waiting for data
-    response_data = None
-    for i in range(timeout):
-        print("Awaiting for response data from thread", i)
-        await asyncio.sleep(1)
-        response_data = RESPONSE_CACHE[url]
-        if response_data is not None:
-            break
+    loop = asyncio.get_event_loop()
+    future = loop.run_in_executor(
+        executor, functools.partial(fetch_sync, method, url, parse=parse, **kwargs)
+    )
+    try:
+        response_data = await asyncio.wait_for(future, timeout)
+    except asyncio.TimeoutError:
+        print(f"Timed out after {timeout}s waiting for response data from {url}")
+        return None
     # Call the callback that handles the response data
-    callback(response_data)
-    # Clear the cache after handling the response
-    if clear_cache_after:
-        del RESPONSE_CACHE[url]
+    if callback:
+        callback(response_data)
+    return response_data
 
 #task = asyncio.ensure_future(fetch_page("http://blender.org"))
 #asyncio.get_event_loop().run_until_complete(task)
@@ -1,3 +1,15 @@
+import random
+import numpy as np
+
+
+# Control points of the colormaps (interpolated to a LUT by colormap_lut)
+COLORMAPS = {
+    'greyscale': [(0.0, 0.0, 0.0), (1.0, 1.0, 1.0)],
+    'blue-red': [(0.0, 0.0, 1.0), (0.0, 1.0, 1.0), (0.0, 1.0, 0.0), (1.0, 1.0, 0.0), (1.0, 0.0, 0.0)],
+    'viridis': [(0.267, 0.005, 0.329), (0.231, 0.322, 0.545), (0.129, 0.569, 0.549), (0.369, 0.788, 0.384), (0.993, 0.906, 0.144)],
+}
+
+
 def _get_color_or_random(index, colors):
     if index < len(colors):
         return colors[index]
@@ -14,39 +26,106 @@ def _get_or_create_color_layer(mesh):
     return mesh.vertex_colors.get("Col") or mesh.vertex_colors.new()
 
 
+def _get_or_create_corner_color_attribute(mesh, name="Col"):
+    """ A face-corner color attribute (Blender 3.2+) or the (also per face-corner)
+    vertex color layer on older versions
+    """
+    if not hasattr(mesh, "color_attributes"):
+        return _get_or_create_color_layer(mesh)
+    attribute = mesh.color_attributes.get(name)
+    if attribute is not None and attribute.domain != 'CORNER':
+        mesh.color_attributes.remove(attribute)
+        attribute = None
+    if attribute is None:
+        attribute = mesh.color_attributes.new(name, 'BYTE_COLOR', 'CORNER')
+    mesh.color_attributes.active_color = attribute
+    return attribute
+
+
+def colormap_lut(colormap, n=256):
+    """ An (n, 3) array of RGB colors interpolated from the named colormap
+    (or from a list of RGB control points)
+    """
+    points = np.asarray(COLORMAPS[colormap] if isinstance(colormap, str) else colormap, dtype=np.float64)
+    x = np.linspace(0.0, 1.0, n)
+    xp = np.linspace(0.0, 1.0, len(points))
+    return np.column_stack([np.interp(x, xp, points[:, i]) for i in range(3)])
+
+
+def values_to_rgba(values, alpha=1.0, colormap=None):
+    """ Map values in [0, 1] to an (N, 4) RGBA array.  Greyscale (v, v, v)
+    unless a colormap is given.
+    """
+    values = np.clip(np.asarray(values, dtype=np.float64), 0.0, 1.0)
+    if colormap is None:
+        rgb = np.repeat(values[:, None], 3, axis=1)
+    else:
+        lut = colormap_lut(colormap)
+        rgb = lut[np.rint(values * (len(lut) - 1)).astype(np.int64)]
+    return np.column_stack([rgb, np.full(len(values), alpha)])
+
+
+def loop_face_indices(mesh):
+    """ The index of the polygon that each loop (face-corner) belongs to
+    """
+    n_faces = len(mesh.polygons)
+    starts = np.empty(n_faces, dtype=np.int64)
+    totals = np.empty(n_faces, dtype=np.int64)
+    mesh.polygons.foreach_get("loop_start", starts)
+    mesh.polygons.foreach_get("loop_total", totals)
+    # The loops of each polygon are a contiguous range starting at loop_start
+    order = np.argsort(starts)
+    return np.repeat(order, totals[order])
+
+
 def is_exploded(obj):
     mesh = obj.data
-    n_vertices_expected = sum([p.loop_total for p in mesh.polygons])
-    return n_vertices_expected == len(mesh.vertices)
+    return len(mesh.loops) == len(mesh.vertices)
 
 
 def explode_polygons_to_mesh(obj, force=False):
     """ Explode all of the polygons to separate polygons without any linking
-    vertices.  This is required for coloring the faces with vertex colors.
+    vertices.  This is not required for color_polygons (which colors the face
+    corners) but can still be used to separate the faces.
     """
     if (not force) and is_exploded(obj):
         print("Mesh is already exploded.  Not exploding faces.  Set kwarg force=True to bypass this.")
         return None
 
     print(f"Exploding faces on mesh for object: {obj.name}")
-    vertices = []
-    faces = []
-    # Construct a new set of vertices and faces
-    for poly in obj.data.polygons:
-        face_start_index = len(vertices)
-        # Add the vertices to the global list
-        for vi in poly.vertices:
-            vertices.append(obj.data.vertices[vi].co.to_tuple())
-        # The face is just a straight range of these vertices
-        faces.append([vi + face_start_index for vi in range(len(poly.vertices))])
-    # Remove the original mesh
-    obj.data.clear_geometry()
-    # Add in the new vertices and faces
-    obj.data.from_pydata(vertices, [], faces)
-
+    mesh = obj.data
+    n_faces = len(mesh.polygons)
+    n_loops = len(mesh.loops)
+
+    # Each loop gets its own copy of its vertex
+    co = np.empty(len(mesh.vertices) * 3, dtype=np.float32)
+    mesh.vertices.foreach_get("co", co)
+    vertex_index = np.empty(n_loops, dtype=np.int32)
+    mesh.loops.foreach_get("vertex_index", vertex_index)
+    starts = np.empty(n_faces, dtype=np.int32)
+    totals = np.empty(n_faces, dtype=np.int32)
+    mesh.polygons.foreach_get("loop_start", starts)
+    mesh.polygons.foreach_get("loop_total", totals)
+    co = co.reshape(-1, 3)[vertex_index]
 
-def color_polygons(obj, values = [], alpha=1.0, try_explode=True, force_explode=False):
-    """ Color the polygons of an object on a colorscale
+    # Remove the original mesh
+    mesh.clear_geometry()
+    # Add in the new vertices and faces (the face is just a straight range of these vertices)
+    mesh.vertices.add(n_loops)
+    mesh.vertices.foreach_set("co", co.ravel())
+    mesh.loops.add(n_loops)
+    mesh.loops.foreach_set("vertex_index", np.arange(n_loops, dtype=np.int32))
+    mesh.polygons.add(n_faces)
+    mesh.polygons.foreach_set("loop_start", starts)
+    mesh.polygons.foreach_set("loop_total", totals)
+    mesh.update(calc_edges=True)
+
+
+def color_polygons(obj, values = [], alpha=1.0, try_explode=False, force_explode=False, colormap=None):
+    """ Color the polygons of an object on a colorscale (one value in [0, 1] per face)
+    The colors are written to the face corners in one bulk foreach_set, so the
+    mesh does not need to be exploded.  colormap is the name of one of COLORMAPS
+    (or a list of RGB control points), otherwise greyscale.
     NOTE: Use a ColorRamp in the ShadingEditor (nodes) to generate a colormap
     """
     mesh = obj.data
@@ -56,27 +135,24 @@ def color_polygons(obj, values = [], alpha=1.0, try_explode=True, force_explode=
     if not len(values) == n_faces:
         raise ValueError("len(values) is not equal to number of faces")
 
-    # Ensure the object is exploded into separate polygons (no common vertices)
+    # Optionally explode the object into separate polygons (no common vertices)
     if try_explode:
         explode_polygons_to_mesh(obj, force=force_explode)
 
     # Create the color layer if it doesn't exist
-    color_layer = _get_or_create_color_layer(mesh)
-    # Color the polygons
-    for polygon in mesh.polygons:
-        # Get the color to use
-        #value = _get_value_or_random(polygon.index, values)
-        value = values[polygon.index]
-        # Set the color for the vertices from the face color
-        for vi in polygon.vertices:
-            color_layer.data[vi].color = (value, value, value, alpha)
+    color_layer = _get_or_create_corner_color_attribute(mesh)
+    # Color the face corners of the polygons
+    face_colors = values_to_rgba(values, alpha=alpha, colormap=colormap)
+    loop_colors = face_colors[loop_face_indices(mesh)].astype(np.float32)
+    color_layer.data.foreach_set("color", loop_colors.ravel())
+    mesh.update()
 
 
 def print_poly_colors(obj):
-    color_layer = obj.data.vertex_colors["Col"]
+    color_layer = _get_or_create_corner_color_attribute(obj.data)
     for poly in obj.data.polygons:
         vertex_indices = [i for i in poly.vertices]
         print(f"POLYGON: {poly.index}: {vertex_indices}")
-        for vi in poly.vertices:
-            color_values = [i for i in color_layer.data[vi].color]
-            print(f" - {vi}: {color_values}")
+        for li in poly.loop_indices:
+            color_values = [i for i in color_layer.data[li].color]
+            print(f" - {li}: {color_values}")
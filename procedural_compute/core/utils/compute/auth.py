@@ -3,20 +3,30 @@ Utilities for API Access.  Specifically a User class which gets or refreshes the
 access token and
 """
 
-from urllib import request as Req
-from urllib.error import HTTPError
 from urllib.parse import urlencode
 import requests
-from datetime import datetime
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import InsecureRequestWarning
+import urllib3
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
 import base64
 import json
 import logging
-import ssl
+import threading
+
+from .exceptions import Throttled
+from .cache import ResponseCache
 
 logger = logging.getLogger(__name__)
 
 # Disable SSL verification - TO FIX THIS
-ssl_context = ssl._create_unverified_context()
+SSL_VERIFY = False
+if not SSL_VERIFY:
+    urllib3.disable_warnings(InsecureRequestWarning)
+
+# Default number of pooled keep-alive connections per host
+POOL_SIZE = 10
 
 # Common function for pretty-print JSON data
 def printJSON(pyObj):
@@ -37,19 +47,71 @@ def data_to_dict(data):
 
     return data
 
+def parse_retry_after(value):
+    """ Seconds to wait from a Retry-After header (delay-seconds or HTTP-date)
+    """
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    return max((retry_at - datetime.now(timezone.utc)).total_seconds(), 0.0)
+
+def is_stream(data):
+    """ True if data is an iterable of chunks rather than a complete body
+    """
+    return data is not None and not isinstance(data, (bytes, bytearray, str, dict, list))
+
+def encode_stream(chunks, encoding='utf8'):
+    """ Encode a stream of str or bytes chunks to bytes.  An iterable body is sent
+    with chunked transfer-encoding, so only one chunk is held in memory at a time.
+    """
+    for chunk in chunks:
+        yield chunk.encode(encoding) if isinstance(chunk, str) else chunk
+
 # Store each user in a class with their access token and a method
 # "request" to GET, POST, PUT, DELETE to the API urls
 class User():
 
     content_header = {"content-type": "application/json"}
 
-    def __init__(self, username, password, host="https://compute.procedural.build"):
+    def __init__(self, username, password, host="https://compute.procedural.build", pool_size=POOL_SIZE, cache=True):
         self.host_url = host[:-1] if host[-1] == "/" else host
         self.username   = username
         self.password   = password
         self._access_token   = ""
         self._refresh_token  = ""
         self.request_log = []
+        self.pool_size = pool_size
+        self._session = None
+        self._token_lock = threading.Lock()
+        self.cache = ResponseCache() if cache is True else (cache or None)
+
+    @property
+    def session(self):
+        """ A keep-alive session shared by all requests of this user.  Connections
+        are pooled per host (up to pool_size) and gzip responses are decoded.
+        """
+        if self._session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size)
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+            session.headers.update({'Accept-Encoding': 'gzip, deflate'})
+            self._session = session
+        return self._session
+
+    def close(self):
+        """ Close the pooled connections
+        """
+        if self._session is not None:
+            self._session.close()
+            self._session = None
 
     @property
     def token(self):
@@ -109,16 +171,18 @@ class User():
         # Check that we have a refresh token first
         if not self._refresh_token:
             return None
-        # Check if the current access token is valid
-        exp_time = self.token_exp_time
-        if exp_time and exp_time > time_remaining:
-            #logger.info(f"No refresh required. Token will expire in {exp_time}")
+        # Only one thread refreshes - the others wait and then see a valid token
+        with self._token_lock:
+            # Check if the current access token is valid
+            exp_time = self.token_exp_time
+            if exp_time and exp_time > time_remaining:
+                #logger.info(f"No refresh required. Token will expire in {exp_time}")
+                return self.token
+            # Do the refresh
+            response_dict = self.request('POST', '/auth-jwt/refresh/', {'refresh': self._refresh_token})
+            self._access_token = response_dict['access']
+            logger.info(f"Refreshed token. Will expire in {self.token_exp_time}")
             return self.token
-        # Do the refresh
-        response_dict = self.request('POST', '/auth-jwt/refresh/', {'refresh': self._refresh_token})
-        self._access_token = response_dict['access']
-        logger.info("Refreshed token. Will expire in", self.token_exp_time)
-        return self.token
 
     def verify_token(self):
         response_dict = self.request('POST', '/auth-jwt/verify/', {'token': self.token})
@@ -131,16 +195,18 @@ class User():
         url_params = urlencode(query_params) if query_params else None
         return '%s?%s'%(url, url_params) if url_params else url
 
-    def decode_response(self):
+    def decode_response(self, response=None, content=None):
         """ Try to parse the response as JSON, otherwise just return the raw response
         """
-        decoded_response = self.last_response
-        content = ""
+        response = response if response is not None else self.last_response
+        decoded_response = response
+        content = response.content if content is None else content
         try:
-            content = self.last_response.read().decode('utf8')
+            content = content.decode('utf8')
             decoded_response = json.loads(content)
             return decoded_response
-        except (TypeError, json.JSONDecodeError):
+        except (TypeError, UnicodeDecodeError, json.JSONDecodeError):
+            content = content if isinstance(content, str) else ""
             # Attach the read content onto the response object (for future use)
             decoded_response.read_content = content
             return decoded_response
@@ -170,15 +236,25 @@ class User():
         url = self.get_full_url(url, query_params)
 
         # Set the data that should be sent
+        streamed = raw and is_stream(data)
         if method in ['POST', 'PUT', 'PATCH'] and not raw:
             # Send POST requst with JSON encoded data
             data = json.dumps(data).encode('utf8')
+        elif streamed:
+            # Send the chunks as they are generated (chunked transfer-encoding)
+            data = encode_stream(data)
 
         _extra_headers = extra_headers.copy()
         if raw and (not "content-type" in extra_headers):
             logger.info("Setting raw body content-type to application/octet-stream")
             _extra_headers.update({"content-type": "application/octet-stream"})
 
+        # Revalidate a cached GET response rather than downloading it again
+        cache_key = f"{self.username} {url}"
+        cached = self.cache.get(cache_key) if (method == "GET" and self.cache) else None
+        if cached is not None:
+            _extra_headers.update(cached.validators())
+
         # Remove data from GET requests (otherwise urllib will conver this to a POST automatically)
         if method == "GET":
             data = None
@@ -195,21 +271,39 @@ class User():
             "id": _id,
             "url": url,
             "time": datetime.now().isoformat(),
-            "data": data_to_dict(data)
+            "data": "<stream>" if streamed else data_to_dict(data)
         })
 
-        # Get the actual request object
-        request = Req.Request(url, method=method, data=data, headers=headers)
-
+        # Send the request on a pooled (keep-alive) connection
         try:
-            self.last_response = Req.urlopen(request, context=ssl_context)
-        except HTTPError as err:
-            msg = err.read().decode('utf8')
+            response = self.session.request(method, url, data=data, headers=headers, verify=SSL_VERIFY)
+        except requests.ConnectionError as err:
+            self.last_response = None
+            raise ConnectionError("Request failed due to: %s"%(err)) from err
+
+        if response.status_code == 429:
+            retry_after = parse_retry_after(response.headers.get('Retry-After'))
+            logger.info(f"Request #{_id} throttled. Retry after: {retry_after}")
+            raise Throttled("Request throttled: %s"%(response.text), retry_after=retry_after)
+
+        if not response.ok:
+            msg = response.text
             logger.info(msg)
             self.last_response = None
             raise Exception("Request failed due to: %s"%(msg))
 
-        return self.decode_response()
+        self.last_response = response
+
+        if cached is not None and response.status_code == 304:
+            logger.info(f"Request #{_id} not modified. Using cached response")
+            self.cache.hit()
+            return self.decode_response(response, content=cached.content)
+        if method == "GET" and self.cache:
+            self.cache.miss()
+            self.cache.store(cache_key, response)
+
+        # Decode this response (not self.last_response) as requests may run on several threads
+        return self.decode_response(response)
 
 
 USER = [User('', '')]
@@ -220,6 +314,7 @@ def get_current_user():
 
 
 def login_user(username, password, host):
+    USER[0].close()
     USER[0] = User(username, password, host = host)
     logger.info(f"Getting token for user {username} from {host}")
     USER[0].get_token()
@@ -0,0 +1,96 @@
+"""
+Run many API calls (eg. deleting files or sub-tasks) through a bounded pool
+of worker threads.  All workers share one Backoff so that a throttled (429)
+response or Retry-After header pauses every worker, and the pause shrinks
+again as requests succeed.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import threading
+import time
+import logging
+
+from .exceptions import Throttled
+
+logger = logging.getLogger(__name__)
+
+
+class Backoff():
+
+    def __init__(self, initial=0.5, maximum=60.0, decay=0.5):
+        self.initial = initial
+        self.maximum = maximum
+        self.decay = decay
+        self.delay = 0.0
+        self.resume_at = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        """ Block until the shared pause (if any) is over
+        """
+        while True:
+            with self._lock:
+                remaining = self.resume_at - time.monotonic()
+            if remaining <= 0:
+                return
+            time.sleep(remaining)
+
+    def throttled(self, retry_after=None):
+        """ Double the delay and pause all workers for retry_after seconds
+        (if the server gave one) or the current delay.  Returns the pause.
+        """
+        with self._lock:
+            self.delay = min(max(self.delay * 2, self.initial), self.maximum)
+            pause = retry_after if retry_after is not None else self.delay
+            self.resume_at = max(self.resume_at, time.monotonic() + pause)
+            return pause
+
+    def succeeded(self):
+        with self._lock:
+            self.delay = self.delay * self.decay if self.delay > 0.01 else 0.0
+
+
+def run_bulk(function, items, max_workers=4, max_retries=5, backoff=None, progress=None, label="item"):
+    """ Call function(item) for each of the items on at most max_workers threads.
+    Throttled calls are retried (up to max_retries) after backing off.
+
+    progress(done, total, item, error) is called as each item finishes.
+    Returns a tuple of dicts (results, failures) keyed by item.
+    """
+    items = list(items)
+    backoff = backoff or Backoff()
+    results = {}
+    failures = {}
+
+    def run(item):
+        for attempt in range(max_retries + 1):
+            backoff.wait()
+            try:
+                result = function(item)
+            except Throttled as err:
+                if attempt == max_retries:
+                    raise
+                pause = backoff.throttled(err.retry_after)
+                logger.info(f"Throttled on {label} {item}. Backing off for {pause:.2f}s")
+                continue
+            backoff.succeeded()
+            return result
+
+    if not items:
+        return (results, failures)
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {executor.submit(run, item): item for item in items}
+        for (done, future) in enumerate(as_completed(futures), 1):
+            item = futures[future]
+            error = future.exception()
+            if error is None:
+                results[item] = future.result()
+                logger.info(f"[{done}/{len(items)}] {label} {item}: done")
+            else:
+                failures[item] = error
+                logger.info(f"[{done}/{len(items)}] {label} {item}: failed ({error})")
+            if progress:
+                progress(done, len(items), item, error)
+
+    return (results, failures)
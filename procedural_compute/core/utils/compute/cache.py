@@ -0,0 +1,220 @@
+"""
+Cache of GET responses keyed by the full url (including query parameters).
+Cached responses are always revalidated with the server (If-None-Match /
+If-Modified-Since) so a repeated listing or download costs a 304 rather than
+a full transfer.  Entries are held in memory and on disk, each with an LRU
+size cap.  Responses are authenticated, so the disk cache is in the user's
+own cache directory, readable only by them.
+"""
+
+from collections import OrderedDict
+import hashlib
+import tempfile
+import threading
+import sys
+import json
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+def user_cache_dir():
+    if sys.platform.startswith('win'):
+        root = os.environ.get('LOCALAPPDATA') or os.path.expanduser('~')
+    elif sys.platform == 'darwin':
+        root = os.path.expanduser('~/Library/Caches')
+    else:
+        root = os.environ.get('XDG_CACHE_HOME') or os.path.expanduser('~/.cache')
+    return os.path.join(root, 'procedural_compute', 'http_cache')
+
+
+CACHE_DIR = user_cache_dir()
+
+
+class CacheEntry():
+
+    def __init__(self, content, etag=None, last_modified=None):
+        self.content = content
+        self.etag = etag
+        self.last_modified = last_modified
+
+    def digest(self):
+        return hashlib.sha1(self.content).hexdigest()
+
+    def __len__(self):
+        return len(self.content)
+
+    @property
+    def meta(self):
+        return {'etag': self.etag, 'last_modified': self.last_modified, 'sha1': self.digest()}
+
+    def validators(self):
+        """ Headers for a conditional request against this entry
+        """
+        headers = {}
+        if self.etag:
+            headers['If-None-Match'] = self.etag
+        if self.last_modified:
+            headers['If-Modified-Since'] = self.last_modified
+        return headers
+
+
+class ResponseCache():
+
+    def __init__(self, max_memory=64 * 2**20, max_disk=512 * 2**20, cache_dir=CACHE_DIR):
+        self.max_memory = max_memory
+        self.max_disk = max_disk
+        self.cache_dir = cache_dir
+        self.entries = OrderedDict()
+        self.memory_size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'stores': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+
+    def get(self, url):
+        """ Get the entry for the url from memory or (failing that) from disk
+        """
+        with self._lock:
+            entry = self.entries.get(url)
+            if entry is not None:
+                self.entries.move_to_end(url)
+                return entry
+        entry = self._read_disk(url)
+        if entry is not None:
+            self._put_memory(url, entry)
+        return entry
+
+    def store(self, url, response):
+        """ Store the response if it has validators to revalidate it with
+        (otherwise any older entry is dropped, as its validators are stale)
+        """
+        etag = response.headers.get('ETag')
+        last_modified = response.headers.get('Last-Modified')
+        if not (etag or last_modified):
+            self.invalidate(url)
+            return None
+        entry = CacheEntry(response.content, etag=etag, last_modified=last_modified)
+        self._put_memory(url, entry)
+        self._write_disk(url, entry)
+        with self._lock:
+            self.stats['stores'] += 1
+        return entry
+
+    def hit(self):
+        with self._lock:
+            self.stats['hits'] += 1
+
+    def miss(self):
+        with self._lock:
+            self.stats['misses'] += 1
+
+    def invalidate(self, url):
+        with self._lock:
+            previous = self.entries.pop(url, None)
+            if previous is not None:
+                self.memory_size -= len(previous)
+        path = self._path(url)
+        for _path in (f"{path}.json", path):
+            try:
+                os.remove(_path)
+            except FileNotFoundError:
+                pass
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.memory_size = 0
+        for (path, size, mtime) in self._disk_files():
+            os.remove(path)
+
+    def _put_memory(self, url, entry):
+        if len(entry) > self.max_memory:
+            return None
+        with self._lock:
+            previous = self.entries.pop(url, None)
+            if previous is not None:
+                self.memory_size -= len(previous)
+            self.entries[url] = entry
+            self.memory_size += len(entry)
+            while self.memory_size > self.max_memory:
+                (_url, evicted) = self.entries.popitem(last=False)
+                self.memory_size -= len(evicted)
+                self.stats['evictions'] += 1
+
+    def _path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode('utf8')).hexdigest())
+
+    def _read_disk(self, url):
+        path = self._path(url)
+        try:
+            with open(f"{path}.json", 'r') as f:
+                meta = json.load(f)
+            with open(path, 'rb') as f:
+                content = f.read()
+            # Touch the file so it is the most recently used on disk
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        entry = CacheEntry(content, etag=meta.get('etag'), last_modified=meta.get('last_modified'))
+        # The pair was read part way through being replaced
+        if meta.get('sha1') != entry.digest():
+            return None
+        return entry
+
+    def _write_disk(self, url, entry):
+        if not self.max_disk or len(entry) > self.max_disk:
+            return None
+        path = self._path(url)
+        try:
+            self._make_dir()
+            self._replace(path, entry.content)
+            self._replace(f"{path}.json", json.dumps(entry.meta).encode('utf8'))
+        except OSError as err:
+            logger.info(f"Could not write response cache file {path}: {err}")
+            return None
+        self._evict_disk()
+
+    def _make_dir(self):
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, mode=0o700, exist_ok=True)
+        os.chmod(self.cache_dir, 0o700)
+
+    def _replace(self, path, data):
+        # Write a private temporary file and swap it in, so the file is never partial
+        (fd, tmp) = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except OSError:
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            raise
+
+    def _disk_files(self):
+        if not os.path.isdir(self.cache_dir):
+            return []
+        files = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(('.json', '.tmp')):
+                continue
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                continue
+            files.append((path, stat.st_size, stat.st_mtime))
+        return files
+
+    def _evict_disk(self):
+        files = sorted(self._disk_files(), key=lambda i: i[2])
+        total = sum(size for (path, size, mtime) in files)
+        for (path, size, mtime) in files:
+            if total <= self.max_disk:
+                break
+            for _path in (path, f"{path}.json"):
+                if os.path.exists(_path):
+                    os.remove(_path)
+            total -= size
+            with self._lock:
+                self.stats['evictions'] += 1
@@ -5,3 +5,10 @@ class MultipleObjectsReturned(Exception):
 
 class DoesNotExist(Exception):
     pass
+
+
+class Throttled(Exception):
+
+    def __init__(self, message, retry_after=None):
+        super().__init__(message)
+        self.retry_after = retry_after
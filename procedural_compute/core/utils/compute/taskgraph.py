@@ -0,0 +1,118 @@
+"""
+Declarative graph of the sub-tasks under a parent task (eg. setup -> mesh ->
+solution).  The task UIDs are cached so that reconciling an unchanged graph
+only sends the actions (dispatches) rather than a get_or_create for every
+task along the way.
+
+    graph = TaskGraph(project_id, task_id, cache=json.loads(cache_str))
+    setup = graph.task('setup')
+    mesh = graph.task('mesh', dependent_on=setup)
+    mesh.action = {'status': 'pending', 'config': {...}}
+    tasks = graph.reconcile([mesh])
+    cache_str = json.dumps(graph.cache)
+"""
+
+import logging
+
+from .view import GenericViewSet
+
+logger = logging.getLogger(__name__)
+
+
+class TaskNode():
+
+    def __init__(self, name, parent=None, dependent_on=None, config=None, action=None):
+        self.name = name
+        self.parent = parent
+        self.dependent_on = dependent_on
+        self.config = config
+        self.action = action
+
+    @property
+    def key(self):
+        return f"{self.parent.key}/{self.name}" if self.parent else self.name
+
+    def requires(self):
+        return [i for i in (self.parent, self.dependent_on) if i is not None]
+
+
+class TaskGraph():
+
+    def __init__(self, project_id, root_task_id, cache=None):
+        self.project_id = project_id
+        self.root_task_id = root_task_id
+        self.nodes = {}
+        # Discard a cache that belongs to another parent task
+        cache = cache or {}
+        self.cache = cache if cache.get('root') == root_task_id else {'root': root_task_id, 'tasks': {}}
+
+    @property
+    def viewset(self):
+        return GenericViewSet(f'/api/project/{self.project_id}/task/')
+
+    def task(self, name, parent=None, dependent_on=None, config=None):
+        node = TaskNode(name, parent=parent, dependent_on=dependent_on, config=config)
+        self.nodes[node.key] = node
+        return node
+
+    def plan(self, targets):
+        """ The target nodes and everything they require, in dependency order
+        """
+        ordered = []
+
+        def visit(node):
+            if node in ordered:
+                return
+            for required in node.requires():
+                visit(required)
+            ordered.append(node)
+
+        for node in targets:
+            visit(node)
+        return ordered
+
+    def reconcile(self, targets=None):
+        """ Get or create the tasks required for the targets and send their
+        actions.  Returns a dict of {node.key: task}.  If a cached task has gone
+        (eg. deleted on the server) the cache is dropped and the plan is rerun.
+        """
+        try:
+            return self._reconcile(targets)
+        except Exception as err:
+            if not self.cache['tasks']:
+                raise
+            logger.info(f"Reconciling from cached task ids failed ({err}). Retrying without the cache")
+            self.clear()
+            return self._reconcile(targets)
+
+    def clear(self):
+        self.cache['tasks'] = {}
+
+    def _reconcile(self, targets):
+        tasks = {}
+        for node in self.plan(targets or list(self.nodes.values())):
+            uid = self.cache['tasks'].get(node.key)
+            task = {'uid': uid}
+            if uid is None:
+                task = self._get_or_create(node, tasks)
+                self.cache['tasks'][node.key] = task['uid']
+            if node.action:
+                task = self.viewset.update(task['uid'], node.action)
+            tasks[node.key] = task
+        return tasks
+
+    def _get_or_create(self, node, tasks):
+        query_params = {
+            'name': node.name,
+            'parent': tasks[node.parent.key]['uid'] if node.parent else self.root_task_id,
+        }
+        if node.dependent_on is not None:
+            query_params.update({'dependent_on': tasks[node.dependent_on.key]['uid']})
+
+        return self.viewset.get_or_create(
+            query_params,
+            {
+                'config': node.config or {'task_type': 'empty'}
+            },
+            create = True
+        )
@@ -1,5 +1,6 @@
 from .exceptions import MultipleObjectsReturned, DoesNotExist
 from .auth import USER
+from .bulk import run_bulk
 
 
 class GenericViewSet():
@@ -78,3 +79,14 @@ class GenericViewSet():
             self.object_path(object_id),
             query_params = query_params
         )
+
+    def bulk_delete(self, object_ids, query_params=None, **kwargs):
+        """ Delete many objects concurrently (see bulk.run_bulk for kwargs).
+        Returns a tuple of dicts (results, failures) keyed by object_id.
+        """
+        return run_bulk(
+            lambda object_id: self.delete(object_id, query_params=query_params),
+            object_ids,
+            label=f"DELETE {self.base_path}",
+            **kwargs
+        )
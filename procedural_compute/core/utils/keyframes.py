@@ -0,0 +1,45 @@
+###########################################################
+# Blender Addon for Procedural Cloud-based Design Tools
+# Copyright (C) 2020, Procedural (ApS) Denmark
+# License : procedural.build license
+# Version : 1.2
+# Web     : www.procedural.build
+###########################################################
+
+"""
+Bake precomputed animation straight into F-curves.  All the keyframes of a
+curve are added at once (keyframe_points.add + foreach_set) so neither the
+current frame nor the depsgraph is touched while baking.
+"""
+
+import bpy
+import numpy as np
+
+
+def bakeKeyframes(ob, data_path, frames, values, group="Object Transforms"):
+    """ Replace the F-curves of ob.data_path with keyframes at frames.
+    values has one row per frame and one column per array index of the
+    property (eg. (n, 3) for location).
+    """
+    frames = np.asarray(frames, dtype=np.float32)
+    values = np.asarray(values, dtype=np.float32).reshape(len(frames), -1)
+
+    if ob.animation_data is None:
+        ob.animation_data_create()
+    if ob.animation_data.action is None:
+        ob.animation_data.action = bpy.data.actions.new(f"{ob.name}Action")
+    fcurves = ob.animation_data.action.fcurves
+
+    co = np.empty((len(frames), 2), dtype=np.float32)
+    co[:, 0] = frames
+    for index in range(values.shape[1]):
+        fcurve = fcurves.find(data_path, index=index)
+        if fcurve is not None:
+            fcurves.remove(fcurve)
+        fcurve = fcurves.new(data_path, index=index, action_group=group)
+        fcurve.keyframe_points.add(len(frames))
+        co[:, 1] = values[:, index]
+        fcurve.keyframe_points.foreach_set("co", co.ravel())
+        # Recalculate the handles for the new points
+        fcurve.update()
+    return None
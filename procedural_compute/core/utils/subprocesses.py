@@ -12,13 +12,20 @@ base-program such as EnergyPlus, Radiance or OpenFOAM.
 
 DATA:
     p = dict: A dictionary of subprocesses accessed by name
+    runs = dict: The latest StreamingProcess of each name, for the UI
 
 """
 
 import bpy
+import os
+import signal
 import subprocess
+import threading
+import time
+from collections import deque
 
 p = {}
+runs = {}
 
 
 def bashForWindows(cmd):
@@ -42,7 +49,7 @@ def waitSTDOUT(cmd, cwd=None, shell=True):
     P = subprocess.Popen(cmd, cwd=cwd, shell=shell)
     P.wait()
     print("Done")
-    return None
+    return P.returncode
 
 
 def waitOUTPUT(cmd, cwd=None, shell=True):
@@ -52,6 +59,141 @@ def waitOUTPUT(cmd, cwd=None, shell=True):
     return (out, err)
 
 
+class LogBuffer():
+    """ The last maxlines lines of a process's output (as (stream, line) tuples)
+    """
+
+    def __init__(self, maxlines=2000):
+        self.lines = deque(maxlen=maxlines)
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def append(self, stream, line):
+        with self._lock:
+            self.lines.append((stream, line))
+            self.count += 1
+        return None
+
+    def tail(self, n=20, stream=None):
+        with self._lock:
+            lines = [l for (s, l) in self.lines if stream is None or s == stream]
+        return lines[-n:]
+
+
+class StreamingProcess():
+    """ Run a command with its stdout and stderr read line by line on reader
+    threads, so the caller (or the UI) is never blocked.  Each line is kept in
+    the ring-buffered log, appended to logfile (like | tee) and passed to
+    parser(stream, line), which can stop the process.
+    """
+
+    def __init__(self, cmd, cwd=None, name=None, logfile=None, mode='w', parser=None, maxlines=2000, echo=True):
+        self.cmd = bashForWindows(cmd)
+        self.cwd = cwd
+        self.name = name
+        self.logfile = logfile
+        self.mode = mode
+        self.parser = parser
+        self.echo = echo
+        self.log = LogBuffer(maxlines)
+        self.process = None
+        self.started = None
+        self.finished = None
+        self.stopped = False
+        self._readers = []
+        self._file = None
+        self._fileLock = threading.Lock()
+
+    def start(self):
+        if self.logfile:
+            self._file = open(os.path.join(self.cwd or '', self.logfile), self.mode, encoding='utf-8')
+        self.started = time.monotonic()
+        # In its own process group (on posix) so stop() reaches the command and not just the shell
+        self.process = subprocess.Popen(self.cmd, cwd=self.cwd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                        start_new_session=(os.name == 'posix'))
+        for (stream, pipe) in (('stdout', self.process.stdout), ('stderr', self.process.stderr)):
+            reader = threading.Thread(target=self._read, args=(stream, pipe), daemon=True)
+            reader.start()
+            self._readers.append(reader)
+        if self.name:
+            runs[self.name] = self
+        return self
+
+    def _read(self, stream, pipe):
+        for raw in iter(pipe.readline, b''):
+            line = raw.decode('utf-8', 'replace').rstrip('\r\n')
+            self.log.append(stream, line)
+            if self._file:
+                with self._fileLock:
+                    self._file.write(line + '\n')
+            if self.echo:
+                print(line)
+            if self.parser:
+                self.parser(stream, line)
+        pipe.close()
+        return None
+
+    def wait(self, timeout=None):
+        """ Wait for the process (and its output) to finish and return its return code
+        """
+        returncode = self.process.wait(timeout)
+        for reader in self._readers:
+            reader.join()
+        if self._file:
+            self._file.close()
+            self._file = None
+        if self.finished is None:
+            self.finished = time.monotonic()
+        return returncode
+
+    def stop(self, timeout=10):
+        """ Terminate the process (killing it if it has not exited after timeout seconds)
+        """
+        if self.process is None or self.process.poll() is not None:
+            return None
+        self.stopped = True
+        self._signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            self._signal(signal.SIGKILL if os.name == 'posix' else signal.SIGTERM)
+        return None
+
+    def _signal(self, sig):
+        try:
+            if os.name == 'posix':
+                os.killpg(self.process.pid, sig)
+            else:
+                self.process.send_signal(sig)
+        except ProcessLookupError:
+            pass
+        return None
+
+    @property
+    def running(self):
+        return self.process is not None and self.process.poll() is None
+
+    @property
+    def returncode(self):
+        return None if self.process is None else self.process.poll()
+
+    @property
+    def elapsed(self):
+        if self.started is None:
+            return 0.0
+        return (self.finished or time.monotonic()) - self.started
+
+
+def streamSTDOUT(cmd, cwd=None, name=None, logfile=None, mode='w', parser=None, maxlines=2000, echo=True):
+    """ Run the command through a StreamingProcess and wait for it to finish.
+    Returns the StreamingProcess.
+    """
+    run = StreamingProcess(cmd, cwd, name, logfile, mode, parser, maxlines, echo).start()
+    returncode = run.wait()
+    print("Done (%i) in %.1fs"%(returncode, run.elapsed))
+    return run
+
+
 def newProcess(name='bash'):
     """Start a new process"""
     p[name] = subprocess.Popen("", executable=getExecutable(), stdin=subprocess.PIPE)
@@ -7,45 +7,362 @@
 ###########################################################
 
 """
-Module for managing thrads that run the relevant
+Module for managing the worker threads that run the relevant
 base-program such as EnergyPlus, Radiance or OpenFOAM.
 
+Jobs are submitted to named pools of persistent worker threads.  Each pool
+runs its jobs by priority (highest first) and in submission order within a
+priority.  A pool with one worker (eg. cfdRun) therefore runs its jobs one
+after another, so dependent steps can simply be queued in order.
+
+Every job declares the number of cores it will use (eg. rtrace -n, mpirun
+-np) and is only started once those cores fit in the machine-wide
+CoreBudget, which is shared by all the pools.  The budget admits jobs in
+the order they ask for cores, so a large job is not starved by small ones.
+Jobs of the I/O pools (eg. requests) use no cores by default, so they are
+never held up behind a solve.
+
+Submitting returns a Job, which is a concurrent.futures.Future: it can be
+cancelled while queued, waited on, and gives the result or exception of the
+function.  Pools are also Executors, so they can be used with
+asyncio's run_in_executor.
+
 DATA:
-    q = queue: A queue of threads
+    pools = {name: Pool}
+    budget = CoreBudget of the machine
+    POOL_WORKERS = default number of workers of the named pools
+    POOL_CORES = default cores of the jobs of the named pools (otherwise 1)
 """
 
 import threading
-import queue
+import heapq
+import itertools
+import time
+import traceback
 import os
+from collections import deque
+from concurrent.futures import Executor, Future
 
-queues = {}
+POOL_WORKERS = {
+    'rtrace': 4,
+    'rpict': 4,
+    'cfdRun': 1,
+    'cfdSteps': 8,
+    'vwt': 32,
+    'cfdPost': 4,
+    'requests': 4,
+    'stats': os.cpu_count() or 4,
+}
 
+POOL_CORES = {
+    'requests': 0,
+}
 
-def get_or_create_queue(name, length=4):
-    if not name in queues:
-        queues[name] = queue.Queue(length)
-    return queues[name]
+pools = {}
+_pools_lock = threading.Lock()
 
 
-def put_item(_queue, item, args, **kwargs):
-    thread = threading.Thread(target=item, args=args, kwargs=kwargs)
-    thread.daemon = True
-    _queue.put(thread, True)
-    thread.start()
-    thread.join()
-    _queue.get(True)
-    _queue.task_done()
-    return None
+class Job(Future):
+    """ Handle of a submitted function
+    """
 
+    def __init__(self, pool, name, priority=0, cores=1):
+        super().__init__()
+        self.pool = pool
+        self.name = name
+        self.priority = priority
+        self.cores = cores
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
 
-def queue_fun(queue_name, _function, args=(), kwargs={}):
-    _queue = get_or_create_queue(queue_name)
-    put_thread = threading.Thread(target=put_item, args=(_queue, _function, args), kwargs=kwargs)
-    put_thread.daemon = True
-    put_thread.start()
-    return None
+    @property
+    def status(self):
+        if self.cancelled():
+            return 'cancelled'
+        if not self.done():
+            return 'running' if self.running() else 'queued'
+        return 'failed' if self.exception() is not None else 'done'
+
+    def __repr__(self):
+        return f"<Job {self.pool}:{self.name} {self.status}>"
+
+
+class CoreBudget():
+    """ The number of cores shared by the jobs of every pool, with counters
+    of how well they are used
+    """
+
+    def __init__(self, total=None):
+        self.total = max(1, int(total or os.cpu_count() or 1))
+        self.in_use = 0
+        self._waiting = deque()
+        self._cond = threading.Condition()
+        self.reset_stats()
+
+    def reset_stats(self):
+        with self._cond:
+            self._since = self._last = time.monotonic()
+            self.stats = {'admitted': 0, 'waited': 0, 'wait_time': 0.0, 'core_seconds': 0.0, 'peak': self.in_use}
+        return None
+
+    def _tick(self):
+        # Called with the lock held: integrate the cores in use over time
+        now = time.monotonic()
+        self.stats['core_seconds'] += self.in_use * (now - self._last)
+        self._last = now
+        return now
+
+    def acquire(self, cores=1):
+        """ Block until the cores fit in the budget (and earlier requests have
+        been admitted).  Requests larger than the machine get the whole machine,
+        and jobs that only wait on others (cores=0) are admitted at once.
+        Returns the number of cores taken.
+        """
+        if cores <= 0:
+            return 0
+        ticket = object()
+        with self._cond:
+            cores = min(max(1, int(cores)), self.total)
+            self._waiting.append(ticket)
+            start = time.monotonic()
+            while self._waiting[0] is not ticket or self.in_use + cores > self.total:
+                self._cond.wait()
+            self._waiting.popleft()
+            now = self._tick()
+            self.in_use += cores
+            self.stats['admitted'] += 1
+            if now - start > 1e-3:
+                self.stats['waited'] += 1
+                self.stats['wait_time'] += now - start
+            self.stats['peak'] = max(self.stats['peak'], self.in_use)
+            # The next request may fit as well
+            self._cond.notify_all()
+        return cores
+
+    def release(self, cores):
+        with self._cond:
+            self._tick()
+            self.in_use -= cores
+            self._cond.notify_all()
+        return None
+
+    def resize(self, total):
+        with self._cond:
+            self.total = max(1, int(total))
+            self._cond.notify_all()
+        return None
+
+    def utilisation(self):
+        """ Counters of the budget since the last reset_stats:
+            total, in_use, waiting  = cores of the machine, cores in use and requests waiting
+            utilisation             = mean fraction of the cores in use
+            admitted, waited        = jobs started, and how many of them had to wait for cores
+            wait_time               = total seconds spent waiting for cores
+            core_seconds, peak      = integral and maximum of the cores in use
+        """
+        with self._cond:
+            now = self._tick()
+            elapsed = now - self._since
+            counters = dict(self.stats)
+            counters.update({
+                'total': self.total,
+                'in_use': self.in_use,
+                'waiting': len(self._waiting),
+                'utilisation': counters['core_seconds'] / (self.total * elapsed) if elapsed > 0 else 0.0,
+            })
+        return counters
+
+
+budget = CoreBudget()
+
+
+class Pool(Executor):
+    """ A named pool of persistent worker threads with a priority queue
+    """
+
+    def __init__(self, name, workers=4, cores=1):
+        self.name = name
+        self.workers = max(1, int(workers))
+        self.cores = cores
+        self.stats = {'submitted': 0, 'completed': 0, 'failed': 0, 'cancelled': 0}
+        self._heap = []
+        self._order = itertools.count()
+        self._running = set()
+        self._admitting = set()
+        self._threads = set()
+        self._idle = 0
+        self._shutdown = False
+        self._cond = threading.Condition()
+
+    def submit_job(self, fn, args=(), kwargs=None, priority=0, name=None, cores=None):
+        """ Queue fn(*args, **kwargs), which will use cores of the budget (default
+        the pool's), and return its Job
+        """
+        cores = self.cores if cores is None else cores
+        job = Job(self.name, name or getattr(fn, '__name__', repr(fn)), priority, cores)
+        with self._cond:
+            if self._shutdown:
+                raise RuntimeError(f"Pool {self.name} has been shut down")
+            heapq.heappush(self._heap, (-priority, next(self._order), job, fn, args, kwargs or {}))
+            self.stats['submitted'] += 1
+            self._startWorkers()
+            self._cond.notify()
+        return job
+
+    def submit(self, fn, /, *args, **kwargs):
+        return self.submit_job(fn, args, kwargs)
+
+    def resize(self, workers):
+        """ Set the number of workers.  Extra workers exit after their current job.
+        """
+        with self._cond:
+            self.workers = max(1, int(workers))
+            self._startWorkers()
+            self._cond.notify_all()
+        return None
+
+    def jobs(self):
+        """ The queued (waiting for cores, then in run order) and running jobs
+        """
+        with self._cond:
+            queued = list(self._admitting)
+            queued += [item[2] for item in sorted(self._heap) if not item[2].cancelled()]
+            return (queued, list(self._running))
+
+    def depth(self):
+        (queued, running) = self.jobs()
+        return {'queued': len(queued), 'running': len(running), 'workers': self.workers}
+
+    def cancel_all(self):
+        """ Cancel the queued jobs (running jobs are left to finish)
+        """
+        (queued, running) = self.jobs()
+        return sum(job.cancel() for job in queued)
+
+    def shutdown(self, wait=True, *, cancel_futures=False):
+        with self._cond:
+            self._shutdown = True
+            self._cond.notify_all()
+        if cancel_futures:
+            self.cancel_all()
+        if wait:
+            for thread in list(self._threads):
+                if thread is not threading.current_thread():
+                    thread.join()
+        return None
+
+    def _startWorkers(self):
+        # Called with the lock held
+        queued = len(self._heap)
+        while len(self._threads) < self.workers and queued > self._idle:
+            thread = threading.Thread(target=self._worker, name=f"{self.name}-{len(self._threads)}", daemon=True)
+            self._threads.add(thread)
+            self._idle += 1
+            thread.start()
+        return None
+
+    def _next(self):
+        # Wait for the next job that has not been cancelled (None once this worker should exit)
+        me = threading.current_thread()
+        with self._cond:
+            while True:
+                if len(self._threads) > self.workers or (self._shutdown and not self._heap):
+                    self._threads.discard(me)
+                    self._idle -= 1
+                    return None
+                if self._heap:
+                    (_priority, _order, job, fn, args, kwargs) = heapq.heappop(self._heap)
+                    if job.cancelled():
+                        self.stats['cancelled'] += 1
+                        continue
+                    self._idle -= 1
+                    self._admitting.add(job)
+                    return (job, fn, args, kwargs)
+                self._cond.wait()
+
+    def _admit(self, job):
+        # Take the job's cores from the budget and mark it running (None if it was cancelled meanwhile)
+        cores = budget.acquire(job.cores)
+        with self._cond:
+            self._admitting.discard(job)
+            if job.set_running_or_notify_cancel():
+                self._running.add(job)
+                return cores
+            self._idle += 1
+            self.stats['cancelled'] += 1
+        budget.release(cores)
+        return None
+
+    def _worker(self):
+        while True:
+            item = self._next()
+            if item is None:
+                return None
+            (job, fn, args, kwargs) = item
+            cores = self._admit(job)
+            if cores is None:
+                continue
+            job.started = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                print(f"Job {job.name} in {self.name} failed:")
+                traceback.print_exc()
+                job.set_exception(e)
+                failed = True
+            else:
+                job.set_result(result)
+                failed = False
+            finally:
+                budget.release(cores)
+            job.finished = time.time()
+            with self._cond:
+                self._running.discard(job)
+                self._idle += 1
+                self.stats['failed' if failed else 'completed'] += 1
+            del item, job, fn, args, kwargs
+
+
+def get_pool(name, workers=None):
+    """ The named pool, created with workers (or its default) on first use
+    """
+    with _pools_lock:
+        if name not in pools:
+            pools[name] = Pool(name, workers or POOL_WORKERS.get(name, 4), POOL_CORES.get(name, 1))
+        return pools[name]
+
+
+def submit(pool_name, _function, *args, priority=0, name=None, cores=None, **kwargs):
+    return get_pool(pool_name).submit_job(_function, args, kwargs, priority=priority, name=name, cores=cores)
+
+
+def queue_fun(queue_name, _function, args=(), kwargs={}, priority=0, cores=None):
+    return get_pool(queue_name).submit_job(_function, args, kwargs, priority=priority, cores=cores)
 
 
 def queue_sys(queue_name, cmd):
-    queue_fun(queue_name, os.system(cmd), ())
+    return queue_fun(queue_name, os.system, (cmd,))
+
+
+def queue_depth(name=None):
+    """ {'queued', 'running', 'workers'} of the named pool, or a dict of all pools
+    """
+    if name is not None:
+        return get_pool(name).depth()
+    return {n: p.depth() for (n, p) in list(pools.items())}
+
+
+def set_core_budget(total):
+    """ Set the number of cores shared by all the pools (defaults to the machine's)
+    """
+    budget.resize(total)
     return None
+
+
+def utilisation():
+    """ The budget's counters, with the depth of every pool
+    """
+    counters = budget.utilisation()
+    counters['pools'] = queue_depth()
+    return counters
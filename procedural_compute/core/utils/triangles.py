@@ -0,0 +1,201 @@
+###########################################################
+# Blender Addon for Procedural Cloud-based Design Tools
+# Copyright (C) 2020, Procedural (ApS) Denmark
+# License : procedural.build license
+# Version : 1.2
+# Web     : www.procedural.build
+###########################################################
+
+"""
+Cache of the world-space triangles of mesh objects, shared by the STL and
+Radiance exporters so an unchanged scene is only triangulated once.
+
+Entries are keyed on the object and checked against its mesh data, modifier
+state and matrix_world, and for objects that can change with the frame
+(animated, with shape keys or modifiers) the frame as well.  Geometry edits
+(which leave those unchanged) are picked up by the depsgraph_update_post
+handler, which drops the entries of the updated objects, and the
+frame_change_post handler drops the entries of other frames.  The cache
+holds at most MAX_BYTES of triangles and evicts the least recently used
+objects first.
+"""
+
+import bpy
+import numpy as np
+from collections import OrderedDict
+import threading
+
+MAX_BYTES = 256 * 2**20
+
+
+def isAnimated(id_data):
+    animation = getattr(id_data, 'animation_data', None)
+    return animation is not None and (animation.action is not None or len(animation.drivers) > 0)
+
+
+def changesWithFrame(obj):
+    """ True if the triangles of the object can differ between frames with the
+    same matrix_world (armatures and other modifiers, shape keys or drivers)
+    """
+    if len(obj.modifiers) > 0 or isAnimated(obj) or isAnimated(obj.data):
+        return True
+    shape_keys = getattr(obj.data, 'shape_keys', None)
+    return shape_keys is not None and isAnimated(shape_keys)
+
+
+def objectKey(obj):
+    modifiers = tuple((m.name, m.type, m.show_viewport, m.show_render) for m in obj.modifiers)
+    matrix = tuple(v for row in obj.matrix_world for v in row)
+    scene = bpy.context.scene
+    frame = (scene.frame_current, scene.frame_subframe) if changesWithFrame(obj) else None
+    return (obj.data.name_full, modifiers, matrix, frame)
+
+
+def triangulate(obj):
+    """ The world-space triangles of an object as an (N, 3, 3) float32 array.
+    Returns None if the object cannot be converted to a mesh.
+    """
+    # Object.to_mesh() is not guaranteed to return a mesh.
+    try:
+        me = obj.to_mesh()
+    except RuntimeError:
+        return None
+    if me is None:
+        obj.to_mesh_clear()
+        return None
+
+    # Always free the temporary mesh
+    try:
+        me.transform(obj.matrix_world)
+        me.calc_loop_triangles()
+        co = np.empty(len(me.vertices) * 3, dtype=np.float32)
+        me.vertices.foreach_get("co", co)
+        indices = np.empty(len(me.loop_triangles) * 3, dtype=np.int32)
+        me.loop_triangles.foreach_get("vertices", indices)
+    finally:
+        obj.to_mesh_clear()
+
+    return co.reshape(-1, 3)[indices].reshape(-1, 3, 3)
+
+
+class TriangulationCache():
+
+    def __init__(self, max_bytes=MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.size = 0
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self._lock = threading.Lock()
+
+    def triangles(self, obj):
+        """ The (read-only) world-space triangles of the object
+        """
+        name = obj.name_full
+        key = objectKey(obj)
+        with self._lock:
+            entry = self.entries.get(name)
+            if entry is not None and entry[0] == key:
+                self.entries.move_to_end(name)
+                self.stats['hits'] += 1
+                return entry[1]
+            self.stats['misses'] += 1
+
+        tris = triangulate(obj)
+        if tris is None:
+            self.invalidate(name)
+            return None
+        tris.flags.writeable = False
+        self._put(name, key, tris)
+        return tris
+
+    def invalidate(self, name):
+        with self._lock:
+            entry = self.entries.pop(name, None)
+            if entry is not None:
+                self.size -= entry[1].nbytes
+
+    def invalidateMesh(self, mesh_name):
+        """ Drop every object that uses the mesh data
+        """
+        with self._lock:
+            names = [name for (name, (key, tris)) in self.entries.items() if key[0] == mesh_name]
+        for name in names:
+            self.invalidate(name)
+
+    def invalidateFrames(self, frame):
+        """ Drop the entries of objects that change with the frame, other than those of frame
+        """
+        with self._lock:
+            names = [name for (name, (key, tris)) in self.entries.items() if key[3] not in (None, frame)]
+        for name in names:
+            self.invalidate(name)
+
+    def clear(self):
+        with self._lock:
+            self.entries.clear()
+            self.size = 0
+
+    def _put(self, name, key, tris):
+        if tris.nbytes > self.max_bytes:
+            self.invalidate(name)
+            return None
+        with self._lock:
+            previous = self.entries.pop(name, None)
+            if previous is not None:
+                self.size -= previous[1].nbytes
+            self.entries[name] = (key, tris)
+            self.size += tris.nbytes
+            while self.size > self.max_bytes:
+                (_name, (_key, evicted)) = self.entries.popitem(last=False)
+                self.size -= evicted.nbytes
+                self.stats['evictions'] += 1
+
+
+cache = TriangulationCache()
+
+
+def objectTriangles(obj):
+    """ The world-space triangles of a mesh object from the shared cache
+    """
+    return cache.triangles(obj)
+
+
+@bpy.app.handlers.persistent
+def depsgraph_update(scene, depsgraph):
+    for update in depsgraph.updates:
+        if not (update.is_updated_geometry or update.is_updated_transform):
+            continue
+        data = update.id.original
+        if isinstance(data, bpy.types.Object):
+            cache.invalidate(data.name_full)
+        elif isinstance(data, bpy.types.Mesh):
+            cache.invalidateMesh(data.name_full)
+
+
+@bpy.app.handlers.persistent
+def frame_change(scene, *args):
+    cache.invalidateFrames((scene.frame_current, scene.frame_subframe))
+
+
+@bpy.app.handlers.persistent
+def load_post(*args):
+    cache.clear()
+
+
+def register():
+    if depsgraph_update not in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.append(depsgraph_update)
+    if frame_change not in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.append(frame_change)
+    if load_post not in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.append(load_post)
+
+
+def unregister():
+    if depsgraph_update in bpy.app.handlers.depsgraph_update_post:
+        bpy.app.handlers.depsgraph_update_post.remove(depsgraph_update)
+    if frame_change in bpy.app.handlers.frame_change_post:
+        bpy.app.handlers.frame_change_post.remove(frame_change)
+    if load_post in bpy.app.handlers.load_post:
+        bpy.app.handlers.load_post.remove(load_post)
+    cache.clear()
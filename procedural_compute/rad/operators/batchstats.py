@@ -9,10 +9,25 @@
 import bpy
 import glob
 import os
-import threading
+from concurrent.futures import as_completed
+from procedural_compute.core.utils import threads
 from procedural_compute.core.utils.threads import queue_fun
-from procedural_compute.core.utils.subprocesses import waitOUTPUT
 from procedural_compute.rad.operators.ops import getTimeStamp
+from procedural_compute.rad.utils.hdr import imageStats
+
+# Luminance percentiles appended to each row of the Stats-*.csv
+PERCENTILES = (50, 95)
+
+
+def fileStats(filepath, mult, lim):
+    """ CSV row of the statistics of one image (run in a pool worker)
+    """
+    filename = os.path.basename(filepath)
+    print("Getting statistics for: %s"%filename)
+    stats = imageStats(filepath, mult, lim, percentiles=PERCENTILES)
+    row = "%s,%i,%i,%f,%f"%(filename, stats['pixels'], stats['nonzero'], stats['mean'], stats['limit'])
+    row += "".join([",%f"%(stats['p%g'%p]) for p in PERCENTILES])
+    return row + "\n"
 
 
 class SCENE_OT_batchstats(bpy.types.Operator):
@@ -25,26 +40,23 @@ class SCENE_OT_batchstats(bpy.types.Operator):
         return bpy.path.abspath("%s/%s"%(sc.RAD.caseDir, s))
 
     @staticmethod
-    def fileStats(filepath, mult, lim, out):
-        def clean_cmd(cmd):
-            if 'Windows' in bpy.app.build_platform.decode():
-                cmd = cmd.replace("'","\"")
-            return cmd
-        (path, filename) = os.path.split(filepath)
-        print("Getting statistics for: %s"%filename)
-        NP = int(waitOUTPUT(clean_cmd("getinfo -d %s | rcalc -e '$1=$3*$5'"%filename), cwd=path)[0].decode())
-        NPZ = int(waitOUTPUT(clean_cmd("pvalue -h -H -o %s | rcalc -e '$1=($3*0.265+$4*0.67+$5*0.065)*179' | rcalc -e '$1=if($1,1,0)' | total"%filename), cwd=path)[0].decode())
-        AV = float(waitOUTPUT(clean_cmd("pvalue -h -H -o %s | rcalc -e '$1=($3*0.265+$4*0.67+$5*0.065)*'%f | total -m"%(filename, mult)), cwd=path)[0].decode())
-        NPLIM = int(waitOUTPUT(clean_cmd("pvalue -h -H -o %s | rcalc -e '$1=($3*0.265+$4*0.67+$5*0.065)*'%f | rcalc -e '$1=if($1-%f,1,0)' | total"%(filename, mult, lim)), cwd=path)[0].decode())
-        AVZ = float(AV*NP/NPZ)
-        ALIM= float(NPLIM/NPZ)
-        # Append the results to the output file
-        lock = threading.Lock()
-        lock.acquire()
-        f = open(out, 'a')
-        f.write("%s,%i,%i,%f,%f\n"%(filename,NP,NPZ,AVZ,ALIM))
-        f.close()
-        lock.release()
+    def runStats(files, mult, lim, out):
+        """ Get the statistics of all the images on the stats pool (a core of
+        the budget each) and write the rows to the output file from this
+        (single) thread in file order
+        """
+        rows = {}
+        jobs = {threads.submit("stats", fileStats, f, mult, lim, cores=1): f for f in files}
+        for job in as_completed(jobs):
+            try:
+                rows[jobs[job]] = job.result()
+            except Exception as err:
+                print("Could not get statistics for %s: %s"%(jobs[job], err))
+        # Write all rows at once and swap the file in, so readers never see a partial file
+        with open(out + ".tmp", 'w') as f:
+            for filepath in sorted(rows):
+                f.write(rows[filepath])
+        os.replace(out + ".tmp", out)
         print("Done")
         return None
 
@@ -55,9 +67,8 @@ class SCENE_OT_batchstats(bpy.types.Operator):
         outFile = "%s/images/Stats-%s.csv"%(cdir,ts)
         files = glob.glob('%s/images/*%s.hdr'%(cdir, ts))
         f=open(outFile,'w');f.write("");f.close()
-        for f in files:
-            #self.fileStats(f, p.mult, p.limit, outFile)
-            queue_fun("rtrace", self.fileStats, (f, p.mult, p.limit, outFile) )
+        # Only waits on the stats jobs, so takes no cores itself
+        queue_fun("rtrace", self.runStats, (files, p.mult, p.limit, outFile), cores=0)
         return None
 
     def execute(self, context):
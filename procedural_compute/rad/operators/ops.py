@@ -15,7 +15,7 @@ import threading
 from procedural_compute.core.utils.threads import queue_fun
 from procedural_compute.core.utils.subprocesses import waitSTDOUT, waitOUTPUT
 
-from procedural_compute.rad.utils.radiancescene import RadianceScene
+from procedural_compute.rad.utils.radiancescene import RadianceScene, afterStaticOctree
 from procedural_compute.sun.utils.timeFrameSync import getTimeStamp
 from procedural_compute.sun.utils.timeFrameSync import frameToTime
 
@@ -86,14 +86,21 @@ class SCENE_OT_radianceOps(bpy.types.Operator):
     def executeRifFile(self):
         sc = bpy.context.scene
         cmd = "rad -N %i %s.rif"%(sc.RAD.nproc, getTimeStamp())
-        queue_fun("rpict", waitSTDOUT, (cmd, caseDir()))
+        afterStaticOctree(caseDir(), queue_fun, "rpict", waitSTDOUT, (cmd, caseDir()), cores=sc.RAD.nproc)
         getOutsideAmb()
         return{'FINISHED'}
 
     def genOctree(self):
-        ts = getTimeStamp()
-        cmd = "oconv %s.rad > octrees/%s.oct"%(ts, ts)
-        queue_fun("rtrace", waitSTDOUT, (cmd, caseDir()))
+        afterStaticOctree(caseDir(), self.queueOctree, caseDir(), RadianceScene().staticOctree(), getTimeStamp())
+
+    @staticmethod
+    def queueOctree(cwd, base, ts):
+        if os.path.exists(os.path.join(cwd, base)):
+            # Add this frame's sky to the frozen static octree
+            cmd = "oconv -i %s skies/%s.sky > octrees/%s.oct"%(base, ts, ts)
+        else:
+            cmd = "oconv %s.rad > octrees/%s.oct"%(ts, ts)
+        queue_fun("rtrace", waitSTDOUT, (cmd, cwd))
 
     def getFilename(self,s):
         return "%s/%s"%(caseDir(),s)
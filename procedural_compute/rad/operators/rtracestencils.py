@@ -7,9 +7,13 @@
 ###########################################################
 
 import bpy
+import os
+import numpy as np
 
 from procedural_compute.core.utils.threads import queue_fun
-from procedural_compute.core.utils.subprocesses import waitSTDOUT, waitOUTPUT
+from procedural_compute.core.utils.subprocesses import waitSTDOUT
+from procedural_compute.rad.utils.rtrace import rtrace, octreeBounds
+from procedural_compute.rad.utils.hdr import writeHDR
 
 from procedural_compute.rad.utils.radiancescene import RadianceScene
 from procedural_compute.rad.operators.ops import getTimeStamp
@@ -32,7 +36,6 @@ class SCENE_OT_rtracestencils(bpy.types.Operator):
                 self.report({'ERROR'},'Not all stencils are flat')
                 return {'FINISHED'}
         self.writeStencils()
-        self.oconvStensils()
         self.rtraceStencils()
         return{'FINISHED'}
 
@@ -56,39 +59,34 @@ class SCENE_OT_rtracestencils(bpy.types.Operator):
             f.close()
         return
 
-    def oconvStensils(self):
-        for o in bpy.context.selected_objects:
-            cmd = "oconv stencils/%s.rad > stencils/%s.oct"%(o.name, o.name)
-            queue_fun("rtrace", waitSTDOUT, (cmd, caseDir()))
-        return
+    def oconvStensil(self, o):
+        return "oconv stencils/%s.rad > stencils/%s.oct"%(o.name, o.name)
 
-    def vertXY(self, o):
-        M = o.matrix_world
-        X = [(M*v.co)[0] for v in o.data.vertices]
-        Y = [(M*v.co)[1] for v in o.data.vertices]
-        return (X, Y)
+    def worldVertices(self, o):
+        co = np.empty(len(o.data.vertices)*3, dtype=np.float64)
+        o.data.vertices.foreach_get("co", co)
+        M = np.array(o.matrix_world)
+        return co.reshape(-1, 3) @ M[:3, :3].T + M[:3, 3]
 
     def getDimRes(self, o):
-        (x, y) = self.vertXY(o)
+        co = self.worldVertices(o)
         sc = bpy.context.scene
         R = sc.RAD.Stencil.res
-        X = max(x) - min(x)
-        Y = max(y) - min(y)
+        (minX, minY) = co[:, :2].min(axis=0)
+        (maxX, maxY) = co[:, :2].max(axis=0)
+        X = maxX - minX
+        Y = maxY - minY
         if X >= Y:
             xres = int(R)
             yres = int(R*Y/X)
         else:
             xres = int(R*X/Y)
             yres = int(R)
-        return (min(x), min(y), max(x), max(y), xres, yres)
+        return (minX, minY, maxX, maxY, xres, yres)
 
     def isFlat(self, o):
-        M = o.matrix_world
-        z0 = (M*o.data.vertices[0].co)[2]
-        for v in o.data.vertices:
-            if abs((M*v.co)[2] - z0) > 0.001:
-                return False
-        return True
+        z = self.worldVertices(o)[:, 2]
+        return bool(np.all(np.abs(z - z[0]) <= 0.001))
 
     def rtraceStencils(self):
         # Now do the calculation
@@ -101,36 +99,49 @@ class SCENE_OT_rtracestencils(bpy.types.Operator):
             YC = (minY+maxY)/2.0
             X = maxX-minX
             Y = maxY-minY
-            Zvec = (o.matrix_world.to_3x3()*o.data.polygons[0].normal).normalized()
-            Zo = (o.matrix_world*o.data.vertices[0].co)
+            Zvec = (o.matrix_world.to_3x3() @ o.data.polygons[0].normal).normalized()
+            Zo = (o.matrix_world @ o.data.vertices[0].co)
             Z = (Zo + Zvec)[2]
 
-            # Get the arguments for the rtrace command
+            # Get the arguments for the rtrace command (-ar is set from the octree size)
             rtargs =  " -ab %i -ad %i -as %i -aa %f -av .0 .0 .0 "%(b.ambB, b.ambD, b.ambS, b.ambA)
+            cores = 1
             if not 'Windows' in bpy.app.build_platform.decode():
                 rtargs  = " -n %i"%(s.nproc) + rtargs
-                rtargs += " -ar `getinfo -d<octrees/%s.oct|rcalc -e '$1=floor(16*$4/(%f+%f))'`"%(timestamp,X,Y)
-            else:
-                octDir = bpy.path.abspath("%s/octrees/%s.oct"%(caseDir(),timestamp))
-                (AR,err) = waitOUTPUT("getinfo -d<%s|rcalc -e \"$1=floor(16*$4/(%f+%f))\""%(octDir,X,Y),cwd=caseDir())
-                rtargs += " -ar %i"%(int(AR))
-
-            # Generate a rectangular grid of rays over the stencil limits
-            cmd  = "cnt %u %u"%(yres, xres)
-            cmd += " | rcalc -e '$1=%f + ($2-(%u/2)+0.5)*(%f)' "%(XC, xres, X/xres)
-            cmd += " -e '$2=%f - ($1-(%u/2)+0.5)*(%f)' "%(YC, yres, Y/yres)
-            cmd += " -e '$3=%f' -e '$4=0;$5=0;$6=%f' "%(Z, -1*Zvec[2])
-            # raytrace upwards to the stencil area
-            cmd += " | rtrace -w -h -opv  stencils/%s.oct "%(o.name)
-            cmd += " | rcalc -e '$1=$1;$2=$2;$3=$3;$4=0;$5=0;$6=if($6-0.5,1,0)' "
-            cmd += " | rtrace %s -h+ -I+ -ov octrees/%s.oct "%(rtargs, timestamp)
-            cmd += " | pvalue -r -x %u -y %u "%(yres, xres)
-            cmd += " | pfilt -h 20 -p 1 > images/dftrace_%s_%s.hdr"%(o.name, timestamp)
-
-            if 'Windows' in bpy.app.build_platform.decode():
-                cmd = cmd.replace("'","\"")
-
-            queue_fun("rtrace", waitSTDOUT, (cmd, caseDir()))
+                cores = s.nproc
+
+            # A rectangular grid of rays over the stencil limits, top row first
+            (row, col) = np.mgrid[0:yres, 0:xres]
+            origins = np.empty((yres, xres, 3))
+            origins[..., 0] = XC + (col - xres/2 + 0.5)*(X/xres)
+            origins[..., 1] = YC - (row - yres/2 + 0.5)*(Y/yres)
+            origins[..., 2] = Z
+            direction = (0.0, 0.0, -1*Zvec[2])
+
+            job = (self.oconvStensil(o), "stencils/%s.oct"%(o.name), "octrees/%s.oct"%(timestamp),
+                   origins, direction, X+Y, rtargs, "images/dftrace_%s_%s.hdr"%(o.name, timestamp), caseDir())
+            queue_fun("rtrace", traceStencil, job, cores=cores)
         return None
 
+
+def traceStencil(oconv, stencil, octree, origins, direction, size, rtargs, outfile, cwd):
+    """ Irradiance over the stencil area, as a (yres, xres, 3) array written to outfile.
+    The pixels are the irradiances themselves, without the auto-exposure of
+    the former pfilt pass.
+    """
+    waitSTDOUT(oconv, cwd)
+    (yres, xres) = origins.shape[:2]
+    (xmin, ymin, zmin, octsize) = octreeBounds(octree, cwd)
+    rtargs += " -ar %i"%(int(np.floor(16*octsize/size)))
+
+    # Trace towards the stencil, then upwards from the points that hit the stencil glow
+    hits = rtrace(stencil, origins.reshape(-1, 3), direction, args="-w", outputs="pv", cwd=cwd)
+    directions = np.zeros((len(hits), 3))
+    directions[hits[:, 5] > 0.5, 2] = 1.0
+    values = rtrace(octree, hits[:, :3], directions, args=rtargs + " -I+", outputs="v", cwd=cwd)
+
+    image = values.reshape(yres, xres, 3)
+    writeHDR(os.path.join(cwd, outfile), image)
+    return image
+
 bpy.utils.register_class(SCENE_OT_rtracestencils)
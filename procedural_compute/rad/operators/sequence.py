@@ -8,8 +8,15 @@
 
 
 import bpy
+import os
 from procedural_compute.core.utils.threads import queue_fun
-from procedural_compute.rad.utils.radiancescene import RadianceScene
+from procedural_compute.core.utils.subprocesses import waitSTDOUT
+from procedural_compute.sun.utils.timeFrameSync import frameToTime
+from procedural_compute.rad.utils.radiancescene import RadianceScene, afterStaticOctree
+
+
+def caseDir():
+    return bpy.path.abspath(bpy.context.scene.RAD.caseDir)
 
 
 class SCENE_OT_radanimation(bpy.types.Operator):
@@ -29,7 +36,7 @@ class SCENE_OT_radanimation(bpy.types.Operator):
         sc = bpy.context.scene
         # Back up the current frame position
         orgFrame = sc.frame_current
-        # Do the sequence export
+        # Do the sequence export (the static geometry is frozen into one octree for all frames)
         RadianceScene().exportStaticObjects(name="%s.rad"%(sc.name))
         text = ""
         for frame in range(sc.frame_start, sc.frame_end+1, sc.RAD.Sequence.sequstep):
@@ -52,7 +59,7 @@ class SCENE_OT_radanimation(bpy.types.Operator):
         # Open the list of commands to execute for the sequence and run them
         f = open(commands,'r')
         for cmd in f.readlines():
-            queue_fun("rpict", waitSTDOUT, (cmd, caseDir()))
+            afterStaticOctree(caseDir(), queue_fun, "rpict", waitSTDOUT, (cmd, caseDir()))
         f.close()
         return{'FINISHED'}
 
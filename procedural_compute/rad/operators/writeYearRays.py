@@ -7,12 +7,14 @@
 ###########################################################
 
 import bpy
+import os
 from procedural_compute.core.utils.threads import queue_fun
-from procedural_compute.core.utils.subprocesses import waitSTDOUT, waitOUTPUT
-from procedural_compute.sun.utils.timeFrameSync import frameToTime, getTimeStamp
-from procedural_compute.sun.utils.suncalcs import Solar_Pos
+from procedural_compute.rad.utils.rtrace import rtrace
+from procedural_compute.rad.utils.hdr import writeHDR
+from procedural_compute.sun.utils.timeFrameSync import getTimeStamp
+from procedural_compute.sun.utils.suntable import scene_sun_table
 
-from math import degrees, radians, sin, cos, tan
+import numpy as np
 
 
 def caseDir():
@@ -25,7 +27,6 @@ class SCENE_OT_writeYearRays(bpy.types.Operator):
     bl_description = "Calc Annual Solar Exposure"
 
     def execute(self, context):
-        self.writeYearRays()
         self.calcYearRays()
         return{'FINISHED'}
 
@@ -38,48 +39,32 @@ class SCENE_OT_writeYearRays(bpy.types.Operator):
         return bpy.path.abspath("%s/%s"%(sc.RAD.caseDir, s))
 
     def calcYearRays(self):
-        sc = bpy.context.scene
-        (nDays, nFrames) = self.writeYearRays()
+        rays = self.yearRays()
         for o in bpy.context.selected_objects:
             timestamp = getTimeStamp()
-            if not 'Windows' in bpy.app.build_platform.decode():
-                cmd = "cat yearRays | rcalc -e '$1=%f' -e '$2=%f' -e '$3=%f' -e '$4=$1' -e '$5=$2' -e '$6=$3'"%(o.location[0],o.location[1],o.location[2])
-            else:
-                cmd = "cat yearRays | rcalc -e \"$1=%f\" -e \"$2=%f\" -e \"$3=%f\" -e \"$4=$1\" -e \"$5=$2\" -e \"$6=$3\""%(o.location[0],o.location[1],o.location[2])
-            cmd += " | rtrace -ab 0 -h+ -ov -fac -x %u -y %u octrees/%s.oct "%(nFrames,nDays,timestamp)
-            cmd += " | pfilt -h 20 -n 0 -p 1 -r 1 > images/yearTrace_temp.hdr "
-            cmd += " && protate images/yearTrace_temp.hdr images/yearTrace_%s.hdr && rm -v images/yearTrace_temp.hdr"%(o.name)
-            queue_fun("rtrace", waitSTDOUT, (cmd, caseDir()))
+            origin = tuple(o.location)
+            job = ("octrees/%s.oct"%(timestamp), origin, rays, "images/yearTrace_%s.hdr"%(o.name), caseDir())
+            queue_fun("rtrace", traceYear, job)
         return
 
-    def writeYearRays(self):
+    def yearRays(self):
         sc = bpy.context.scene
-        b = sc.ODS_SUN
+        # One ray per frame (1 to 24*solarDT) for each day of the year
+        return scene_sun_table(sc).rays()[:, 1:]
 
-        f = open( self.getFilename('yearRays'), 'w')
 
-        months = [1, 2, 3, 4, 5, 6, 7, 8, 9, 10, 11, 12]
-        days = [31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31]
-        nDays = 0
-        for month in months:
-            for day in range(days[month-1]):
-                nDays += 1
-                nFrames = 0
-                for frame in range(1, (24*b.solarDT)+1):
-                    (hour, minute) = frameToTime(frame)
-                    (az,el) = Solar_Pos(sc.Site.longitude, sc.Site.latitude, sc.Site.timezone, month, day, hour, minute)
-                    az = az + degrees(sc.Site.northAxis)
-                    if el <= 0.1:
-                        x=0.0;y=0.0;z=-1.0;
-                    elif el >= 89.9:
-                        x=0.0;y=0.0;z=1.0;
-                    else:
-                        x = sin(radians(az))
-                        y = cos(radians(az))
-                        z = tan(radians(el))
-                    f.write( "%f %f %f\n"%(x, y, z) )
-                    nFrames += 1
-        f.close()
-        return (nDays, nFrames)
+def traceYear(octree, origin, rays, outfile, cwd):
+    """ Direct sun from origin over the year as a (frames, days, 3) array
+    (first frame at the top, 1st January on the right), written to outfile.
+    The pixels are the traced values themselves: unlike the former pfilt -r 1
+    pass there is no Gaussian filter (which blurred the sun of each frame and
+    day into its neighbours) and no auto-exposure (EXPOSURE header).
+    """
+    (nDays, nFrames) = rays.shape[:2]
+    values = rtrace(octree, origin, rays.reshape(-1, 3), args="-ab 0", outputs="v", cwd=cwd)
+    # Days down and frames across, rotated 90 degrees clockwise (as protate)
+    image = np.rot90(values.reshape(nDays, nFrames, 3), -1)
+    writeHDR(os.path.join(cwd, outfile), image)
+    return image
 
 bpy.utils.register_class(SCENE_OT_writeYearRays)
@@ -18,7 +18,7 @@ from .image import imageprops
 
 
 def setQueue(self, context):
-    threads.queues["rpict"].maxsize = self.nproc
+    threads.get_pool("rpict").resize(self.nproc)
     return None
 
 
@@ -49,6 +49,7 @@ class imageprops(bpy.types.PropertyGroup):
         row = layout.row()
         row.operator("image.falsecolor", text="Make").command="falsecolor"
         row.operator("image.falsecolor", text="Reload").command="load"
+        layout.row().operator("image.falsecolor", text="Make All In Folder").command="falsecolorFolder"
 
     def drawBatch(self, layout):
         row = layout.row()
@@ -9,10 +9,18 @@
 
 import bpy
 import os
+import numpy as np
 from math import pi, tan, atan2
 
 from procedural_compute.sun.utils.timeFrameSync import getTimeStamp
 from procedural_compute.rad.utils.radUtils import formatName
+from procedural_compute.core.utils.triangles import objectTriangles
+
+# Number of triangles formatted per write when exporting geometry
+CHUNK_SIZE = 65536
+
+# A triangle polygon (after the "material polygon object_face-" prefix)
+TRIANGLE = "%d\n0\n0\n9\n    %f  %f  %f\n    %f  %f  %f\n    %f  %f  %f\n"
 
 class ExportBase():
 
@@ -74,40 +82,44 @@ class ExportBase():
             text += "    %f  %f  %f\n"%(v[0], v[1], v[2])
         return text
 
-    def writeTriangles(self, obj, matname):
+    def meshTriangles(self, obj):
+        """ World-space triangles of the object as an (N, 3, 3) float32 array
+        (None if it has no mesh)
+        """
         if not obj.type == 'MESH':
-            return ""
-
+            return None
         if len(obj.data.polygons) == 0:
-            return ''
-
-        # Get mesh in global coordinates
-        try:
-            me = obj.to_mesh()
-        except RuntimeError:
-            return ""
-
-        me.transform(obj.matrix_world)
-        vertices = me.vertices
+            return None
+        return objectTriangles(obj)
 
-        poly_text = ''
-        index = 0
-        me.calc_loop_triangles()
-        for face in me.loop_triangles:
-            face_vertex_coords = [vertices[index].co.copy() for index in face.vertices]
-            tris = self.faceToTriangles(face_vertex_coords)
+    def iterTriangles(self, tris, matname, obj_name):
+        """ Yield the Radiance polygons of the triangles in chunks of text
+        """
+        # The names are the same for every polygon so put them in the template
+        prefix = ("\n%s polygon %s_face-" % (matname, obj_name)).replace('%', '%%')
+        template = prefix + TRIANGLE
+        for start in range(0, len(tris), CHUNK_SIZE):
+            chunk = tris[start:start + CHUNK_SIZE]
+            rows = np.empty((len(chunk), 10))
+            rows[:, 0] = np.arange(start, start + len(chunk))
+            rows[:, 1:] = chunk.reshape(-1, 9)
+            yield (template * len(rows)) % tuple(rows.ravel().tolist())
 
-            # Write faces to text
-            for tri in tris:
-                poly_text += self.triString(tri, matname, obj.name, index)
-                index += 1
-        return poly_text
+    def writeTriangles(self, obj, matname):
+        tris = self.meshTriangles(obj)
+        if tris is None:
+            return ""
+        return "".join(self.iterTriangles(tris, matname, obj.name))
 
     def exportObject(self, obj, matname="ods_default_material"):
-        # Get text to write for triangulated face of each object
-        text = self.writeTriangles(obj, formatName(matname))
+        # Stream the text for the triangulated faces of the object to its file
         filename = self.getFilename('objects/%s.rad'%(obj.name))
-        self.createFile(filename, text)
+        self.createDir(os.path.dirname(filename))
+        tris = self.meshTriangles(obj)
+        with open(filename, 'w') as f:
+            if tris is not None:
+                for chunk in self.iterTriangles(tris, formatName(matname), obj.name):
+                    f.write(chunk)
         return None
 
     def exportmesh(self, obj):
@@ -0,0 +1,253 @@
+###########################################################
+# Blender Addon for Procedural Cloud-based Design Tools
+# Copyright (C) 2020, Procedural (ApS) Denmark
+# License : procedural.build license
+# Version : 1.2
+# Web     : www.procedural.build
+###########################################################
+
+"""
+False colour and threshold images of Radiance pictures, computed in one pass
+over the decoded image rather than through pcomb/pcompos/psign pipelines.
+
+The mapping follows Radiance's falsecolor script: the luminance (x mult) is
+divided by the scale, optionally mapped over log decades, and coloured with
+the def_red/def_grn/def_blu colour scale.  Contour lines or bands show the
+original picture (or the overlay picture) between them.  The legend colour
+bar, label and values are drawn in memory to the left of the image.
+
+Only numpy is needed (no Blender) so the functions can run on worker threads.
+"""
+
+import glob
+import os
+import re
+import numpy as np
+
+from procedural_compute.core.utils import threads
+from procedural_compute.rad.utils.hdr import readRGBE, rgbeToFloat, luminance, writeHDR
+
+# def_red/def_grn/def_blu from Radiance's falsecolor (23 points over v = 0 to 1)
+DEF_RED = np.array([
+    0.18848, 0.05468174, 0.00103547, 8.311144e-08, 7.449763e-06, 0.0004390987, 0.001367254,
+    0.003076, 0.01376382, 0.06170773, 0.1739422, 0.2881156, 0.3299725,
+    0.3552663, 0.372552, 0.3921184, 0.4363976, 0.6102754, 0.7757267,
+    0.9087369, 1, 1, 0.9863])
+DEF_GRN = np.array([
+    0.0009766, 2.35501e-05, 0.0008966244, 0.0264977, 0.1256843, 0.2865799, 0.4247083, 0.4739468,
+    0.4402732, 0.3671876, 0.2629843, 0.1725325, 0.1206819, 0.07316644,
+    0.03761026, 0.01612362, 0.004773749, 6.830967e-06, 0.00803605,
+    0.1008085, 0.3106831, 0.6447838, 0.9707])
+DEF_BLU = np.array([
+    0.2666, 0.3638662, 0.4770437, 0.5131397, 0.5363797, 0.5193677, 0.4085123, 0.1702815, 0.05314236,
+    0.05194055, 0.08564082, 0.09881395, 0.08324373, 0.06072902,
+    0.0391076, 0.02315354, 0.01284458, 0.005184709, 0.001691774,
+    2.432735e-05, 1.212949e-05, 0.006659406, 0.02539])
+STEP = 0.0454545
+
+# 5x7 bitmap glyphs for the legend text (lower case is drawn as upper case)
+GLYPHS = {
+    '0': "01110 10001 10011 10101 11001 10001 01110", '1': "00100 01100 00100 00100 00100 00100 01110",
+    '2': "01110 10001 00001 00010 00100 01000 11111", '3': "11111 00010 00100 00010 00001 10001 01110",
+    '4': "00010 00110 01010 10010 11111 00010 00010", '5': "11111 10000 11110 00001 00001 10001 01110",
+    '6': "00110 01000 10000 11110 10001 10001 01110", '7': "11111 00001 00010 00100 01000 01000 01000",
+    '8': "01110 10001 10001 01110 10001 10001 01110", '9': "01110 10001 10001 01111 00001 00010 01100",
+    '.': "00000 00000 00000 00000 00000 01100 01100", '-': "00000 00000 00000 11111 00000 00000 00000",
+    '+': "00000 00100 00100 11111 00100 00100 00000", '%': "11000 11001 00010 00100 01000 10011 00011",
+    '/': "00000 00001 00010 00100 01000 10000 00000", ' ': "00000 00000 00000 00000 00000 00000 00000",
+    'A': "01110 10001 10001 11111 10001 10001 10001", 'B': "11110 10001 10001 11110 10001 10001 11110",
+    'C': "01110 10001 10000 10000 10000 10001 01110", 'D': "11100 10010 10001 10001 10001 10010 11100",
+    'E': "11111 10000 10000 11110 10000 10000 11111", 'F': "11111 10000 10000 11110 10000 10000 10000",
+    'G': "01110 10001 10000 10111 10001 10001 01111", 'H': "10001 10001 10001 11111 10001 10001 10001",
+    'I': "01110 00100 00100 00100 00100 00100 01110", 'J': "00111 00010 00010 00010 00010 10010 01100",
+    'K': "10001 10010 10100 11000 10100 10010 10001", 'L': "10000 10000 10000 10000 10000 10000 11111",
+    'M': "10001 11011 10101 10101 10001 10001 10001", 'N': "10001 10001 11001 10101 10011 10001 10001",
+    'O': "01110 10001 10001 10001 10001 10001 01110", 'P': "11110 10001 10001 11110 10000 10000 10000",
+    'Q': "01110 10001 10001 10001 10101 10010 01101", 'R': "11110 10001 10001 11110 10100 10010 10001",
+    'S': "01111 10000 10000 01110 00001 00001 11110", 'T': "11111 00100 00100 00100 00100 00100 00100",
+    'U': "10001 10001 10001 10001 10001 10001 01110", 'V': "10001 10001 10001 10001 10001 01010 00100",
+    'W': "10001 10001 10001 10101 10101 10101 01010", 'X': "10001 10001 01010 00100 01010 10001 10001",
+    'Y': "10001 10001 10001 01010 00100 00100 00100", 'Z': "11111 00001 00010 00100 01000 10000 11111",
+}
+GLYPHS = {k: np.array([[c == '1' for c in row] for row in v.split()]) for (k, v) in GLYPHS.items()}
+
+
+def settings(p):
+    """ A plain dict of the falsecolor properties (RAD.falsecolor) for the worker threads
+    """
+    return {
+        'mult': p.mult, 'scale': p.scale, 'ndivs': p.ndivs, 'decades': p.decades,
+        'contours': p.contours, 'label': p.label, 'legwidth': p.legwidth, 'legheight': p.legheight,
+        'overlay': p.overlaypic,
+    }
+
+
+def colorScale(v):
+    """ (..., 3) def_red/def_grn/def_blu colours of values v (0 to 1)
+    """
+    x = np.asarray(v, dtype=np.float64) / STEP
+    i = np.arange(len(DEF_RED))
+    return np.clip(np.stack([np.interp(x, i, DEF_RED), np.interp(x, i, DEF_GRN), np.interp(x, i, DEF_BLU)], axis=-1), 0, 1)
+
+
+def mapValues(x, decades):
+    """ Map scaled values onto the colour scale (over log decades if decades > 0)
+    """
+    if not decades:
+        return x
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(x > 10.0**-decades, np.log10(x) / decades + 1, 0.0)
+
+
+def unmapValue(y, decades):
+    return 10**((y - 1) * decades) if decades else y
+
+
+def contourMask(v, ndivs, contours, vleft=None, vright=None, vabove=None, vbelow=None):
+    """ Where the colour scale is drawn (the rest shows the background picture)
+    """
+    inside = (v >= 0) & (v < 1)
+    if contours == "Lines":
+        def level(a):
+            return np.floor(ndivs * a + .5)
+        return inside & ((level(vleft) != level(vright)) | (level(vabove) != level(vbelow)))
+    if contours == "Bands":
+        f = ndivs * v - np.floor(ndivs * v)
+        return inside & (f >= .4) & (f < .6)
+    return np.ones(v.shape, dtype=bool)
+
+
+def neighbours(a):
+    """ The (left, right, above, below) neighbours of each pixel (edges repeated)
+    """
+    p = np.pad(a, 1, mode='edge')
+    return (p[1:-1, :-2], p[1:-1, 2:], p[:-2, 1:-1], p[2:, 1:-1])
+
+
+def falsecolorImage(rgb, background, mult=179.0, scale=0.0, ndivs=8, decades=0, contours="None"):
+    """ False colour (scanlines, length, 3) image.  Returns (image, scale)
+    where scale is the (auto-scaled if 0) top of the legend.
+    """
+    lum = luminance(rgb) * mult
+    if not scale:
+        scale = float(lum.max()) or 1.0
+    x = lum / scale
+    v = mapValues(x, decades)
+    if contours == "Lines":
+        mask = contourMask(v, ndivs, contours, *[mapValues(n, decades) for n in neighbours(x)])
+    else:
+        mask = contourMask(v, ndivs, contours)
+    image = np.where(mask[..., None], colorScale(v), background)
+    return (image.astype(np.float32), scale)
+
+
+def formatValue(value):
+    # As the falsecolor script: rcalc output truncated to 3 decimal places
+    return re.sub(r'(\.[0-9]{3})[0-9]*', r'\1', "%.7g" % value)
+
+
+def drawText(canvas, text, x, y, size, color=(1.0, 1.0, 1.0), shadow=(0.0, 0.0, 0.0)):
+    """ Draw text with its top left corner at pixel (x, y) of the canvas rows
+    """
+    for char in text.upper():
+        glyph = GLYPHS.get(char, GLYPHS[' ']).repeat(size, axis=0).repeat(size, axis=1)
+        for (offset, c) in ((1, shadow), (0, color)):
+            (y0, x0) = (y + offset, x + offset)
+            region = canvas[y0:y0 + glyph.shape[0], x0:x0 + glyph.shape[1]]
+            region[glyph[:region.shape[0], :region.shape[1]]] = c
+        x += 6 * size
+    return x
+
+
+def legendImage(scale, ndivs=8, decades=0, contours="None", label="", width=100, height=200):
+    """ The legend: a colour bar (height rows) with the value of each division
+    and a row for the label on top
+    """
+    rowHeight = int(np.floor(height / ndivs + .5))
+    legend = np.zeros((height + rowHeight, width, 3), dtype=np.float32)
+
+    # Colour bar, with v from 1 at the top to 0 at the bottom
+    y = np.arange(height)[::-1, None] * np.ones((1, width))
+    v = (y + .5) / height
+    mask = contourMask(v, ndivs, contours, v, v, (y + 1.5) / height, (y - .5) / height)
+    legend[rowHeight:] = np.where(mask[..., None], colorScale(v), 0.0)
+
+    # Label and division values
+    size = max(1, (rowHeight - 2) // 8)
+    margin = max(0, (rowHeight - 7 * size) // 2)
+    drawText(legend, label, 2, margin, size)
+    for i in range(ndivs):
+        value = scale * unmapValue((ndivs - .5 - i) / ndivs, decades)
+        drawText(legend, formatValue(value), 2, rowHeight * (i + 1) + margin, size)
+    return legend
+
+
+def compose(legend, image):
+    """ Legend to the left of the image, both aligned to the bottom
+    """
+    height = max(legend.shape[0], image.shape[0])
+    out = np.zeros((height, legend.shape[1] + image.shape[1], 3), dtype=np.float32)
+    out[height - legend.shape[0]:, :legend.shape[1]] = legend
+    out[height - image.shape[0]:, legend.shape[1]:] = image
+    return out
+
+
+def falsecolor(filepath, outpath, mult=179.0, scale=0.0, ndivs=8, decades=0, contours="None",
+               label="", legwidth=100, legheight=200, overlay=""):
+    """ Write the false colour picture (with legend) of a picture.  Returns the scale.
+    """
+    (info, rgbe) = readRGBE(filepath)
+    rgb = rgbeToFloat(rgbe, info)
+    # The background is the picture (or overlay) as stored, like ri() in pcomb
+    background = rgbeToFloat(rgbe)
+    if overlay and os.path.isfile(overlay):
+        (oinfo, orgbe) = readRGBE(overlay)
+        if orgbe.shape == rgbe.shape:
+            background = rgbeToFloat(orgbe)
+        else:
+            print("Overlay picture %s does not match the size of %s. Ignoring it"%(overlay, filepath))
+
+    (image, scale) = falsecolorImage(rgb, background, mult, scale, ndivs, decades, contours)
+    if legwidth > 20 and legheight > 40:
+        image = compose(legendImage(scale, ndivs, decades, contours, label, legwidth, legheight), image)
+    writeHDR(outpath, image)
+    return scale
+
+
+def threshold(filepath, outpath, mult=179.0, limit=500.0, exposure=-4):
+    """ Write the picture with the pixels below the limit blacked out (at the
+    exposure in f-stops).  Returns the percentage of pixels below the limit.
+    """
+    (info, rgbe) = readRGBE(filepath)
+    rgb = rgbeToFloat(rgbe, info)
+    lum = luminance(rgb)
+    above = lum * mult > limit
+    percentage = 100.0 * (lum.size - np.count_nonzero(above)) / lum.size
+    # As pcompos -t limit/mult (transparent below the limit) then pfilt -e exposure
+    factor = 2.0 ** exposure
+    writeHDR(outpath, np.where((lum >= limit / mult)[..., None], rgb * factor, 0.0), exposure=factor)
+    return percentage
+
+
+def falsecolorFolder(folder, outdir, pattern="*.hdr", exclude=(), pool="stats", **kwargs):
+    """ False colour every picture in the folder into outdir, each as a one
+    core job of the pool.  Pictures in outdir and those named in exclude (eg.
+    the falsecolor/threshold output) are skipped.  Returns a dict of
+    {filepath: scale or error}.
+    """
+    os.makedirs(outdir, exist_ok=True)
+    skip = set(os.path.basename(e) for e in exclude)
+    files = [f for f in sorted(glob.glob(os.path.join(folder, pattern)))
+             if os.path.dirname(os.path.abspath(f)) != os.path.abspath(outdir) and os.path.basename(f) not in skip]
+    jobs = {f: threads.submit(pool, falsecolor, f, os.path.join(outdir, os.path.basename(f)), cores=1, **kwargs) for f in files}
+    results = {}
+    for (f, job) in jobs.items():
+        try:
+            results[f] = job.result()
+        except Exception as err:
+            results[f] = err
+    failed = [f for (f, r) in results.items() if isinstance(r, Exception)]
+    for f in failed:
+        print("Could not make false colour image of %s: %s"%(f, results[f]))
+    print("Wrote %i false colour images to %s (%i failed)"%(len(results) - len(failed), outdir, len(failed)))
+    return results
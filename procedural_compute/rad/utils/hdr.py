@@ -0,0 +1,295 @@
+###########################################################
+# Blender Addon for Procedural Cloud-based Design Tools
+# Copyright (C) 2020, Procedural (ApS) Denmark
+# License : procedural.build license
+# Version : 1.2
+# Web     : www.procedural.build
+###########################################################
+
+"""
+Reader for Radiance HDR (RGBE) pictures, flat or run-length encoded, and
+single-pass image statistics.  Only numpy is needed (no Blender), and the
+decoding is done in numpy, so pictures can be read in parallel by threads.
+
+Pixel values are the original (pvalue -o) radiances, ie. with any EXPOSURE
+and COLORCORR in the header undone.
+"""
+
+import mmap
+import numpy as np
+
+# Luminous efficacy and RGB weights used by the Radiance tools (pvalue | rcalc)
+EFFICACY = 179.0
+LUMINANCE_WEIGHTS = np.array([0.265, 0.67, 0.065])
+
+
+class HDRError(Exception):
+    pass
+
+
+def readHeader(data):
+    """ Parse the header and resolution string of the picture.  Returns a
+    tuple (info, shape, offset) where shape is (scanlines, scanline length)
+    and offset is the index of the first pixel byte.
+    """
+    end = data.find(b"\n\n")
+    if end < 0 or not (data[:10] == b"#?RADIANCE" or data[:6] == b"#?RGBE"):
+        raise HDRError("Not a Radiance picture")
+    info = {'exposure': 1.0, 'colorcorr': np.ones(3), 'format': '32-bit_rle_rgbe'}
+    for line in bytes(data[:end]).decode('ascii', 'replace').splitlines():
+        (key, _, value) = line.partition('=')
+        key = key.strip().upper()
+        if key == 'FORMAT':
+            info['format'] = value.strip()
+        elif key == 'EXPOSURE':
+            info['exposure'] *= float(value)
+        elif key == 'COLORCORR':
+            info['colorcorr'] *= np.array([float(v) for v in value.split()[:3]])
+    if info['format'] != '32-bit_rle_rgbe':
+        raise HDRError(f"Unsupported picture format: {info['format']}")
+
+    start = end + 2
+    eol = data.find(b"\n", start)
+    resolution = bytes(data[start:eol]).decode('ascii').split()
+    if len(resolution) != 4:
+        raise HDRError("Bad resolution string")
+    info['resolution'] = ' '.join(resolution)
+    shape = (int(resolution[1]), int(resolution[3]))
+    return (info, shape, eol + 1)
+
+
+def decodeScanlines(data, offset, shape):
+    """ Decode the RGBE bytes of the picture into a (scanlines, length, 4) uint8 array
+    """
+    (nlines, width) = shape
+    npixels = nlines * width
+    # Flat pictures (and scanlines too short or long to encode) map straight onto the file
+    if width < 8 or width > 0x7fff or data[offset] != 2 or data[offset+1] != 2 or data[offset+2] & 0x80:
+        if len(data) - offset >= 4*npixels and not _hasOldRuns(data, offset, npixels):
+            return np.frombuffer(data, dtype=np.uint8, count=4*npixels, offset=offset).reshape(nlines, width, 4)
+        return _decodeOld(data, offset, shape)
+
+    return _decodeRLE(data, offset, shape)
+
+
+def _decodeRLE(data, offset, shape):
+    """ New-style run-length pictures: every scanline starts (2, 2, length) and
+    then has its four components one after another, each as runs of
+    (128 + n, value) repeats or (n, n values) literals.
+
+    The runs are found for all the scanlines at once: every place the
+    scanline header appears is walked in step (one run per iteration, so
+    there are only as many iterations as the longest scanline has runs), the
+    true scanlines are then the chain of starts from the first one, and
+    their runs are expanded in one gather.
+    """
+    (nlines, width) = shape
+    b = np.frombuffer(data, dtype=np.uint8, offset=offset)
+    # A zero count past the end stops any walk that runs off the data
+    padded = np.concatenate((b, np.zeros(1, dtype=np.uint8)))
+    starts = np.flatnonzero(b[:-3] == 2)
+    starts = starts[(b[starts + 1] == 2) & (b[starts + 2] == width >> 8) & (b[starts + 3] == width & 0xff)]
+    if len(starts) == 0 or starts[0] != 0:
+        raise HDRError("Bad run-length encoded scanline 0")
+
+    pos = starts + 4
+    component = np.zeros(len(starts), dtype=np.intp)
+    remaining = np.full(len(starts), width, dtype=np.intp)
+    active = np.ones(len(starts), dtype=bool)
+    valid = np.ones(len(starts), dtype=bool)
+    (positions, running) = ([], [])
+    while active.any():
+        code = padded[np.minimum(pos, len(b))].astype(np.intp)
+        repeat = code > 128
+        count = np.where(repeat, code - 128, code)
+        bad = active & ((count == 0) | (count > remaining))
+        valid &= ~bad
+        active &= ~bad
+        positions.append(pos.copy())
+        running.append(active.copy())
+        remaining -= np.where(active, count, 0)
+        pos += np.where(active, np.where(repeat, 2, 1 + code), 0)
+        ended = active & (remaining == 0)
+        component += ended
+        remaining[ended] = width
+        active &= component < 4
+
+    # Follow the scanlines from the first, each starting where the last ended
+    column = {start: i for (i, start) in enumerate(starts.tolist())}
+    ends = pos.tolist()
+    lines = []
+    start = 0
+    for line in range(nlines):
+        i = column.get(start)
+        if i is None or not valid[i]:
+            raise HDRError(f"Bad run-length encoded scanline {line}")
+        lines.append(i)
+        start = ends[i]
+    if start > len(b):
+        raise HDRError("Picture data is truncated")
+
+    # The runs of the scanlines in file order...
+    positions = np.array(positions)[:, lines].T
+    runs = positions[np.array(running)[:, lines].T]
+    code = b[runs].astype(np.intp)
+    literal = code <= 128
+    counts = np.where(literal, code, code - 128)
+    # ...expanded with one repeat of the encoded bytes: run codes and scanline
+    # headers are dropped, literal bytes are kept once and repeat values
+    # count times
+    # (a literal ends on the next run's code, so never where another starts)
+    times = np.zeros(len(b) + 1, dtype=np.intp)
+    times[runs[literal] + 1] = 1
+    times[runs[literal] + 1 + counts[literal]] = -1
+    times = np.cumsum(times[:-1])
+    times[runs[~literal] + 1] = counts[~literal]
+    # Components are planar per scanline
+    return np.repeat(b, times).reshape(nlines, 4, width).transpose(0, 2, 1)
+
+
+def _hasOldRuns(data, offset, npixels):
+    """ Old-style run-length pictures repeat the previous pixel with (1, 1, 1, n) markers
+    """
+    pixels = np.frombuffer(data, dtype=np.uint8, count=4*npixels, offset=offset).reshape(-1, 4)
+    return bool(np.any((pixels[:, 0] == 1) & (pixels[:, 1] == 1) & (pixels[:, 2] == 1)))
+
+
+def _decodeOld(data, offset, shape):
+    npixels = shape[0] * shape[1]
+    out = np.empty((npixels, 4), dtype=np.uint8)
+    pos = offset
+    n = 0
+    shift = 0
+    while n < npixels:
+        pixel = data[pos:pos+4]
+        if len(pixel) < 4:
+            raise HDRError("Picture data is truncated")
+        pos += 4
+        if pixel[0] == 1 and pixel[1] == 1 and pixel[2] == 1:
+            count = pixel[3] << shift
+            out[n:n+count] = out[n-1]
+            n += count
+            shift += 8
+        else:
+            out[n] = tuple(pixel)
+            n += 1
+            shift = 0
+    return out.reshape(shape[0], shape[1], 4)
+
+
+def readRGBE(filename):
+    """ Read a Radiance picture.  Returns (info, rgbe) where rgbe is a
+    (scanlines, length, 4) uint8 array in file order.
+    """
+    with open(filename, 'rb') as f:
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            (info, shape, offset) = readHeader(data)
+            error = None
+            try:
+                rgbe = decodeScanlines(data, offset, shape)
+                # Copy out of the map (and release the view) before it is closed
+                image = np.array(rgbe)
+                del rgbe
+            except (HDRError, IndexError) as e:
+                # Raised once the traceback (and its views of the map) is gone
+                error = f"{filename}: {e}"
+    if error is not None:
+        raise HDRError(error)
+    return (info, image)
+
+
+def rgbeToFloat(rgbe, info=None):
+    """ (..., 3) float32 radiances of RGBE pixels (as Radiance's colr_color)
+    """
+    e = rgbe[..., 3].astype(np.int32)
+    f = np.where(e > 0, np.ldexp(1.0, e - (128 + 8)), 0.0).astype(np.float32)
+    rgb = (rgbe[..., :3].astype(np.float32) + 0.5) * f[..., None]
+    if info is not None:
+        rgb /= (info['exposure'] * info['colorcorr']).astype(np.float32)
+    return rgb
+
+
+def readHDR(filename):
+    """ Read a Radiance picture as (info, (scanlines, length, 3) float32 radiances)
+    """
+    (info, rgbe) = readRGBE(filename)
+    return (info, rgbeToFloat(rgbe, info))
+
+
+def luminance(rgb):
+    return rgb @ LUMINANCE_WEIGHTS.astype(np.float32)
+
+
+def imageStats(filename, mult=EFFICACY, limit=0.0, percentiles=(50, 95)):
+    """ Statistics of the luminance (x mult) of a picture in one pass:
+        pixels   = total number of pixels
+        nonzero  = number of pixels with a positive value
+        mean     = mean over the non-zero pixels
+        limit    = fraction of the non-zero pixels above the limit
+        p<N>     = percentiles of the non-zero pixels
+    """
+    (info, rgb) = readHDR(filename)
+    values = luminance(rgb).ravel() * mult
+    positive = values[values > 0]
+    pixels = values.size
+    nonzero = positive.size
+    stats = {
+        'pixels': pixels,
+        'nonzero': nonzero,
+        'mean': float(positive.sum(dtype=np.float64) / nonzero) if nonzero else 0.0,
+        'limit': float(np.count_nonzero(values > limit) / nonzero) if nonzero else 0.0,
+    }
+    quantiles = np.percentile(positive, percentiles) if nonzero else np.zeros(len(percentiles))
+    for (p, q) in zip(percentiles, quantiles):
+        stats['p%g' % p] = float(q)
+    return stats
+
+
+def floatToRGBE(rgb):
+    """ (..., 4) uint8 RGBE pixels of float radiances (as Radiance's setcolr)
+    """
+    rgb = np.asarray(rgb, dtype=np.float64)
+    m = rgb.max(axis=-1)
+    (mantissa, exponent) = np.frexp(m)
+    valid = m > 1e-32
+    d = np.divide(mantissa * 256.0, m, out=np.zeros_like(m), where=valid)
+    rgbe = np.zeros(rgb.shape[:-1] + (4,), dtype=np.uint8)
+    rgbe[..., :3] = np.clip(rgb * d[..., None], 0, 255).astype(np.uint8)
+    rgbe[..., 3] = np.where(valid, exponent + 128, 0)
+    return rgbe
+
+
+def encodeScanlines(rgbe):
+    """ Run-length encoded scanlines of a (scanlines, length, 4) RGBE array.
+    Components are written as literal runs of up to 128 bytes (no repeats),
+    which keeps the encoding vectorized across all the scanlines.
+    """
+    (nlines, width) = rgbe.shape[:2]
+    if width < 8 or width > 0x7fff:
+        return rgbe.tobytes()
+    planar = rgbe.transpose(0, 2, 1)
+    starts = range(0, width, 128)
+    length = 4 + 4 * (len(starts) + width)
+    out = np.empty((nlines, length), dtype=np.uint8)
+    out[:, :4] = (2, 2, width >> 8, width & 0xff)
+    pos = 4
+    for component in range(4):
+        for start in starts:
+            count = min(128, width - start)
+            out[:, pos] = count
+            out[:, pos+1:pos+1+count] = planar[:, component, start:start+count]
+            pos += 1 + count
+    return out.tobytes()
+
+
+def writeHDR(filename, rgb, exposure=None):
+    """ Write (scanlines, length, 3) radiances (top scanline first) as a Radiance picture
+    """
+    (nlines, width) = rgb.shape[:2]
+    header = "#?RADIANCE\nFORMAT=32-bit_rle_rgbe\n"
+    if exposure is not None:
+        header += "EXPOSURE=%e\n" % exposure
+    header += "\n-Y %d +X %d\n" % (nlines, width)
+    with open(filename, 'wb') as f:
+        f.write(header.encode('ascii'))
+        f.write(encodeScanlines(floatToRGBE(rgb)))
@@ -9,9 +9,8 @@
 
 import bpy
 import os
-from math import degrees
 
-from procedural_compute.sun.utils.suncalcs import Solar_Pos
+from procedural_compute.sun.utils.suntable import scene_sun_table
 from procedural_compute.rad.utils.exportbase import ExportBase
 from procedural_compute.rad.utils.material import MaterialContext
 
@@ -20,8 +19,7 @@ class RadianceSky(ExportBase):
     def export(self, hour, minute, name):
         sc = bpy.context.scene
         b = sc.ODS_SUN
-        (az,el) = Solar_Pos(sc.Site.longitude, sc.Site.latitude, sc.Site.timezone, b.month, b.day, hour, minute)
-        az = az + degrees(sc.Site.northAxis)
+        (az,el) = scene_sun_table(sc).position(b.month, b.day, hour, minute)
         text = "!gensky -ang %.3f %.3f "%(el, az+180.0)
 
         text += " %s -g 0.2 -t 1.7\n"%(sc.RAD.skytype)
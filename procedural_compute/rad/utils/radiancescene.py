@@ -8,12 +8,91 @@
 
 
 import bpy
+import glob
+import os
+import re
 
+from procedural_compute.core.utils import threads
+from procedural_compute.core.utils.subprocesses import waitSTDOUT
 from procedural_compute.sun.utils.timeFrameSync import getTimeStamp
 from procedural_compute.rad.utils.radiance_entities import RadianceSky
 from procedural_compute.rad.utils.material import MaterialContext
 from procedural_compute.rad.utils.exportbase import ExportBase
 
+# The queued static octree job of each case (see afterStaticOctree)
+freezing = {}
+
+
+def rifScene(timestamp, base=None):
+    """ The scene of a frame's rif file: its sky added to the frozen static
+    octree base, or (without one) the whole scene of the frame
+    """
+    if base is None:
+        return "scene=        %s.rad\n"%(timestamp)
+    return "scene=        skies/%s.sky\noconv=        -i %s\n"%(timestamp, base)
+
+
+def rifFiles(cwd, base):
+    """ {rif file: its frame octree} of the frames of the case built on base
+    """
+    rifs = {}
+    for rif in glob.glob(os.path.join(cwd, "*.rif")):
+        with open(rif) as f:
+            text = f.read()
+        octree = re.search(r"^OCTREE=\s*(\S+)", text, flags=re.MULTILINE)
+        if octree and re.search(r"^oconv=\s*-i\s+%s\s*$"%(re.escape(base)), text, flags=re.MULTILINE):
+            rifs[rif] = octree.group(1)
+    return rifs
+
+
+def buildStaticOctree(name, base, cwd):
+    """ Compile the static scene into the frozen octree base (via a temporary
+    file, so a failed oconv never leaves a broken base) and remove the frame
+    octrees that were built on the previous one.
+    """
+    tmp = "%s.tmp"%(base)
+    returncode = waitSTDOUT("oconv -f %s > %s"%(name, tmp), cwd)
+    if returncode != 0:
+        if os.path.exists(os.path.join(cwd, tmp)):
+            os.remove(os.path.join(cwd, tmp))
+        if not os.path.exists(os.path.join(cwd, base)):
+            # Without a base the frames compile their whole scene again
+            for rif in rifFiles(cwd, base):
+                timestamp = os.path.splitext(os.path.basename(rif))[0]
+                with open(rif) as f:
+                    text = f.read().replace(rifScene(timestamp, base), rifScene(timestamp))
+                with open(rif, 'w') as f:
+                    f.write(text)
+        raise RuntimeError("oconv -f %s failed (%s), keeping the previous %s"%(name, returncode, base))
+    os.replace(os.path.join(cwd, tmp), os.path.join(cwd, base))
+    # The frame octrees of this base are out of date (rad only checks the sky file).
+    # Other scenes of the case have their own base and frames, so are left alone.
+    baseTime = os.path.getmtime(os.path.join(cwd, base))
+    for octree in rifFiles(cwd, base).values():
+        path = os.path.join(cwd, octree)
+        if not octree.endswith("_static.oct") and os.path.isfile(path) and os.path.getmtime(path) < baseTime:
+            os.remove(path)
+    return base
+
+
+def afterStaticOctree(cwd, fn, *args, **kwargs):
+    """ Call fn(*args, **kwargs) once the queued static octree of the case has been
+    built (now if there is none), or not at all if it failed
+    """
+    job = freezing.get(cwd)
+    if job is None:
+        return fn(*args, **kwargs)
+
+    def done(job):
+        if job.cancelled() or job.exception() is not None:
+            print("Not running %s: the static octree was not built"%(getattr(fn, '__name__', fn)))
+            return None
+        fn(*args, **kwargs)
+
+    job.add_done_callback(done)
+    return None
+
+
 class RadianceScene(ExportBase):
 
     def exportFrame(self, hour, minute, writeStaticData=True):
@@ -50,8 +129,24 @@ class RadianceScene(ExportBase):
         MaterialContext().export(self.materialsList)
         # Create the master .rad file (minus the skyfile)
         self.createMainScene(self.references, name)
+        # Compile it once into the frozen octree that each frame's sky is added to
+        self.freezeOctree(name)
         return
 
+    def staticOctree(self):
+        return "octrees/%s_static.oct"%(bpy.context.scene.name)
+
+    def freezeOctree(self, name):
+        """ Queue the compilation of the static scene into a frozen octree
+        (oconv -f).  Each frame then only adds its sky to it (oconv -i)
+        rather than recompiling all of the geometry.
+        """
+        self.createDir(self.getFilename("octrees"))
+        cwd = bpy.path.abspath(bpy.context.scene.RAD.caseDir)
+        # Ahead of the frames that are queued on it
+        freezing[cwd] = threads.queue_fun("rtrace", buildStaticOctree, (name, self.staticOctree(), cwd), priority=10)
+        return freezing[cwd]
+
     def createMainScene(self, references, name):
         ref_text = "".join([r+'\n' for r in references])
         ## add materials and at top of file (sky is added later for animation compatability)
@@ -70,8 +165,13 @@ class RadianceScene(ExportBase):
         text += "OCTREE=       octrees/%s.oct\n"%(timestamp)
         text += "AMBFILE=      ambfiles/%s.amb\n"%(timestamp)
         text += "REPORT=       3 logfiles/%s.log\n"%(timestamp)
-        text += "scene=        %s.rad\n"%(timestamp)
-        text += "materials=    materials.rad\n\n"
+        # Only the sky is compiled per frame. The geometry and materials are in the frozen base octree
+        # (if it has been or is being built, otherwise rad compiles the whole frame scene)
+        cwd = bpy.path.abspath(bpy.context.scene.RAD.caseDir)
+        job = freezing.get(cwd)
+        frozen = os.path.exists(os.path.join(cwd, self.staticOctree())) or (job is not None and not job.done())
+        text += rifScene(timestamp, self.staticOctree() if frozen else None)
+        text += "\n"
         text += "render=       -av 0 0 0\n"
         text += "%s\n\n"%("".join([v + "\n" for v in self.views]))
         text += "\n"
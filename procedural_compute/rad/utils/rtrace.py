@@ -0,0 +1,78 @@
+###########################################################
+# Blender Addon for Procedural Cloud-based Design Tools
+# Copyright (C) 2020, Procedural (ApS) Denmark
+# License : procedural.build license
+# Version : 1.2
+# Web     : www.procedural.build
+###########################################################
+
+"""
+Stream rays to rtrace as binary floats (-ff/-fd) and read the binary results
+back into arrays, so ray grids are built in numpy instead of cnt | rcalc and
+the results can go straight to an image or vertex colours.
+"""
+
+import subprocess
+import threading
+import numpy as np
+
+from procedural_compute.core.utils.subprocesses import bashForWindows, waitOUTPUT
+
+# Number of values rtrace writes for each numeric output (-o) letter
+OUTPUT_WIDTHS = {'o': 3, 'd': 3, 'v': 3, 'V': 3, 'W': 3, 'p': 3, 'n': 3, 'N': 3, 'w': 1, 'l': 1, 'L': 1, 'c': 2}
+
+# Rays written to rtrace per write
+CHUNK_SIZE = 65536
+
+
+def rayArray(origins, directions, precision='f'):
+    """ (N, 6) array of origins and directions (broadcast against each other)
+    """
+    (origins, directions) = np.broadcast_arrays(np.asarray(origins), np.asarray(directions))
+    rays = np.empty(origins.shape[:-1] + (6,), dtype=np.float32 if precision == 'f' else np.float64)
+    rays[..., :3] = origins
+    rays[..., 3:] = directions
+    return rays.reshape(-1, 6)
+
+
+def rtrace(octree, origins, directions, args="", outputs="v", cwd=None, precision='f'):
+    """ Trace the rays through rtrace and return an (N, width) array of the
+    outputs (eg. 'v' gives (N, 3) values, 'pv' gives (N, 6)).  Rays with a
+    zero direction give zero results.
+    """
+    for o in outputs:
+        if o not in OUTPUT_WIDTHS:
+            raise ValueError(f"rtrace output -o{o} is not numeric")
+    width = sum(OUTPUT_WIDTHS[o] for o in outputs)
+    rays = rayArray(origins, directions, precision)
+
+    cmd = bashForWindows("rtrace -h- -f%s%s -o%s %s %s"%(precision, precision, outputs, args, octree))
+    P = subprocess.Popen(cmd, cwd=cwd, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+    # Write the rays from another thread so rtrace's output never blocks on a full pipe
+    def write():
+        try:
+            for start in range(0, len(rays), CHUNK_SIZE):
+                P.stdin.write(rays[start:start + CHUNK_SIZE].tobytes())
+        except BrokenPipeError:
+            pass
+        finally:
+            P.stdin.close()
+
+    writer = threading.Thread(target=write, daemon=True)
+    writer.start()
+    out = P.stdout.read()
+    P.wait()
+    writer.join()
+
+    values = np.frombuffer(out, dtype=rays.dtype)
+    if P.returncode != 0 or values.size != len(rays) * width:
+        raise RuntimeError(f"rtrace failed ({P.returncode}) after {values.size // width} of {len(rays)} rays: {cmd}")
+    return values.reshape(len(rays), width)
+
+
+def octreeBounds(octree, cwd=None):
+    """ (xmin, ymin, zmin, size) of the octree cube (getinfo -d)
+    """
+    (out, err) = waitOUTPUT("getinfo -d < %s"%(octree), cwd=cwd)
+    return tuple(float(v) for v in out.decode().split()[-4:])
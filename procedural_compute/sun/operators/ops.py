@@ -8,8 +8,10 @@
 
 
 import bpy
+import numpy as np
 
 from procedural_compute.core.utils.addRemoveMeshObject import addObject
+from procedural_compute.core.utils.keyframes import bakeKeyframes
 
 import procedural_compute.sun.utils.suncalcs as suncalcs
 import procedural_compute.sun.properties.scene
@@ -67,20 +69,18 @@ class calcClockHandRotation(bpy.types.Operator):
                 print("Found hourHand")
                 h = o
                 hasHourHand = True
-        # Calculate the positions
-        dt = sc.procedural_compute.sun.solarDT
-        for Hour in range(24):
-            for T in range(dt):
-                Minute = T*(60/dt)
-                sc.frame_set( timeFrameSync.timeToFrame(Hour, Minute) )
-                if hasMinuteHand:
-                    rotMin = -1.0*(Minute/60.0)*2.0*3.14159265
-                    m.rotation_euler = [0.0, 0.0, rotMin]
-                    m.keyframe_insert("rotation_euler")
-                if hasHourHand:
-                    rotHr = -1.0*(Hour/12.0)*2.0*3.14159265 + rotMin/12.0
-                    h.rotation_euler = [0.0, 0.0, rotHr]
-                    h.keyframe_insert("rotation_euler")
+        # Calculate the rotations for every timestep and bake them
+        dt = sc.ODS_SUN.solarDT
+        Hour = np.repeat(np.arange(24), dt)
+        Minute = np.tile(np.arange(dt)*(60/dt), 24)
+        frames = [timeFrameSync.timeToFrame(hr, mn) for (hr, mn) in zip(Hour, Minute)]
+        rotMin = -1.0*(Minute/60.0)*2.0*3.14159265
+        rotHr = -1.0*(Hour/12.0)*2.0*3.14159265 + rotMin/12.0
+        zeros = np.zeros(len(frames))
+        if hasMinuteHand:
+            bakeKeyframes(m, "rotation_euler", frames, np.stack([zeros, zeros, rotMin], axis=-1))
+        if hasHourHand:
+            bakeKeyframes(h, "rotation_euler", frames, np.stack([zeros, zeros, rotHr], axis=-1))
         return{'FINISHED'}
 
 bpy.utils.register_class(calcClockHandRotation)
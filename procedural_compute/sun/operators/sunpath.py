@@ -7,213 +7,190 @@
 ###########################################################
 
 import bpy
-import bgl
 import blf
+import gpu
+from gpu_extras.batch import batch_for_shader
 
-from math import radians, pi, cos, sin
-from procedural_compute.sun.utils.suncalcs import Solar_Pos, azElToXYZ, azElToPolar
+import numpy as np
+from math import pi
+from procedural_compute.sun.utils.suncalcs import az_el_to_xyz, az_el_to_polar, MONTH_START_DAYS
+from procedural_compute.sun.utils.suntable import scene_sun_table
 from procedural_compute.sun.utils.timeFrameSync import frameToTime
-import datetime
 
-points = [[(0,0,0)]*24*4]*365
-daylines = [[(0,0,0)]*24*4]*12
-loops = [[(0,0,0)]*365]*24
+# Seconds without a property change before the geometry is rebuilt (slider drags)
+DEBOUNCE = 0.15
 
-def draw_sunpath_callback(self, context):
+DAY_COLOR = (0.1, 0.4, 0.8, 0.8)
+LOOP_COLOR = (1.0, 0.8, 0.0, 1.0)
+ROSE_COLOR = (0.8, 0.8, 0.8, 1.0)
 
-    def drawLine(points, loop=False, color=(0.1, 0.4, 0.8, 0.8), thickness=2):
-        bgl.glLineWidth(thickness)
-        bgl.glBlendColor(color[0], color[1], color[2], color[3])
-        bgl.glBegin(bgl.GL_LINE_STRIP)
-        for p in points:
-            bgl.glVertex3f(p[0], p[1], p[2])
-        if loop:
-            p = points[0]
-            bgl.glVertex3f(p[0], p[1], p[2])
-        bgl.glEnd()
-        return points
-
-    def dayPoints(Month, Day):
-        sc = bpy.context.scene
-        N = sc.Site.northAxis
-        Long = sc.Site.longitude
-        Lat = sc.Site.latitude
-        TimeZone = sc.Site.timezone
-        dt = 4 # timesteps per hour
-        coords = [(0.0,0.0,0.0)]*(24*dt)
-        i = 0
-        for Hour in range(24):
-            for T in range(dt):
-                Minute = T*(60/dt)
-                (Az, El) = Solar_Pos(Long, Lat, TimeZone, Month, Day, Hour, Minute)
-                if sc.ODS_SUN.sunpath.flat:
-                    if sc.ODS_SUN.sunpath.equi:
-                        coords[i] = azElToPolar(radians(Az)+N, radians(El))
-                    else:
-                        coords[i] = azElToXYZ(radians(Az)+N, radians(El))
-                        coords[i][2] = 0.0
-                else:
-                    coords[i] = azElToXYZ(radians(Az)+N, radians(El))
-                # Finally shift the coordinate to the offset centre
-                for j in range(3):
-                    coords[i][j] += sc.ODS_SUN.sunpath.pos[j]
-                i += 1
-        return coords
-
-    def drawCompassRose(color=(0.8,0.8,0.8,1.0)):
-        def tick(ang,f):
-            X = sin(ang); Y = cos(ang);
-            return [(R*X+O[0], R*Y+O[1], O[2]), (R*f*X+O[0], R*f*Y+O[1], O[2])]
-        sc = bpy.context.scene
-        R = sc.ODS_SUN.arcRadius
-        N = sc.Site.northAxis
-        O = sc.ODS_SUN.sunpath.pos
-        T = [N+(i*2*pi/360) for i in range(360)]
-        # Draw inner concentric circles
-        if sc.ODS_SUN.sunpath.circles:
-            for i in range(1,9):
-                if sc.ODS_SUN.sunpath.flat and sc.ODS_SUN.sunpath.equi:
-                    r = (i*R/9)
-                else:
-                    r = R*sin((pi/2)*(i/9))
-                P = [(r*sin(t)+O[0], r*cos(t)+O[1], O[2]) for t in T]
-                drawLine(P, loop=True, color=color, thickness=0.7)
-        # Draw the thick outer circle (90 degrees)
-        P = [(R*sin(t)+O[0], R*cos(t)+O[1], O[2]) for t in T]
-        drawLine(P, loop=True, color=color)
-        # Draw the ticks
-        drawLine(tick(N,1.2), color=color)
-        for i in range(8):
-            T = N+(i*2*pi/8)
-            drawLine(tick(T,1.1), color=color)
-        for i in range(36):
-            T = N+(i*2*pi/36)
-            drawLine(tick(T,1.05), color=color)
-        return
-
-    def calcSunPath():
-        datum = datetime.datetime(2010,1,1)
-        for day in range(365):
-            t = datum + datetime.timedelta(day)
-            dp = dayPoints(t.month, t.day)
-            points[day] = dp
-            if t.day == 1:
-                daylines[t.month-1] = dp
-        for i in range(0,24):
-            loops[i] = [points[day][i*4] for day in range(365)]
-        return None
+# Cached geometry.  The batches are (color, line width, batch) tuples that are
+# only rebuilt when the geometry key (site, sun table and sunpath settings) changes
+cache = {'key': None, 'pending': None, 'batches': []}
 
-    def getTextLocation():
-        context = bpy.context
-        scene = bpy.context.scene
-        X = 62; Y = 4;
-        pos_x = int( (context.region.width ) - X)
-        pos_y = int( Y ) #(context.region.height)
-        return(pos_x, pos_y)
-
-    def drawTime():
-        font_size = 20
-        (r,g,b,alpha)=(1.0,1.0,1.0,1.0)
-        blf.size(0, font_size, 72)
-        (pos_x, pos_y) = getTextLocation()
-        blf.position(0, pos_x, pos_y , 0)
-        bgl.glBlendColor(r, g, b, alpha)
-        (hour,minute) = frameToTime(bpy.context.scene.frame_current)
-        if hour >= 24:
-            minute = 0
-        blf.draw(0, "%02i:%02i"%(min(hour,24),minute))
-        return None
 
-    def drawSunPath():
-        for line in daylines:
-            drawLine(line)
-        for line in loops:
-            drawLine(line, loop=True, color=(1.0,0.8,0.0,1.0))
-        drawCompassRose()
+def shader():
+    return gpu.shader.from_builtin('3D_UNIFORM_COLOR' if bpy.app.version < (3, 4, 0) else 'UNIFORM_COLOR')
+
+
+def geometryKey(sc):
+    s = sc.ODS_SUN.sunpath
+    return (
+        sc.Site.latitude, sc.Site.longitude, sc.Site.timezone, sc.Site.northAxis, sc.ODS_SUN.algorithm,
+        sc.ODS_SUN.arcRadius, s.flat, s.equi, s.circles, tuple(s.pos)
+    )
+
+
+def calcSunPath(sc):
+    """ Coordinates of the day lines (12, frames, 3) and the hourly analemma loops (24, days, 3)
+    """
+    R = sc.ODS_SUN.arcRadius
+    dt = 4 # timesteps per hour
+    table = scene_sun_table(sc, steps_per_hour=dt)
+    (Az, El) = table.radians()
+    (Az, El) = (Az[:, table.frames()], El[:, table.frames()])
+    if sc.ODS_SUN.sunpath.flat:
+        if sc.ODS_SUN.sunpath.equi:
+            coords = az_el_to_polar(Az, El, R)
+        else:
+            coords = az_el_to_xyz(Az, El, R)
+            coords[..., 2] = 0.0
+    else:
+        coords = az_el_to_xyz(Az, El, R)
+    # Finally shift the coordinates to the offset centre
+    coords += np.array(sc.ODS_SUN.sunpath.pos)
+    return (coords[MONTH_START_DAYS], coords[:, ::dt].transpose(1, 0, 2))
+
+
+def calcCompassRose(sc):
+    """ Line segments of the (thin) inner circles and the (thick) outer circle and ticks
+    """
+    R = sc.ODS_SUN.arcRadius
+    N = sc.Site.northAxis
+    O = np.array(sc.ODS_SUN.sunpath.pos)
+    T = N + np.arange(360) * (2*pi/360)
+    circle = np.stack([np.sin(T), np.cos(T), np.zeros(360)], axis=-1)
+
+    # Inner concentric circles
+    inner = []
+    if sc.ODS_SUN.sunpath.circles:
+        for i in range(1,9):
+            if sc.ODS_SUN.sunpath.flat and sc.ODS_SUN.sunpath.equi:
+                r = (i*R/9)
+            else:
+                r = R*np.sin((pi/2)*(i/9))
+            inner.append(r*circle + O)
+
+    # The outer circle (90 degrees) and the north, 8 and 36 division ticks
+    outer = [R*circle + O]
+    ticks = [(N, 1.2)] + [(N+(i*2*pi/8), 1.1) for i in range(8)] + [(N+(i*2*pi/36), 1.05) for i in range(36)]
+    for (ang, f) in ticks:
+        X = np.sin(ang); Y = np.cos(ang);
+        outer.append(np.array([(R*X, R*Y, 0.0), (R*f*X, R*f*Y, 0.0)]) + O)
+    return (inner, outer, len(ticks))
+
+
+def lineBatch(polylines, closed=0):
+    """ One LINES batch for many polylines.  The first `closed` polylines are drawn as loops
+    """
+    coords = []
+    indices = []
+    offset = 0
+    for (n, line) in enumerate(polylines):
+        count = len(line)
+        i = np.arange(offset, offset + count)
+        segments = np.stack([i[:-1], i[1:]], axis=-1)
+        if n < closed:
+            segments = np.vstack([segments, [[i[-1], i[0]]]])
+        coords.append(np.asarray(line, dtype=np.float32).reshape(-1, 3))
+        indices.append(segments)
+        offset += count
+    if not coords:
         return None
+    return batch_for_shader(shader(), 'LINES', {"pos": np.vstack(coords)}, indices=np.vstack(indices).astype(np.int32))
+
+
+def buildBatches(sc):
+    (daylines, loops) = calcSunPath(sc)
+    (inner, outer, nTicks) = calcCompassRose(sc)
+    batches = [
+        (DAY_COLOR, 2.0, lineBatch(daylines)),
+        (LOOP_COLOR, 2.0, lineBatch(loops, closed=len(loops))),
+        (ROSE_COLOR, 0.7, lineBatch(inner, closed=len(inner))),
+        (ROSE_COLOR, 2.0, lineBatch(outer, closed=1)),
+    ]
+    return [b for b in batches if b[2] is not None]
+
+
+def rebuild():
+    """ Timer callback: rebuild the batches for the latest settings and redraw
+    """
+    sc = bpy.context.scene
+    cache['batches'] = buildBatches(sc)
+    cache['key'] = geometryKey(sc)
+    cache['pending'] = None
+    sc.ODS_SUN.sunpath.recalc = False
+    tagRedraw()
+    return None
+
+
+def requestRebuild(key):
+    """ Rebuild DEBOUNCE seconds after the last change, so dragging a slider
+    rebuilds the geometry once rather than on every step of the drag
+    """
+    cache['pending'] = key
+    if bpy.app.timers.is_registered(rebuild):
+        bpy.app.timers.unregister(rebuild)
+    bpy.app.timers.register(rebuild, first_interval=DEBOUNCE)
 
-    # Draw the time
-    if bpy.context.scene.ODS_SUN.sunpath.time:
-        drawTime()
 
-    if not bpy.context.scene.ODS_SUN.sunpath.path:
+def tagRedraw():
+    for window in bpy.context.window_manager.windows:
+        for area in window.screen.areas:
+            if area.type == 'VIEW_3D':
+                area.tag_redraw()
+
+
+def draw_sunpath_callback(self, context):
+    sc = context.scene
+    if not sc.ODS_SUN.sunpath.path:
         return None
 
-    # Get & convert the Perspective Matrix of the current view/region.
-    #bgl.glClear(bgl.GL_COLOR_BUFFER_BIT)
-    view3d = bpy.context
-    region = view3d.region_data
-    perspMatrix = region.perspective_matrix
-    tempMat = [perspMatrix[j][i] for i in range(4) for j in range(4)]
-    perspBuff = bgl.Buffer(bgl.GL_FLOAT, 16, tempMat)
-
-    # ---
-    # Store previous OpenGL settings.
-    # Store MatrixMode
-    MatrixMode_prev = bgl.Buffer(bgl.GL_INT, [1])
-    bgl.glGetIntegerv(2976, MatrixMode_prev)  # bgl.GL_MATRIX_MODE
-    MatrixMode_prev = MatrixMode_prev[0]
-
-    # Store projection matrix
-    ProjMatrix_prev = bgl.Buffer(bgl.GL_DOUBLE, [16])
-    bgl.glGetFloatv(2983, ProjMatrix_prev)  # bgl.GL_PROJECTION_MATRIX
-
-    # Store Line width
-    lineWidth_prev = bgl.Buffer(bgl.GL_FLOAT, [1])
-    bgl.glGetFloatv(bgl.GL_LINE_WIDTH, lineWidth_prev)
-    lineWidth_prev = lineWidth_prev[0]
-
-    # Store GL_BLEND
-    blend_prev = bgl.Buffer(bgl.GL_BYTE, [1])
-    bgl.glGetFloatv(bgl.GL_BLEND, blend_prev)
-    blend_prev = blend_prev[0]
-
-    line_stipple_prev = bgl.Buffer(bgl.GL_BYTE, [1])
-    bgl.glGetFloatv(2852, line_stipple_prev)  # bgl.GL_LINE_STIPPLE
-    line_stipple_prev = line_stipple_prev[0]
-
-    # Store glColor4f
-    color_prev = bgl.Buffer(bgl.GL_FLOAT, [4])
-    bgl.glGetFloatv(bgl.GL_COLOR, color_prev)
-
-    # ---
-    # Prepare for 3D drawing
-    bgl.glLoadIdentity()
-    bgl.glMatrixMode(5889)  # bgl.GL_PROJECTION
-    bgl.glLoadMatrixf(perspBuff)
-
-    bgl.glEnable(bgl.GL_BLEND)
-    bgl.glEnable(bgl.GL_LINE_SMOOTH)
-    #bgl.glEnable(bgl.GL_LINE_STIPPLE)
-    if not bpy.context.scene.ODS_SUN.sunpath.xray:
-        bgl.glEnable(bgl.GL_DEPTH_TEST)
-
-    # Draw the day sunpath lines
-    if bpy.context.scene.ODS_SUN.sunpath.recalc:
-        calcSunPath()
-        drawSunPath()
-        bpy.context.scene.ODS_SUN.sunpath.recalc = False
-    else:
-        drawSunPath()
-
-    # ---
-    # Restore previous OpenGL settings
-    if not bpy.context.scene.ODS_SUN.sunpath.xray:
-        bgl.glDisable(bgl.GL_DEPTH_TEST)
-    bgl.glLoadIdentity()
-    bgl.glMatrixMode(MatrixMode_prev)
-    bgl.glLoadMatrixf(ProjMatrix_prev)
-    bgl.glLineWidth(lineWidth_prev)
-    if not blend_prev:
-        bgl.glDisable(bgl.GL_BLEND)
-    if not line_stipple_prev:
-        bgl.glDisable(2852)  # bgl.GL_LINE_STIPPLE
-    bgl.glBlendColor(
-        color_prev[0],
-        color_prev[1],
-        color_prev[2],
-        color_prev[3])
+    key = geometryKey(sc)
+    if not cache['batches']:
+        # Build straight away the first time so there is something to draw
+        cache['batches'] = buildBatches(sc)
+        cache['key'] = key
+    elif (key != cache['key'] or sc.ODS_SUN.sunpath.recalc) and key != cache['pending']:
+        requestRebuild(key)
+
+    gpu.state.blend_set('ALPHA')
+    if not sc.ODS_SUN.sunpath.xray:
+        gpu.state.depth_test_set('LESS_EQUAL')
+    s = shader()
+    s.bind()
+    for (color, width, batch) in cache['batches']:
+        gpu.state.line_width_set(width)
+        s.uniform_float("color", color)
+        batch.draw(s)
+    gpu.state.line_width_set(1.0)
+    gpu.state.depth_test_set('NONE')
+    gpu.state.blend_set('NONE')
+    return None
+
 
+def draw_time_callback(self, context):
+    if not context.scene.ODS_SUN.sunpath.time:
+        return None
+    font_size = 20
+    X = 62; Y = 4;
+    blf.size(0, font_size, 72)
+    blf.position(0, int(context.region.width - X), Y, 0)
+    blf.color(0, 1.0, 1.0, 1.0, 1.0)
+    (hour,minute) = frameToTime(context.scene.frame_current)
+    if hour >= 24:
+        minute = 0
+    blf.draw(0, "%02i:%02i"%(min(hour,24),minute))
     return None
 
 
@@ -224,16 +201,19 @@ class VIEW3D_OT_display_sunpath(bpy.types.Operator):
     bl_options = {'REGISTER'}
 
     def modal(self, context, event):
-        if context.area:
-            context.area.tag_redraw()
-        if event.type == 'TIMER':
-            # no input, so no need to change the display
-            return {'PASS_THROUGH'}
+        # Redraws come from the property updates, frame changes and the rebuild timer
         if not context.scene.ODS_SUN.sunpath.draw:
-            context.region.callback_remove(self._handle)
+            self.remove_handlers()
+            tagRedraw()
             return {'CANCELLED'}
         return {'PASS_THROUGH'}
 
+    def remove_handlers(self):
+        bpy.types.SpaceView3D.draw_handler_remove(self._handle, 'WINDOW')
+        bpy.types.SpaceView3D.draw_handler_remove(self._time_handle, 'WINDOW')
+        cache['batches'] = []
+        cache['key'] = None
+
     def invoke(self, context, event):
         draw = context.scene.ODS_SUN.sunpath.draw
         context.scene.ODS_SUN.sunpath.draw = not draw
@@ -246,7 +226,7 @@ class VIEW3D_OT_display_sunpath(bpy.types.Operator):
         if context.area.type == 'VIEW_3D':
             mgr_ops = context.window_manager.operators.values()
             if not self.bl_idname in [op.bl_idname for op in mgr_ops]:
-                # Add the region OpenGL drawing callback
+                # Add the 3D sunpath and the 2D time drawing callbacks
                 for WINregion in context.area.regions:
                     if WINregion.type == 'WINDOW':
                         context.window_manager.modal_handler_add(self)
@@ -254,8 +234,15 @@ class VIEW3D_OT_display_sunpath(bpy.types.Operator):
                             draw_sunpath_callback,
                             (self, context),
                             'WINDOW',
+                            'POST_VIEW'
+                        )
+                        self._time_handle = bpy.types.SpaceView3D.draw_handler_add(
+                            draw_time_callback,
+                            (self, context),
+                            'WINDOW',
                             'POST_PIXEL'
                         )
+                        tagRedraw()
                         print("Sunpath display callback added")
                         return {'RUNNING_MODAL'}
             return {'CANCELLED'}
@@ -304,6 +291,7 @@ class VIEW3D_PT_sunpath(bpy.types.Panel):
             if sc.ODS_SUN.sunpath.flat:
                 row.prop(sc.ODS_SUN.sunpath, "equi", text="Equidistant")
         layout.row().prop(sc.ODS_SUN, "arcRadius", text="Radius")
+        layout.row().prop(sc.ODS_SUN, "algorithm")
         layout.row().prop(sc.ODS_SUN.sunpath, "pos", text="")
 
         return None
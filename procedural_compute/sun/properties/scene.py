@@ -32,7 +32,15 @@ class BM_SCENE_SUN(bpy.types.PropertyGroup):
 
     solarDT: bpy.props.IntProperty(name="TimeStepsPerHour",
                                     min=1, max=60,
-                                    default=4,description="Timesteps Per Hour")
+                                    default=4,description="Timesteps Per Hour", update=recalcsunpath)
+
+    algorithm: bpy.props.EnumProperty(name="Algorithm",
+                                    items=[("carruthers", "Carruthers", "Carruthers et al (sun held on the horizon at night)"),
+                                           ("noaa", "NOAA", "NOAA general solar position (higher accuracy)")],
+                                    default="carruthers", description="Solar position algorithm", update=recalcsunpath)
+
+    diskCache: bpy.props.BoolProperty(name="Cache Sun Tables On Disk", default=False,
+                                    description="Keep the annual sun position tables in the temp directory between sessions")
 
     arcRadius: bpy.props.FloatProperty(name="arcRadius",
                                     min=0.0, default=10.0, description="Radius of Sun Arc", update=recalcsunpath)
@@ -19,243 +19,162 @@
 # http://www.srrb.noaa.gov/highlights/sunrise/calcdetails.html
 #
 # Enter data in this way:
-# Solar_Pos (Lat, Long, TimeZone, Month, Day, Hour)
-# It will return (Altitude, Azimuth)
+# Solar_Pos (Long, Lat, TimeZone, Month, Day, Hour, Minute)
+# It will return (Azimuth, Altitude)
+# or for arrays of (day-of-year, hour, minute):
+# solar_position(Long, Lat, TimeZone, Day, Hour, Minute)
 # Only Altitude and Azimuth are needed to trace the sun position, for that you will
 # need the Sun_Trace.py script
 
 import bpy
+import numpy as np
 from math import sin, cos, tan, degrees, radians, pi, acos, asin, atan2, floor
 
+# Day of the year before the first of each month (non-leap year)
+MONTH_START_DAYS = np.array([0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334])
+
+ALGORITHMS = ['carruthers', 'noaa']
+
+
+def day_of_year(month, day):
+    """ Day of the year (1-365) from month (1-12) and day arrays
+    """
+    return MONTH_START_DAYS[np.asarray(month) - 1] + np.asarray(day)
+
+
+def solar_position(longitude, latitude, timezone, day, hour, minute=0.0, algorithm='carruthers'):
+    """ Azimuth and altitude (degrees) of the sun for arrays of day-of-year, hour
+    and minute at a site.  The arrays are broadcast against each other.
+
+    Azimuth is clockwise from north in (-180, 180].  The default 'carruthers'
+    algorithm holds the sun on the horizon between sunset and sunrise (as
+    Solar_Pos always has).  'noaa' uses the NOAA general solar position
+    equations, which are more accurate and give negative altitudes at night.
+    """
+    if algorithm == 'noaa':
+        return _solar_position_noaa(longitude, latitude, timezone, day, hour, minute)
+    if algorithm != 'carruthers':
+        raise ValueError(f"Unknown solar position algorithm: {algorithm}")
+
+    day = np.asarray(day, dtype=np.float64)
+    local_time = np.asarray(hour, dtype=np.float64) + np.asarray(minute, dtype=np.float64) / 60.0
+    lat = radians(latitude)
+
+    # Solar declination as per Carruthers et al
+    t = 2 * pi * ((day - 1) / 365.0)
+    declination = 0.322003 - 22.971 * np.cos(t) - 0.357898 * np.cos(2*t) - 0.14398 * np.cos(3*t) + 3.94638 * np.sin(t) + 0.019334 * np.sin(2*t) + 0.05928 * np.sin(3*t)
+    declination = np.radians(np.clip(declination, -89.9, 89.9))
+
+    # Equation of time as per Carruthers et al (hours)
+    t = (279.134 + 0.985647 * day) * (pi/180.0)
+    equation = 5.0323 - 100.976 * np.sin(t) + 595.275 * np.sin(2*t) + 3.6858 * np.sin(3*t) - 12.47 * np.sin(4*t) - 430.847 * np.cos(t) + 12.5024 * np.cos(2*t) + 18.25 * np.cos(3*t)
+    equation = equation / 3600.00
+
+    # Difference (in hours) from the reference longitude and local noon
+    difference = (longitude - timezone * 15) * 4 / 60.0
+    local_noon = 12.0 - equation - difference
+
+    # Sunrise and sunset (from the angle normal to the meridian plane)
+    clamped_lat = min(max(lat, -0.99 * (pi/2.0)), 0.99 * (pi/2.0))
+    t = np.arccos(np.clip(-tan(clamped_lat) * np.tan(declination), -1.0, 1.0)) / (15 * (pi / 180.0))
+    sunrise = local_noon - t
+    sunset = local_noon + t
+
+    # Hold the sun on the horizon outside of daylight hours
+    clamped_time = np.where(local_time > sunset, sunset, local_time)
+    clamped_time = np.where(clamped_time < sunrise, sunrise, clamped_time)
+    clamped_time = np.clip(clamped_time, 0.0, 24.0)
+
+    # Solar time and hour angle
+    solar_time = clamped_time + equation + difference
+    hour_angle = 15 * (solar_time - 12) * (pi/180.0)
+
+    # Altitude
+    altitude = np.arcsin(np.sin(declination) * sin(lat) + np.cos(declination) * cos(lat) * np.cos(hour_angle))
+
+    # Azimuth (avoiding division by zero at the zenith)
+    t = (cos(lat) * np.sin(declination)) - (np.cos(declination) * sin(lat) * np.cos(hour_angle))
+    below_zenith = altitude < (pi/2.0)
+    cos_altitude = np.where(below_zenith, np.cos(altitude), 1.0)
+    sin1 = np.clip(np.where(below_zenith, (-np.cos(declination) * np.sin(hour_angle)) / cos_altitude, 0.0), -1.0, 1.0)
+    cos2 = np.clip(np.where(below_zenith, t / cos_altitude, 0.0), -1.0, 1.0)
+
+    # Azimuth subject to quadrant
+    asin1 = np.arcsin(sin1)
+    azimuth = np.select(
+        [
+            sin1 < -0.99999,
+            (sin1 > 0.0) & (cos2 < 0.0) & (sin1 >= 1.0),
+            (sin1 > 0.0) & (cos2 < 0.0),
+            (sin1 < 0.0) & (cos2 < 0.0),
+        ],
+        [
+            asin1,
+            -(pi/2.0),
+            pi - asin1,
+            -pi - asin1,
+        ],
+        default=asin1
+    )
+
+    # A little last-ditch range check.
+    azimuth = np.where((azimuth < 0.0) & (local_time < 10.0), -azimuth, azimuth)
+
+    return (np.degrees(azimuth), np.degrees(altitude))
+
+
+def _solar_position_noaa(longitude, latitude, timezone, day, hour, minute=0.0):
+    """ NOAA general solar position calculation (fractional year method)
+    """
+    day = np.asarray(day, dtype=np.float64)
+    hour = np.asarray(hour, dtype=np.float64)
+    minute = np.asarray(minute, dtype=np.float64)
+    lat = radians(latitude)
+
+    gamma = 2 * pi / 365.0 * (day - 1 + (hour - 12) / 24.0)
+    equation = 229.18 * (0.000075 + 0.001868 * np.cos(gamma) - 0.032077 * np.sin(gamma) - 0.014615 * np.cos(2*gamma) - 0.040849 * np.sin(2*gamma))
+    declination = 0.006918 - 0.399912 * np.cos(gamma) + 0.070257 * np.sin(gamma) - 0.006758 * np.cos(2*gamma) + 0.000907 * np.sin(2*gamma) - 0.002697 * np.cos(3*gamma) + 0.00148 * np.sin(3*gamma)
+
+    # True solar time (minutes) and hour angle
+    solar_time = hour * 60 + minute + equation + 4 * longitude - 60 * timezone
+    hour_angle = np.radians(solar_time / 4.0 - 180.0)
+
+    altitude = np.arcsin(np.clip(sin(lat) * np.sin(declination) + cos(lat) * np.cos(declination) * np.cos(hour_angle), -1.0, 1.0))
+    azimuth = np.arctan2(np.sin(hour_angle), np.cos(hour_angle) * sin(lat) - np.tan(declination) * cos(lat)) + pi
+    azimuth = np.mod(np.degrees(azimuth) + 180.0, 360.0) - 180.0
+    return (azimuth, np.degrees(altitude))
+
+
+def annual_solar_position(longitude, latitude, timezone, steps_per_hour=1, algorithm='carruthers'):
+    """ Azimuth and altitude arrays of shape (365, 24*steps_per_hour) for every
+    timestep of the year.  The day terms are computed once per day by broadcasting.
+    """
+    days = np.arange(1, 366)[:, None]
+    minutes = (np.arange(24 * steps_per_hour) * (60.0 / steps_per_hour))[None, :]
+    return solar_position(longitude, latitude, timezone, days, minutes // 60, minutes % 60, algorithm=algorithm)
+
+
+def az_el_to_xyz(az, el, radius):
+    """ Array version of azElToXYZ (radians in, (..., 3) coordinates out)
+    """
+    return np.stack([radius*np.cos(el)*np.sin(az), radius*np.cos(el)*np.cos(az), radius*np.sin(el)], axis=-1)
+
+
+def az_el_to_polar(az, el, radius):
+    """ Array version of azElToPolar (radians in, (..., 3) coordinates out)
+    """
+    r = radius*((pi/2)-el)/(pi/2)
+    return np.stack([r*np.sin(az), r*np.cos(az), np.zeros(np.shape(r))], axis=-1)
+
+
 ##This calculates the sun position
-def Solar_Pos (Long, Lat, TimeZone, Month, Day, Hour, Minute):
-
-##  Calculates Julian Day - at arbitrary (epoch or 4713BC) year
-    def J_Day(Month, Day):
-        monthDayList = [0,31,59,90,120,151,181,212,243,273,304,334]
-        j_day = monthDayList[Month-1] + Day
-        return j_day
-
-    ##  Solar declination as per Carruthers et al:
-    def Dec(J_Day):
-        t = 2 * pi * ((J_Day - 1) / 365.0)
-        Dec = 0.322003 - 22.971 * cos(t) - 0.357898 * cos(2*t) - 0.14398 * cos(3*t) + 3.94638 * sin(t) + 0.019334 * sin(2*t) + 0.05928 * sin(3*t)
-        #Convert degrees to radians.
-        if (Dec > 89.9):
-            Dec = 89.9
-        if (Dec < -89.9):
-            Dec = -89.9
-        Dec = radians(Dec)
-        return Dec
-
-    ##  Calculate the equation of time as per Carruthers et al.
-    def EquationOfTime(J_Day):
-        t = (279.134 + 0.985647 * J_Day) * (pi/180.0)
-        fEquation = 5.0323 - 100.976 * sin(t) + 595.275 * sin(2*t) + 3.6858 * sin(3*t) - 12.47 * sin(4*t) - 430.847 * cos(t) + 12.5024 * cos(2*t) + 18.25 * cos(3*t)
-        #Convert seconds to hours.
-        fEquation = fEquation / 3600.00
-        return fEquation
-
-    ##  Calculate Local Time
-    def Local_Time(Hour, Minute):
-        fLocal = Hour + (Minute/60.0)
-        return fLocal
-
-    ##  Calculate solar time.
-    def Solar_Time(fLongitude, fLatitude, fTimeZone, fLocalTime, fEquation):
-
-        # Calculate difference (in minutes) from reference longitude.
-        fDifference = degrees(fLongitude - fTimeZone) * 4 / 60.0
-
-        # Convert solar noon to local noon.
-        local_noon = 12.0 - fEquation - fDifference
-
-        # Calculate angle normal to meridian plane.
-        if (fLatitude > (0.99 * (pi/2.0))):
-            fLatitude = (0.99 * (pi/2.0))
-        if (fLatitude < -(0.99 * (pi/2.0))):
-            fLatitude = -(0.99 * (pi/2.0))
-
-        test = -tan(fLatitude) * tan(fDeclination)
-
-        if (test < -1):
-            t = acos(-1.0) / (15 * (pi / 180.0))
-        elif (test > 1):
-            t = acos(1.0) / (15 * (pi / 180.0))
-        else:
-            t = acos(-tan(fLatitude) * tan(fDeclination)) / (15 * (pi / 180.0))
-
-        # Sunrise and sunset.
-        fSunrise = local_noon - t
-        fSunset  = local_noon + t
-
-        # Check validity of local time.
-        if (fLocalTime > fSunset):
-            fLocalTime = fSunset
-        if (fLocalTime < fSunrise):
-            fLocalTime = fSunrise
-        if (fLocalTime > 24.0):
-            fLocalTime = 24.0
-        if (fLocalTime < 0.0):
-            fLocalTime = 0.0
-
-        # Calculate solar time.
-        fSolarTime = fLocalTime + fEquation + fDifference
-
-        return (fSolarTime, fSunrise, fSunset)
-
-##  Calculate Sun Hour Angle
-    def H_Ang(fSolarTime):
-
-        fHourAngle = 15 * (fSolarTime - 12) * (pi/180.0)
-        return fHourAngle
-
-##  Calculate current altitude
-    def Alt(fLatitude, fDeclination, fHourAngle):
-
-        t = sin(fDeclination) * sin(fLatitude) + cos(fDeclination) * cos(fLatitude) * cos(fHourAngle)
-        fAltitude = asin(t)
-
-        return fAltitude
-
-##  Calculates Sun Azimuth
-    def Az(fLatitude, fAltitude, fDeclination, fHourAngle):
-
-        t = (cos(fLatitude) * sin(fDeclination)) - (cos(fDeclination) * sin(fLatitude) * cos(fHourAngle))
-
-        # Avoid division by zero error.
-        if (fAltitude < (pi/2.0)):
-            sin1 = (-cos(fDeclination) * sin(fHourAngle)) / cos(fAltitude)
-            cos2 = t / cos(fAltitude)
-
-        else:
-            sin1 = 0.0
-            cos2 = 0.0
-
-        # Some range checking.
-        if (sin1 > 1.0):
-            sin1 = 1.0
-        if (sin1 < -1.0):
-            sin1 = -1.0
-        if (cos2 < -1.0):
-            cos2 = -1.0
-        if (cos2 > 1.0):
-            cos2 = 1.0
-
-        # Calculate azimuth subject to quadrant.
-        if (sin1 < -0.99999):
-            fAzimuth = asin(sin1)
-        elif ((sin1 > 0.0) & (cos2 < 0.0)):
-            if (sin1 >= 1.0):
-                fAzimuth = -(pi/2.0)
-            else:
-                fAzimuth = (pi/2.0) + ((pi/2.0) - asin(sin1))
-        elif ((sin1 < 0.0) & (cos2 < 0.0)):
-            if (sin1 <= -1.0):
-                fAzimuth = (pi/2.0)
-            else:
-                fAzimuth = -(pi/2.0) - ((pi/2.0) + asin(sin1))
-        else:
-            fAzimuth = asin(sin1)
-
-        # A little last-ditch range check.
-        if ((fAzimuth < 0.0) & (fLocalTime < 10.0)):
-            fAzimuth = -fAzimuth
-
-        return fAzimuth
-
-    ##  Tell the script what to do
-
-    # convert latitude, longitude and timezone to radians
-    Lat = radians(Lat)
-    Long = radians(Long)
-    TimeZone = radians(TimeZone * 15)
-
-    # get Julian Day
-    if Month == []:
-        Julian = Day
-    else:
-        Julian = J_Day(Month, Day)
-
-    # get Declination
-    fDeclination = Dec(Julian)
-
-    # get Equation of Time
-    fEquation = EquationOfTime(Julian)
-
-    # get Local Time
-    fLocalTime = Local_Time(Hour, Minute)
-
-    # get Solar Time
-    fSolarTime = Solar_Time(Long, Lat, TimeZone, fLocalTime, fEquation)
-    fSunrise = fSolarTime[1]
-    fSunset = fSolarTime[2]
-
-    # get Hour Angle
-    Hour_Angle = H_Ang(fSolarTime[0])
-
-    # get Altitude
-    fAltitude = Alt(Lat, fDeclination, Hour_Angle)
-
-    # get Azimuth
-    fAzimuth = Az(Lat, fAltitude, fDeclination, Hour_Angle)
-
-    ##  Prepare output values
-
-    # Output Declination.
-    fDeclination = degrees(fDeclination)
-
-    # Output equation of time.
-    fEquation = fEquation * 60
-
-    # Output altitude value.
-    fAltitude = degrees(fAltitude)
-
-    # Output azimuth value.
-    fAzimuth = degrees(fAzimuth)
-
-    # Output solar time.
-    t = int(floor(fSolarTime[0]))
-    m = int(floor((fSolarTime[0] - t) * 60.0))
-    if (m < 10):
-        minute = "0" + str(m)
-    else: minute = m
-    if (t < 10):
-        hour = "0" + str(t)
-    else:
-        hour = t
-    sSolarTime = str(hour) + ":" + str(minute)
-
-    # Output sunrise time.
-    t = int(floor(fSunrise))
-    m = int(floor((fSunrise - t) * 60.0))
-    if (m < 10):
-        minute = "0" + str(m)
-    else:
-        minute = m
-    if (t < 10):
-        hour = "0" + str(t)
-    else:
-        hour = t
-    sSunrise = str(hour) + ":" + str(minute)
-
-    # Output sunset time.
-    t = int(floor(fSunset))
-    m = int(floor((fSunset - t) * 60.0))
-    if (m < 10):
-        minute = "0" + str(m)
-    else:
-        minute = m
-    if (t < 10):
-        hour = "0" + str(t)
-    else:
-        hour = t
-    fSunset = str(hour) + ":" + str(minute)
-
-    # This last line is what Python returns to you, in this case:
-    # Declination, Equation, Azimuth, Altitude, SolarTime, Sunrise, Sunset
-    #return (fDeclination, fEquation, fAzimuth, fAltitude, sSolarTime, sSunrise, fSunset)
-    return (fAzimuth, fAltitude)
+def Solar_Pos (Long, Lat, TimeZone, Month, Day, Hour, Minute, algorithm='carruthers'):
+    """ Scalar sun position (Azimuth, Altitude) in degrees.  If Month is [] then
+    Day is the day of the year.  See solar_position for arrays of times.
+    """
+    Julian = Day if Month == [] else day_of_year(Month, Day)
+    (fAzimuth, fAltitude) = solar_position(Long, Lat, TimeZone, Julian, Hour, Minute, algorithm=algorithm)
+    return (float(fAzimuth), float(fAltitude))
 
 def getNames(objList):
     N = len(objList)
@@ -285,44 +204,31 @@ def applySolarAzElCurves(ob):
 
     # Get currently selected object
     sc = bpy.context.scene
-    N = sc.Site.northAxis
-    
+
     # Clear animation data
     ob.animation_data_clear()
 
     dt = sc.ODS_SUN.solarDT
-    Long = sc.Site.longitude
-    Lat = sc.Site.latitude
-    TimeZone = sc.Site.timezone
     Month = sc.ODS_SUN.month
     Day = sc.ODS_SUN.day
 
-    # Step through all frames and define Sun Path
-    cc = 0
-    #for Day in range(180,181):
-    for Hour in range(24):
-        for T in range(dt):
-            Minute = T*(60/dt)
-            (Az, El) = Solar_Pos(Long, Lat, TimeZone, Month, Day, Hour, Minute)
-            # Adjust the azimuth to the site rotation and get LocX, LocY and LocZ position of sun
-            (X,Y,Z) = azElToXYZ(radians(Az)+N, radians(El))
-            # Get rotations about x, y and z-axes to always target 0,0,0
-            Ry = 0.0
-            Rxy = (X**2 + Y**2)**0.5
-            Rx = (atan2(Rxy,Z))
-            Rz = atan2(X,-1.0*Y)
-            # Define a position vector
-            PVec = [X,Y,Z,Rx,Ry,Rz]
-
-            # Set the current frame
-            sc.frame_current = cc
-            ob.location = [PVec[0],PVec[1],PVec[2]]
-            ob.rotation_euler = [PVec[3],PVec[4],PVec[5]]
-            ob.keyframe_insert("location")
-            ob.keyframe_insert("rotation_euler")
-
-            # Increment the counter
-            cc += 1
+    # Sun positions for every frame of the day from the site sun table
+    # (the azimuth already includes the site rotation)
+    from procedural_compute.sun.utils.suntable import scene_sun_table
+    from procedural_compute.core.utils.keyframes import bakeKeyframes
+    (Az, El) = scene_sun_table(sc).day(Month, Day)
+    (Az, El) = (np.radians(Az[:24*dt]), np.radians(El[:24*dt]))
+
+    # LocX, LocY and LocZ position of sun and rotations about x, y and z-axes to always target 0,0,0
+    loc = az_el_to_xyz(Az, El, sc.ODS_SUN.arcRadius)
+    (X, Y, Z) = loc.T
+    rot = np.stack([np.arctan2(np.hypot(X, Y), Z), np.zeros(len(X)), np.arctan2(X, -1.0*Y)], axis=-1)
+
+    # Bake the keyframes for each frame
+    cc = len(loc)
+    frames = np.arange(cc)
+    bakeKeyframes(ob, "location", frames, loc)
+    bakeKeyframes(ob, "rotation_euler", frames, rot)
 
     # Set the ending frame for animations
     sc.frame_end = cc-1
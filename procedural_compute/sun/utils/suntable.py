@@ -0,0 +1,159 @@
+###########################################################
+# Blender Addon for Procedural Cloud-based Design Tools
+# Copyright (C) 2020, Procedural (ApS) Denmark
+# License : procedural.build license
+# Version : 1.2
+# Web     : www.procedural.build
+###########################################################
+
+# Annual sun position tables
+#
+# One table holds the azimuth (rotated by the site north axis) and altitude of
+# the sun in degrees for every frame of every day of the year at a site, as
+# (365, 24*steps_per_hour + 1) float32 arrays.  Frame f of a day is the time
+# given by timeFrameSync.frameToTime(f), so the last column is 24:00.
+#
+# Tables are memoized on (latitude, longitude, timezone, northAxis,
+# steps_per_hour, algorithm) with LRU eviction and optionally saved to disk.
+# Changing any of the Site or ODS_SUN properties changes the key, so the
+# sunpath, year rays, skies and solar curves never read a stale table.
+
+import bpy
+import numpy as np
+from collections import OrderedDict
+import threading
+import tempfile
+import hashlib
+import os
+import logging
+
+from procedural_compute.sun.utils.suncalcs import solar_position, day_of_year
+
+logger = logging.getLogger(__name__)
+
+MAX_TABLES = 16
+CACHE_DIR = os.path.join(tempfile.gettempdir(), 'procedural_compute', 'sun_tables')
+
+_tables = OrderedDict()
+_lock = threading.Lock()
+
+
+class SunTable():
+
+    def __init__(self, key, azimuth, altitude):
+        self.key = key
+        self.azimuth = azimuth
+        self.altitude = altitude
+
+    @property
+    def steps_per_hour(self):
+        return self.key[4]
+
+    def frames(self):
+        """ Frame columns of the table (hours 00:00 to 23:xx)
+        """
+        return slice(0, 24 * self.steps_per_hour)
+
+    def radians(self):
+        """ (azimuth, altitude) in radians as float64 arrays
+        """
+        return (np.radians(self.azimuth, dtype=np.float64), np.radians(self.altitude, dtype=np.float64))
+
+    def day(self, month, day):
+        """ (azimuth, altitude) rows (degrees) for every frame of a day
+        """
+        row = day_of_year(month, day) - 1
+        return (self.azimuth[row].astype(np.float64), self.altitude[row].astype(np.float64))
+
+    def position(self, month, day, hour, minute):
+        """ (azimuth, altitude) in degrees at a time.  Times between the table
+        timesteps are calculated directly rather than interpolated.
+        """
+        step = 60 // self.steps_per_hour
+        if minute % step or not 0 <= hour * 60 + minute <= 24 * 60:
+            (latitude, longitude, timezone, northAxis, steps, algorithm) = self.key
+            (az, el) = solar_position(longitude, latitude, timezone, day_of_year(month, day), hour, minute, algorithm=algorithm)
+            return (float(az) + float(np.degrees(northAxis)), float(el))
+        (row, col) = (day_of_year(month, day) - 1, hour * self.steps_per_hour + minute // step)
+        return (float(self.azimuth[row, col]), float(self.altitude[row, col]))
+
+    def rays(self):
+        """ Direction vectors (365, frames, 3) towards the sun for rtrace (the
+        year rays).  Night points down and the zenith points straight up.
+        """
+        (az, el) = self.radians()
+        rays = np.stack([np.sin(az), np.cos(az), np.tan(el)], axis=-1)
+        rays[self.altitude <= 0.1] = (0.0, 0.0, -1.0)
+        rays[self.altitude >= 89.9] = (0.0, 0.0, 1.0)
+        return rays
+
+
+def _build(key):
+    (latitude, longitude, timezone, northAxis, steps, algorithm) = key
+    frames = np.arange(24 * steps + 1)
+    # Same hour and minute for each frame as frameToTime
+    (hours, minutes) = (frames // steps, (frames % steps) * (60 // steps))
+    days = np.arange(1, 366)[:, None]
+    (az, el) = solar_position(longitude, latitude, timezone, days, hours[None, :], minutes[None, :], algorithm=algorithm)
+    az = az + np.degrees(northAxis)
+    return SunTable(key, az.astype(np.float32), el.astype(np.float32))
+
+
+def _path(key):
+    return os.path.join(CACHE_DIR, hashlib.sha1(repr(key).encode('utf8')).hexdigest() + '.npy')
+
+
+def _read_disk(key):
+    try:
+        data = np.load(_path(key))
+    except (OSError, ValueError):
+        return None
+    return SunTable(key, data[0], data[1])
+
+
+def _write_disk(table):
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        np.save(_path(table.key), np.stack([table.azimuth, table.altitude]))
+    except OSError as err:
+        logger.info(f"Could not write sun table {_path(table.key)}: {err}")
+
+
+def sun_table(latitude, longitude, timezone, northAxis=0.0, steps_per_hour=4, algorithm='carruthers', disk=False):
+    """ The memoized sun table for a site (northAxis in radians)
+    """
+    key = (round(latitude, 6), round(longitude, 6), round(timezone, 4), round(northAxis, 8), int(steps_per_hour), algorithm)
+    with _lock:
+        table = _tables.get(key)
+        if table is not None:
+            _tables.move_to_end(key)
+            return table
+    table = _read_disk(key) if disk else None
+    if table is None:
+        table = _build(key)
+        if disk:
+            _write_disk(table)
+    with _lock:
+        _tables[key] = table
+        while len(_tables) > MAX_TABLES:
+            _tables.popitem(last=False)
+    return table
+
+
+def scene_sun_table(scene=None, steps_per_hour=None):
+    """ The sun table for the Site and ODS_SUN settings of the scene.
+    steps_per_hour defaults to ODS_SUN.solarDT
+    """
+    sc = scene or bpy.context.scene
+    return sun_table(
+        sc.Site.latitude, sc.Site.longitude, sc.Site.timezone, sc.Site.northAxis,
+        steps_per_hour or sc.ODS_SUN.solarDT, sc.ODS_SUN.algorithm, disk=sc.ODS_SUN.diskCache
+    )
+
+
+def clear(disk=False):
+    with _lock:
+        _tables.clear()
+    if disk and os.path.isdir(CACHE_DIR):
+        for name in os.listdir(CACHE_DIR):
+            os.remove(os.path.join(CACHE_DIR, name))